@@ -1,7 +1,7 @@
 """Accounts permissions"""
 
 from rest_framework.permissions import BasePermission
-from rest_framework.exceptions import NotFound, PermissionDenied
+from rest_framework.exceptions import PermissionDenied
 
 from apps.accounts.models import User
 
@@ -17,17 +17,15 @@ class IsAdminOrDoctorUser(BasePermission):
 
 
 def is_account_owner(request_user, username):
-    """Allow access only to objects owned by the requesting user"""
-    user_db = User.objects.filter(username=username).only('id').first()
-    if user_db is None:
-        raise NotFound(detail='Usuario no encontrado.')
-    return request_user.id == user_db.id
+    """Allow access only to objects owned by the requesting user. The username is unique, so it is not queried."""
+    return request_user.username == username
 
 
 def check_permissions(user, username, permission):
     """
     Verify that the user is a superuser, otherwise that the user is the owner of the resource, or has the necessary
-    permissions.
+    permissions. Only the permission that applies is checked, against the permission set loaded with the authenticated
+    user (apps.accounts.tokens).
 
     :param user: User request
     :param username: Username of url
@@ -35,8 +33,7 @@ def check_permissions(user, username, permission):
     :return: None
     """
     if not user.is_superuser:
-        if (
-                is_account_owner(user, username) and not user.has_perm(f'{permission}_from_me') or
-                not is_account_owner(user, username) and not user.has_perm(permission)
-        ):
+        if is_account_owner(user, username):
+            permission = f'{permission}_from_me'
+        if not user.has_perm(permission):
             raise PermissionDenied()
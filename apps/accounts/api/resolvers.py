@@ -0,0 +1,46 @@
+"""Resolution of the user of the `{username}` URL segment (user_url)"""
+
+from rest_framework.exceptions import NotFound
+
+from apps.accounts.api.serializers.users import UserListAdminSerializer, UserListSerializer
+from apps.accounts.models import User
+
+
+def get_path_user(request, username):
+    """
+    Get the user of the URL. The user is loaded once per request and shared by the permission checks, querysets and
+    serializers of the request, including the view sets called by other view sets. The requesting user is used without
+    a query.
+
+    ADMIN users get any user. The other users only get active users, without the fields that they cannot see.
+
+    :param request: Request
+    :param username: Username of url
+    :raises NotFound: If the user does not exist
+    :return: User object
+    """
+    path_users = getattr(request, '_path_users', None)
+    if path_users is None:
+        path_users = request._path_users = {}
+
+    user = path_users.get(username)
+    if user is not None:
+        return user
+
+    if request.user.username == username and request.user.is_active:
+        user = request.user
+    else:
+        queryset = User.objects.filter(username=username)
+        if request.user.role != User.Type.ADMIN:
+            queryset = queryset.filter(is_active=True).defer(*UserListSerializer.Meta.exclude)
+        user = queryset.first()
+
+    if user is None:
+        raise NotFound(detail='Usuario no encontrado.')
+    path_users[username] = user
+    return user
+
+
+def get_user_serializer_class(request):
+    """Get the serializer of the users that the requesting user can see"""
+    return UserListAdminSerializer if request.user.role == User.Type.ADMIN else UserListSerializer
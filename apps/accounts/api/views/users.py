@@ -3,14 +3,16 @@
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
-from rest_framework.exceptions import NotFound, PermissionDenied
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.filters import OrderingFilter
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 
 from apps.accounts.models import User
 from apps.accounts.api.permissions import IsAdminOrDoctorUser
+from apps.accounts.api.resolvers import get_path_user
 from apps.accounts.api.filters.users import UserFilter
+from apps.chats.purge import purge_user
 from apps.accounts.api.serializers.users import (
     UserListSerializer, UserListAdminSerializer, UserCreateSerializer, UserPasswordChangeSerializer,
     UserProfileUpdateSerializer, UserUpdateSerializer, UserPasswordResetSerializer, UserListRelatedSerializer
@@ -52,20 +54,10 @@ class UserModelViewSet(viewsets.ModelViewSet):
         return queryset.filter(is_active=True).defer(*UserListSerializer.Meta.exclude)
 
     def get_object(self):
-        queryset = self.filter_queryset(self.get_queryset())
-
-        # Perform the lookup filtering.
+        """Get the user of the URL, or the requesting user in the profile actions"""
         lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
         username = self.kwargs[lookup_url_kwarg] if self.kwargs else self.request.user.username
-
-        obj = queryset.filter(is_active=True, username=username).defer(*UserListSerializer.Meta.exclude).first()
-
-        if self.request.user.role == User.Type.ADMIN:
-            obj = queryset.filter(username=username).first()
-
-        if obj is None:
-            raise NotFound(detail='Usuario no encontrado.')
-        return obj
+        return get_path_user(self.request, username)
 
     def retrieve(self, request, username=None, *args, **kwargs):
         """User by username"""
@@ -112,6 +104,15 @@ class UserModelViewSet(viewsets.ModelViewSet):
         serializer.save()
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    def destroy(self, request, username=None, *args, **kwargs):
+        """
+        Delete the user. The user is deactivated and deleted in the background after deleting the messages of its
+        chat rooms in batches.
+        """
+        user = self.get_object()
+        purge_user(user)
+        return Response(status=status.HTTP_202_ACCEPTED)
+
     @action(methods=['get'], detail=False)
     def doctors(self, request):
         """Lists the doctor type users. The endpoint is public."""
@@ -0,0 +1,57 @@
+# Generated by Django 3.2.11 on 2026-10-18 14:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+def copy_sessions(apps, schema_editor):
+    """Copy the unexpired sessions of the default engine with their user, so the users stay logged in"""
+    from django.contrib.sessions.backends.db import SessionStore
+
+    Session = apps.get_model('sessions', 'Session')
+    UserSession = apps.get_model('accounts', 'UserSession')
+    User = apps.get_model('accounts', 'User')
+    store = SessionStore()
+    user_ids = set(User.objects.values_list('id', flat=True))
+    sessions = []
+    for session in Session.objects.filter(expire_date__gte=timezone.now()).iterator():
+        try:
+            user_id = int(store.decode(session.session_data).get('_auth_user_id'))
+        except (TypeError, ValueError):
+            user_id = None
+        sessions.append(UserSession(
+            session_key=session.session_key,
+            session_data=session.session_data,
+            expire_date=session.expire_date,
+            user_id=user_id if user_id in user_ids else None,
+        ))
+    UserSession.objects.bulk_create(sessions, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('sessions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSession',
+            fields=[
+                ('session_key', models.CharField(max_length=40, primary_key=True, serialize=False, verbose_name='session key')),
+                ('session_data', models.TextField(verbose_name='session data')),
+                ('expire_date', models.DateTimeField(db_index=True, verbose_name='expire date')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='usuario')),
+            ],
+            options={
+                'verbose_name': 'session',
+                'verbose_name_plural': 'sessions',
+                'db_table': 'user_session',
+                'abstract': False,
+            },
+        ),
+        migrations.RunPython(copy_sessions, migrations.RunPython.noop),
+    ]
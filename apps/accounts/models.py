@@ -1,16 +1,18 @@
 """Accounts models"""
 
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
-from django.contrib.auth.models import PermissionsMixin
+from django.contrib.auth.models import Group, Permission, PermissionsMixin
 from django.contrib.auth.validators import UnicodeUsernameValidator
+from django.contrib.sessions.base_session import AbstractBaseSession
 from django.core.validators import MinLengthValidator, RegexValidator, FileExtensionValidator
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 from rest_framework_simplejwt.tokens import RefreshToken
 
-from apps.accounts.permissions import create_permissions
+from apps.accounts.permissions import bump_group_permissions_version, create_permissions
 from gestion_consultas.utils import REGEX_LETTERS_ONLY
 
 
@@ -190,6 +192,13 @@ class User(AbstractBaseUser, PermissionsMixin):
     def __str__(self):
         return self.first_name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Username loaded from the database, used to remove the user from the cache when it changes
+        instance._loaded_username = instance.__dict__.get('username')
+        return instance
+
     def get_full_name(self):
         """Return the first_name plus the last_name, with a space in between."""
         return f'{self.first_name} {self.last_name}'.strip()
@@ -205,3 +214,92 @@ class User(AbstractBaseUser, PermissionsMixin):
 def create_user_permissions(sender, instance, created, **kwargs):
     if created:
         create_permissions(sender, instance)
+
+
+class UserSession(AbstractBaseSession):
+    """
+    Session of the database session engine (apps.accounts.sessions) with the user that logged in, so the sessions of a
+    user are found without decoding the sessions of all the users
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, verbose_name=_('usuario'))
+
+    class Meta(AbstractBaseSession.Meta):
+        db_table = 'user_session'
+
+    @classmethod
+    def get_session_store_class(cls):
+        from apps.accounts.sessions import SessionStore
+        return SessionStore
+
+
+def invalidate_cached_users(usernames):
+    """
+    Change the version of the users in the cache of authenticated users (apps.accounts.tokens). It is changed again
+    when the transaction is committed, in case the old user was cached while the transaction was running.
+    """
+    from apps.accounts.tokens import bump_user_version
+
+    usernames = list(usernames)
+    if usernames:
+        bump_user_version(*usernames)
+        transaction.on_commit(lambda: bump_user_version(*usernames))
+
+
+def invalidate_group_permissions():
+    """Change the version of the compiled group permissions, now and when the transaction is committed"""
+    bump_group_permissions_version()
+    transaction.on_commit(bump_group_permissions_version)
+
+
+def get_group_usernames(groups):
+    return User.objects.filter(groups__in=groups).values_list('username', flat=True).distinct()
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    invalidate_cached_users([instance.username, getattr(instance, '_loaded_username', None)])
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def invalidate_cached_user_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    """The groups or the permissions of a user changed"""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if not reverse:
+        invalidate_cached_users([instance.username])
+    elif pk_set is not None:
+        invalidate_cached_users(User.objects.filter(pk__in=pk_set).values_list('username', flat=True))
+    else:
+        invalidate_cached_users(instance.user_set.values_list('username', flat=True))
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_cached_group_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    """The permissions of a group changed"""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    invalidate_group_permissions()
+    if not reverse:
+        invalidate_cached_users(get_group_usernames([instance]))
+    else:
+        groups = instance.group_set.all() if pk_set is None else pk_set
+        invalidate_cached_users(get_group_usernames(groups))
+
+
+@receiver(pre_delete, sender=Group)
+def invalidate_cached_group_users(sender, instance, **kwargs):
+    invalidate_group_permissions()
+    invalidate_cached_users(get_group_usernames([instance]))
+
+
+@receiver(pre_delete, sender=Permission)
+def invalidate_cached_permission_users(sender, instance, **kwargs):
+    invalidate_group_permissions()
+    invalidate_cached_users(
+        User.objects.filter(Q(user_permissions=instance) | Q(groups__permissions=instance)).
+        values_list('username', flat=True).distinct()
+    )
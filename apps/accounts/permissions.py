@@ -1,11 +1,20 @@
 """Groups and user permissions"""
 
+import threading
+import uuid
+
 from django.contrib.auth.models import Group, Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 
 from apps.appointments.models import Appointment
 from apps.chats.models import Room, Message
 
+USERS_GROUP = 'Users'
+DOCTORS_GROUP = 'Doctors'
+
+GROUP_PERMISSIONS_VERSION_KEY = 'accounts:group_permissions_version'
+
 
 def get_content_type(model):
     """Get model content type"""
@@ -20,8 +29,8 @@ def create_permissions(user_class, user):
     :return: None
     """
     # Get or create groups
-    user_group, created_ug = Group.objects.get_or_create(name='Users')
-    doctor_group, created_dg = Group.objects.get_or_create(name='Doctors')
+    user_group, created_ug = Group.objects.get_or_create(name=USERS_GROUP)
+    doctor_group, created_dg = Group.objects.get_or_create(name=DOCTORS_GROUP)
 
     if user.role == user_class.Type.ADMIN and created_dg and created_ug:
         # Get permissions
@@ -45,3 +54,69 @@ def create_permissions(user_class, user):
         doctor_group.user_set.add(user)
     else:
         user_group.user_set.add(user)
+
+
+class GroupPermissionsCache:
+    """
+    Permissions of each group (role) compiled into immutable sets of 'app_label.codename', kept per process. The sets
+    are compiled again when the version of the group permissions in the Django cache changes
+    (bump_group_permissions_version).
+    """
+
+    def __init__(self):
+        self.version = None
+        self.permissions = {}
+        self.lock = threading.Lock()
+
+    def get(self, group_ids):
+        """
+        Get the permissions of the groups
+        :param group_ids: Group ids
+        :return: frozenset of permission names
+        """
+        version = get_group_permissions_version()
+        with self.lock:
+            if version != self.version:
+                self.permissions = compile_group_permissions()
+                self.version = version
+            permissions = self.permissions
+
+        if len(group_ids) == 1:
+            return permissions.get(group_ids[0], frozenset())
+        return frozenset().union(*(permissions.get(group_id, frozenset()) for group_id in group_ids))
+
+    def clear(self):
+        with self.lock:
+            self.version = None
+            self.permissions = {}
+
+
+def compile_group_permissions():
+    """
+    Get the permissions of all the groups in a single query
+    :return: Dict of group id to frozenset of permission names
+    """
+    permissions = {}
+    rows = Group.permissions.through.objects.values_list(
+        'group_id', 'permission__content_type__app_label', 'permission__codename'
+    )
+    for group_id, app_label, codename in rows:
+        permissions.setdefault(group_id, set()).add(f'{app_label}.{codename}')
+    return {group_id: frozenset(names) for group_id, names in permissions.items()}
+
+
+def get_group_permissions_version():
+    """Get the version of the group permissions. A new version is created if there is none."""
+    version = cache.get(GROUP_PERMISSIONS_VERSION_KEY)
+    if version is None:
+        cache.add(GROUP_PERMISSIONS_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(GROUP_PERMISSIONS_VERSION_KEY)
+    return version
+
+
+def bump_group_permissions_version():
+    """Change the version of the group permissions, so all the processes compile them again"""
+    cache.set(GROUP_PERMISSIONS_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+group_permissions_cache = GroupPermissionsCache()
@@ -0,0 +1,26 @@
+"""
+Database session engine that saves the user of each session (UserSession), so the sessions of a user are deleted with
+an indexed query.
+"""
+
+from django.contrib.auth import SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+
+from apps.accounts.models import User, UserSession
+
+
+class SessionStore(DBStore):
+
+    @classmethod
+    def get_model_class(cls):
+        return UserSession
+
+    def create_model_instance(self, data):
+        """Set the user of the session from the id saved by django.contrib.auth.login"""
+        obj = super().create_model_instance(data)
+        try:
+            user_id = User._meta.pk.to_python(data.get(SESSION_KEY))
+        except Exception:
+            user_id = None
+        obj.user_id = user_id
+        return obj
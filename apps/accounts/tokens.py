@@ -0,0 +1,228 @@
+"""
+Cached verification of the JWT tokens and cached lookup of their users.
+
+The claims of the verified tokens are kept in an in-process cache keyed by the SHA-256 hash of the token for
+settings.JWT_CLAIMS_CACHE_TTL seconds (never after the token expires), so a client reconnecting with the same token is
+not verified again.
+
+The users are loaded with their permissions and kept in two caches: an in-process cache and the Django cache (Redis in
+production), for settings.AUTH_USER_CACHE_TTL seconds. Each user has a version in the Django cache that is changed when
+the user, its groups or its permissions are saved (apps.accounts.models), and the cached users are only used with the
+current version, so a deactivated user cannot authenticate with the cached user. The password hash of the users is
+not cached.
+"""
+
+import copy
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.core.cache import cache
+from django.db.models import Q, Value
+from django.db.models.functions import Concat
+from rest_framework_simplejwt.tokens import UntypedToken
+
+from apps.accounts.models import User
+from apps.accounts.permissions import group_permissions_cache
+
+
+class TokenClaimsCache:
+    """
+    LRU cache of the claims of verified tokens keyed by the hash of the token. Each entry expires after
+    settings.JWT_CLAIMS_CACHE_TTL seconds or when the token expires. At most settings.JWT_CLAIMS_CACHE_SIZE tokens are
+    kept. The cache is disabled if any of the settings is 0.
+    """
+
+    def __init__(self):
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return settings.JWT_CLAIMS_CACHE_TTL > 0 and settings.JWT_CLAIMS_CACHE_SIZE > 0
+
+    def get(self, key):
+        """Get the claims of the token or None if they are not in the cache or expired"""
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires_at, claims = item
+            if expires_at <= time.time():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return claims
+
+    def set(self, key, claims):
+        """Add the claims of a verified token, removing the least recently used tokens if the cache is full"""
+        if not self.enabled:
+            return
+
+        expires_at = time.time() + settings.JWT_CLAIMS_CACHE_TTL
+        if 'exp' in claims:
+            expires_at = min(expires_at, claims['exp'])
+        with self.lock:
+            self.items[key] = (expires_at, claims)
+            self.items.move_to_end(key)
+            while len(self.items) > settings.JWT_CLAIMS_CACHE_SIZE:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+token_claims_cache = TokenClaimsCache()
+
+
+def get_token_key(token):
+    """Get the key of the token in the cache. The token itself is not kept."""
+    if isinstance(token, str):
+        token = token.encode()
+    return hashlib.sha256(token).hexdigest()
+
+
+def verify_token(token):
+    """
+    Verify the signature and the expiration of the token and decode it in a single pass
+    :param token: Encoded JWT token
+    :raises TokenError: If the token is invalid or expired
+    :return: Claims of the token
+    """
+    key = get_token_key(token)
+    claims = token_claims_cache.get(key)
+    if claims is None:
+        claims = UntypedToken(token).payload
+        token_claims_cache.set(key, claims)
+    return claims
+
+
+class LocalUserCache:
+    """
+    In-process LRU cache of the users and their permissions, keyed by username. Each user is saved with the version of
+    the user when it was loaded, and it is only used while the version is the same. At most
+    settings.AUTH_USER_LOCAL_CACHE_SIZE users are kept; 0 disables the cache.
+    """
+
+    def __init__(self):
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, username, version):
+        """Get the user or None if it is not in the cache or its version changed"""
+        if settings.AUTH_USER_LOCAL_CACHE_SIZE <= 0:
+            return None
+
+        with self.lock:
+            item = self.items.get(username)
+            if item is None or item[0] != version:
+                return None
+            self.items.move_to_end(username)
+            return item[1]
+
+    def set(self, username, version, user):
+        """Add the user, removing the least recently used users if the cache is full"""
+        if settings.AUTH_USER_LOCAL_CACHE_SIZE <= 0:
+            return
+
+        with self.lock:
+            self.items[username] = (version, user)
+            self.items.move_to_end(username)
+            while len(self.items) > settings.AUTH_USER_LOCAL_CACHE_SIZE:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+local_user_cache = LocalUserCache()
+
+
+def get_user_version_key(username):
+    return f'accounts:user_version:{username}'
+
+
+def get_user_cache_key(username, version):
+    return f'accounts:user:{username}:{version}'
+
+
+def get_user_version(username):
+    """
+    Get the version of the user. A new version is created if the user has none, for example because it was removed
+    from the cache, so the users loaded with a previous version are not used.
+    """
+    key = get_user_version_key(username)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def bump_user_version(*usernames):
+    """Change the version of the users, so they are loaded again from the database with their permissions"""
+    cache.set_many({get_user_version_key(username): uuid.uuid4().hex for username in usernames if username}, None)
+
+
+def load_user(username):
+    """
+    Get the user from the database with its permissions loaded. The user, its groups and its own permissions are read
+    in a single query, and the permissions of the groups are taken from the compiled permissions of each role
+    (apps.accounts.permissions). The password hash is not loaded, so it is not kept in the caches; it is read from the
+    database when it is used, for example to change the password.
+    :return: User object or None if it does not exist
+    """
+    user = User.objects.filter(username=username).defer('password').annotate(
+        group_ids=ArrayAgg('groups__id', distinct=True, filter=Q(groups__isnull=False)),
+        own_permissions=ArrayAgg(
+            Concat('user_permissions__content_type__app_label', Value('.'), 'user_permissions__codename'),
+            distinct=True,
+            filter=Q(user_permissions__isnull=False),
+        ),
+    ).first()
+    if user is None:
+        return None
+
+    group_ids = user.__dict__.pop('group_ids')
+    own_permissions = frozenset(user.__dict__.pop('own_permissions'))
+    if user.is_superuser:
+        # Fills the permission caches of the user used by has_perm
+        user.get_all_permissions()
+    else:
+        # Permission caches of ModelBackend
+        user._user_perm_cache = own_permissions
+        user._group_perm_cache = group_permissions_cache.get(group_ids) if group_ids else frozenset()
+        user._perm_cache = user._user_perm_cache | user._group_perm_cache
+    return user
+
+
+def get_cached_user(username):
+    """
+    Get the user and its permissions from the in-process cache, the Django cache or the database, in that order. The
+    cached users are only used while the version of the user does not change (bump_user_version), so reading a cached
+    user only needs the version from the Django cache and no database queries.
+    :param username: Username
+    :return: User object or None if it does not exist
+    """
+    version = get_user_version(username)
+    user = local_user_cache.get(username, version)
+    if user is None:
+        key = get_user_cache_key(username, version)
+        user = cache.get(key)
+        if user is None:
+            user = load_user(username)
+            if user is None:
+                return None
+            cache.set(key, user, settings.AUTH_USER_CACHE_TTL)
+        local_user_cache.set(username, version, user)
+    # The views can change the user of the request
+    return copy.copy(user)
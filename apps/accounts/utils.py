@@ -6,7 +6,6 @@ import jwt
 from django.conf import settings
 from django.contrib.auth import password_validation
 from django.contrib.auth.tokens import PasswordResetTokenGenerator
-from django.contrib.sessions.models import Session
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.utils.encoding import force_bytes
@@ -14,19 +13,12 @@ from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from rest_framework import serializers
 from rest_framework.exceptions import AuthenticationFailed, NotFound
 
-from apps.accounts.models import User
+from apps.accounts.models import User, UserSession
 
 
 def delete_user_sessions(user):
-    """Delete the authentication token and user sessions."""
-
-    all_sessions = Session.objects.filter(expire_date__gte=timezone.now())
-    if all_sessions.exists():
-        for session in all_sessions:
-            session_data = session.get_decoded()
-            session_user = session_data.get('_auth_user_id')
-            if session_user and user.id == int(session_user):
-                session.delete()
+    """Delete the user sessions. The sessions are found by the user index of UserSession."""
+    UserSession.objects.filter(user=user).delete()
 
 
 def validate_username(value):
@@ -9,7 +9,7 @@ from rest_framework.response import Response
 from apps.accounts.models import User
 from apps.appointments.models import Appointment
 from apps.accounts.api.permissions import check_permissions
-from apps.accounts.api.views.users import UserModelViewSet
+from apps.accounts.api.resolvers import get_path_user
 from apps.appointments.api.filters.appointments import AppointmentFilter
 from apps.appointments.api.serializers.appointments import (
     AppointmentSerializer, AppointmentUserSerializer, AppointmentListSerializer
@@ -51,13 +51,8 @@ class AppointmentViewSet(
     ordering = ('-created_at',)
 
     def get_user(self, request, username):
-        """Get user from UserModelViewSet class"""
-        user_model_view_set = UserModelViewSet(
-            request=request,
-            format_kwarg=self.format_kwarg,
-            kwargs={'username': username}
-        )
-        return user_model_view_set.get_object()
+        """Get the user of the URL, resolved once per request"""
+        return get_path_user(request, username)
 
     def get_serializer_class(self):
         """Assign serializer based on action."""
@@ -1,7 +1,30 @@
 """Chats admin"""
 
 from django.contrib import admin
+from django.db.models import QuerySet
 
 from .models import Room
+from .purge import purge_room
 
-admin.site.register(Room)
+
+@admin.register(Room)
+class RoomAdmin(admin.ModelAdmin):
+    """The chat rooms are deleted with their messages in batches (apps.chats.purge)"""
+
+    def get_deleted_objects(self, objs, request):
+        """
+        Only the chat rooms are listed in the delete confirmation page. Their messages are not collected because they
+        are deleted in batches after confirming.
+        """
+        if isinstance(objs, QuerySet):
+            objs = objs.select_related('user_owner', 'user_receiver')
+        rooms = [str(room) for room in objs]
+        perms_needed = set() if self.has_delete_permission(request) else {str(Room._meta.verbose_name)}
+        return rooms, {Room._meta.verbose_name_plural: len(rooms)}, perms_needed, []
+
+    def delete_model(self, request, obj):
+        purge_room(obj)
+
+    def delete_queryset(self, request, queryset):
+        for room in queryset:
+            purge_room(room)
@@ -1,10 +1,76 @@
 """Message consumer"""
 
-import json
+import asyncio
+import logging
+import math
+import re
+import uuid
+from datetime import timedelta
 
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.utils import timezone
 
-from apps.chats.utils import create_chat_message, get_messages, message_to_json, messages_to_json
+from apps.chats.utils import (
+    create_chat_message, get_messages, message_to_json, messages_to_json, message_to_cursor, parse_message_cursor,
+    parse_page_size, parse_positive_integer, get_room, get_room_counterpart, is_room_member, encode_frame,
+    encode_binary_frame, encode_broadcast_frame, decode_frame, parse_datetime_value, get_message_cursor,
+    get_message_changes, mark_room_read
+)
+from apps.chats.models import get_user_group_name
+from apps.chats.presence import presence_registry
+from apps.chats.throttling import TokenBucket, consume_all, user_buckets
+from apps.chats.uploads import (
+    UploadOffsetError, claim_upload_chunk, create_upload, create_upload_message, get_upload, parse_checksum,
+    parse_chunk_data, parse_upload_id, parse_upload_offset, release_upload_chunk, store_upload_file, validate_upload,
+    validate_upload_chunk, write_upload_chunk
+)
+from apps.chats.write_behind import write_behind_queue
+
+logger = logging.getLogger(__name__)
+
+
+# WebSocket subprotocols. JSON is used if the client does not request a subprotocol.
+JSON_SUBPROTOCOL = 'chat.json'
+MSGPACK_SUBPROTOCOL = 'chat.msgpack'
+
+ROOM_NAME_RE = re.compile(r'\w+')
+
+PRESENCE_STATUSES = ('online', 'away')
+
+
+def get_room_group_name(room_name):
+    """Get the name of the channel layer group of the consumers subscribed to the chat room"""
+    return f'chat_{room_name}'
+
+
+class ChatRoom:
+    """Chat room to which a consumer is subscribed"""
+
+    def __init__(self, name, user):
+        self.name = name
+        self.group_name = get_room_group_name(name)
+        self.user = user
+
+        # Chat room and user with whom the chat is shared. They are resolved once per subscription.
+        self.room = None
+        self.user_receiver = None
+
+    def pin(self, room):
+        """
+        Keeps the chat room and the user with whom the chat is shared during the subscription
+        :param room: Room object or None to resolve the room again in the next message
+        """
+        self.room = room
+        self.user_receiver = get_room_counterpart(room, self.user) if room is not None else None
+
+    async def get(self):
+        """Get the chat room. It is resolved again if it was invalidated."""
+        if self.room is None:
+            self.pin(await get_room(self.name))
+        return self.room
 
 
 class MessageConsumer(AsyncWebsocketConsumer):
@@ -14,86 +80,724 @@ class MessageConsumer(AsyncWebsocketConsumer):
         Constructs all the necessary attributes for the chat room
         """
         super().__init__(*args, **kwargs)
-        self.room_id = None
-        self.room_name = None
         self.user = None
 
+        # Chat rooms to which the connection is subscribed, by room name
+        self.rooms = {}
+
+        # The client can use the binary protocol (MessagePack) with the `chat.msgpack` subprotocol
+        self.binary = False
+
+        # Rate limits and queue of the commands waiting to be run
+        self.connection_bucket = None
+        self.user_bucket = None
+        self.command_queue = None
+        self.command_task = None
+
+        # The connection is registered in the presence registry. The client joins with the `presence` command.
+        self.online = False
+
+        # File uploads of the connection, by upload id
+        self.uploads = {}
+
         self.commands = {
             'fetch_messages': self.fetch_messages,
             'create_message': self.create_message,
+            'sync': self.sync,
+            'mark_read': self.mark_read,
+            'typing': self.typing,
+            'presence': self.presence,
+            'upload_start': self.upload_start,
+            'upload_chunk': self.upload_chunk,
+            'upload_commit': self.upload_commit,
         }
 
     async def connect(self):
         """Connect the chat"""
         self.user = self.scope["user"]
-        if self.user.is_anonymous:
+        if self.user.is_anonymous or not self.user.is_active:
             await self.close()
         else:
-            self.room_name = self.scope['url_route']['kwargs']['room_name']
-            self.room_id = f'chat_{self.room_name}'
-            await self.channel_layer.group_add(self.room_id, self.channel_name)
-            await self.accept()
+            await self.join_user_group()
+            if await self.subscribe_room(self.scope['url_route']['kwargs']['room_name']) is None:
+                await self.close()
+                return
+            self.start_commands()
+            await self.accept_subprotocol()
+
+    async def join_user_group(self):
+        """Join the group of the connections of the user, used to close them when the user is deactivated"""
+        await self.channel_layer.group_add(get_user_group_name(self.user.id), self.channel_name)
+
+    def start_commands(self):
+        """Create the rate limits of the connection and of the user and start running the commands of the queue"""
+        self.connection_bucket = TokenBucket(*settings.CHAT_CONNECTION_RATE_LIMIT)
+        self.user_bucket = user_buckets.acquire(self.user.id, *settings.CHAT_USER_RATE_LIMIT)
+        self.command_queue = asyncio.Queue(maxsize=settings.CHAT_COMMAND_QUEUE_SIZE)
+        self.command_task = asyncio.ensure_future(self.process_commands())
+
+    async def stop_commands(self):
+        """Stop running commands and release the rate limit of the user"""
+        if self.command_task is not None:
+            self.command_task.cancel()
+            await asyncio.gather(self.command_task, return_exceptions=True)
+            self.command_task = None
+        if self.user_bucket is not None:
+            user_buckets.release(self.user.id)
+            self.user_bucket = None
+
+    async def accept_subprotocol(self):
+        """Accept the connection with the subprotocol requested by the client"""
+        subprotocols = self.scope.get('subprotocols', [])
+        self.binary = MSGPACK_SUBPROTOCOL in subprotocols
+        if self.binary:
+            await self.accept(MSGPACK_SUBPROTOCOL)
+        else:
+            await self.accept(JSON_SUBPROTOCOL if JSON_SUBPROTOCOL in subprotocols else None)
+
+    async def leave_presence(self):
+        """Remove the connection from the presence registry. If it was the last one, the user is offline."""
+        if not self.online:
+            return
+
+        self.online = False
+        connected = await sync_to_async(presence_registry.disconnect, thread_sensitive=False)(
+            self.user.id, self.channel_name
+        )
+        if not connected:
+            should_broadcast = sync_to_async(presence_registry.should_broadcast, thread_sensitive=False)
+            for room in list(self.rooms.values()):
+                if await should_broadcast('presence', room.name, self.user.id, 'offline'):
+                    await self.broadcast(room.name, self.get_presence_frame(room, 'offline'))
+
+    async def announce_presence(self, room, status='online'):
+        """
+        Broadcast the presence of the user to the chat room (coalesced if the status did not change) and send the
+        presence of the other user of the room to the connection
+        :param room: ChatRoom object
+        :param status: User status
+        """
+        should_broadcast = sync_to_async(presence_registry.should_broadcast, thread_sensitive=False)
+        if await should_broadcast('presence', room.name, self.user.id, status):
+            await self.broadcast(room.name, self.get_presence_frame(room, status))
+
+        if room.user_receiver is not None:
+            online = await sync_to_async(presence_registry.is_online, thread_sensitive=False)(room.user_receiver.id)
+            await self.send_frame({
+                'command': 'presence',
+                'room_name': room.name,
+                'user': room.user_receiver.username,
+                'status': 'online' if online else 'offline',
+            })
+
+    def get_presence_frame(self, room, status):
+        return {
+            'command': 'presence',
+            'room_name': room.name,
+            'user': self.user.username,
+            'status': status,
+            'expires_in': settings.CHAT_PRESENCE_TTL if status != 'offline' else None,
+        }
+
+    async def subscribe_room(self, room_name):
+        """
+        Subscribe the connection to the chat room. The user can subscribe to the rooms in which they participate and to
+        the rooms that do not exist yet, which are checked again when they are created (check_room_access).
+        :param room_name: Room name
+        :return: ChatRoom object or None if the user does not participate in the room
+        """
+        room = self.rooms.get(room_name)
+        if room is None:
+            room = ChatRoom(room_name, self.user)
+            room.pin(await get_room(room_name))
+            if room.room is not None and not is_room_member(room.room, self.user):
+                return None
+            await self.channel_layer.group_add(room.group_name, self.channel_name)
+            self.rooms[room_name] = room
+        return room
+
+    async def check_room_access(self, room):
+        """
+        Verify that the user participates in the chat room. The rooms that did not exist when the connection subscribed
+        to them are resolved again. If the user does not participate in the room, the connection is unsubscribed.
+        :param room: ChatRoom object
+        :return: True if the user can access the room
+        """
+        if room.room is not None:
+            return True
+
+        chat_room = await room.get()
+        if chat_room is None or is_room_member(chat_room, self.user):
+            return True
+        await self.unsubscribe_room(room.name)
+        await self.send_error('subscribe', 'No tiene acceso al chat.', code='forbidden', room_name=room.name)
+        return False
+
+    async def unsubscribe_room(self, room_name):
+        """
+        Unsubscribe the connection from the chat room
+        :param room_name: Room name
+        """
+        room = self.rooms.pop(room_name, None)
+        if room is not None:
+            await self.channel_layer.group_discard(room.group_name, self.channel_name)
 
     async def disconnect(self, close_code):
         """
         Disconnect chat
         :param close_code: Chat to disconnect
         """
-        await self.channel_layer.group_discard(self.room_id, self.channel_name)
+        await self.stop_commands()
+        await self.leave_presence()
+        for room_name in list(self.rooms):
+            await self.unsubscribe_room(room_name)
+        if self.user is not None and not self.user.is_anonymous:
+            await self.channel_layer.group_discard(get_user_group_name(self.user.id), self.channel_name)
+
+    def get_command_room(self, data):
+        """
+        Get the chat room of the command
+        :param data: Client JSON object
+        :return: ChatRoom object. The connection is subscribed to a single room.
+        """
+        return next(iter(self.rooms.values()), None)
 
     async def receive(self, text_data=None, bytes_data=None):
         """
-        Receive message from WebSocket
+        Receive message from WebSocket. The command is queued to be run after the previous commands of the connection.
+        The frames that are not an object with a `command` are rejected, as are the commands if the connection or the
+        user exceeded their rate limit or the queue is full.
         :param text_data: Data from WebSocket
-        :param bytes_data: Bytes data
+        :param bytes_data: Bytes data. MessagePack frame if the binary protocol is used
         :return: Command or function to be executed
         """
-        data = json.loads(text_data)
-        if data['command'] in self.commands:
-            method = getattr(self, data['command'])
-            await method(data)
+        try:
+            data = decode_frame(text_data, bytes_data, self.binary)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or not isinstance(data.get('command'), str):
+            command = data.get('command') if isinstance(data, dict) else None
+            await self.send_error(command, 'La trama es inválida.', code='invalid_frame')
+            return
+
+        command = data['command']
+        buckets = (self.connection_bucket, self.user_bucket)
+        if not consume_all(buckets):
+            # The retry is not possible (None) if a bucket is not refilled
+            retry_after = max(bucket.retry_after() for bucket in buckets)
+            await self.send_error(
+                command, 'Ha superado el límite de solicitudes.', code='rate_limited',
+                retry_after=round(retry_after, 3) if math.isfinite(retry_after) else None
+            )
+            return
+
+        try:
+            self.command_queue.put_nowait(data)
+        except asyncio.QueueFull:
+            await self.send_error(command, 'El servidor está ocupado, intente de nuevo.', code='overloaded')
+
+    async def process_commands(self):
+        """Run the queued commands one at a time. If a command fails, the connection is closed."""
+        while True:
+            data = await self.command_queue.get()
+            try:
+                await self.run_command(data)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Chat command %s failed.', data.get('command'))
+                await self.close(code=1011)
+                return
+
+    async def run_command(self, data):
+        """
+        Execute the command of the chat room sent by the client
+        :param data: Client JSON object
+        """
+        command = data.get('command')
+        room = self.get_command_room(data)
+        if command not in self.commands:
+            await self.send_error(command, 'Acción no permitida.', room_name=data.get('room_name'))
+        elif room is None:
+            await self.send_error(command, 'No está suscrito al chat.', room_name=data.get('room_name'))
+        elif isinstance(room, ChatRoom) and not await self.check_room_access(room):
+            return
         else:
-            content = {
-                'command': data['command'],
-                'messages': "Acción no permitida."
-            }
-            await self.send(text_data=json.dumps(content))
+            await self.commands[command](data, room)
 
-    async def create_message(self, data):
+    async def create_message(self, data, room):
         """
-        Create a new message in the database
+        Create a new message in the database. In write-behind mode the message is broadcast before being saved.
         :param data: Client JSON object to create message
+        :param room: ChatRoom object
         :return: New user message
         """
-        message = await create_chat_message(data['data'], self.user)
+        # The pinned room is only used for messages sent to the chat room of the command
+        pinned_room = room.room if data['data'].get('room_name') == room.name else None
+        try:
+            if settings.CHAT_WRITE_BEHIND:
+                message = await write_behind_queue.create_message(data['data'], self.user, pinned_room)
+            else:
+                message = await create_chat_message(data['data'], self.user, pinned_room)
+        except PermissionDenied:
+            await self.send_error(
+                'create_message', 'No tiene acceso al chat.', code='forbidden', room_name=data['data'].get('room_name')
+            )
+            return
+        except ValueError as e:
+            await self.send_error('create_message', str(e), room_name=data['data'].get('room_name'))
+            return
+
+        if pinned_room is None and message.room.name == room.name:
+            room.pin(message.room)
+
         content = {
             'command': 'create_message',
+            'room_name': message.room.name,
             'message': message_to_json(message)
         }
 
-        # Send chat message
+        await self.broadcast(message.room.name, content)
+
+    async def fetch_messages(self, data, room):
+        """
+        Get chat room messages.
+
+        The history is sent in frames of `page_size` messages. Each frame contains the cursor of its last message and
+        indicates if there are more messages. The client can send the `after` and `before` cursors
+        ({"id": 1, "created_at": "..."}) to get only the messages sent after or before a message. If only the `before`
+        cursor is sent, the frames go from the newest to the oldest messages. The `limit` parameter is the maximum
+        number of messages to send.
+
+        :param data: Client JSON object
+        :param room: ChatRoom object
+        :return: Messages in JSON format
+        """
+        try:
+            after = parse_message_cursor(data.get('after'))
+            before = parse_message_cursor(data.get('before'))
+            page_size = parse_page_size(data.get('page_size'))
+            limit = data.get('limit')
+            if limit is not None:
+                limit = parse_positive_integer(limit, 'El límite es inválido.')
+        except ValueError as e:
+            await self.send_error('fetch_messages', str(e), room_name=room.name)
+            return
+
+        await self.send_messages('fetch_messages', room, page_size, after=after, before=before, limit=limit)
+
+    async def sync(self, data, room):
+        """
+        Synchronize the chat room after reconnecting.
+
+        The client sends the id of the last message it has (`last_message_id`) and the `watermark` received in the
+        previous synchronization. The messages sent after the last message are sent in frames like `fetch_messages`.
+        The first frame also contains the messages updated (`updated`) and the ids of the messages deleted (`deleted`)
+        since the watermark, and the new `watermark`. If there are too many changes, or the watermark is older than
+        settings.CHAT_SYNC_WINDOW days, `resync` is true and the client must get the history again.
+
+        :param data: Client JSON object
+        :param room: ChatRoom object
+        :return: Messages in JSON format
+        """
+        watermark = timezone.now()
+        try:
+            message_id = parse_positive_integer(data.get('last_message_id'), 'El id del último mensaje es inválido.')
+            since = parse_datetime_value(data.get('watermark')) if data.get('watermark') is not None else None
+            page_size = parse_page_size(data.get('page_size'))
+        except ValueError as e:
+            await self.send_error('sync', str(e), room_name=room.name)
+            return
+
+        room_obj = await room.get()
+        cursor = await get_message_cursor(room_obj, message_id) if room_obj is not None else None
+        if cursor is None and room_obj is not None and settings.CHAT_WRITE_BEHIND:
+            # The last message of the client can be queued by the write-behind persistence and not saved yet
+            message = await write_behind_queue.get_pending_message(message_id)
+            if message is not None and message.room_id == room_obj.id:
+                cursor = (message.created_at, message.id)
+        if cursor is None:
+            await self.send_error('sync', 'Mensaje no encontrado.', room_name=room.name, resync=True)
+            return
+
+        changes = {'updated': [], 'deleted': [], 'resync': False, 'watermark': watermark.isoformat()}
+        if since is not None and since < watermark - timedelta(days=settings.CHAT_SYNC_WINDOW):
+            # The deleted messages older than the synchronization window are not kept
+            changes['resync'] = True
+        elif since is not None:
+            max_size = settings.CHAT_MESSAGES_MAX_PAGE_SIZE
+            updated, deleted = await get_message_changes(room_obj, cursor, since, max_size)
+            changes['updated'] = messages_to_json(updated[:max_size])
+            changes['deleted'] = deleted[:max_size]
+            changes['resync'] = max(len(updated), len(deleted)) > max_size
+
+        await self.send_messages('sync', room, page_size, after=cursor, first_frame=changes)
+
+    async def mark_read(self, data, room):
+        """
+        Mark the messages of the chat room as read. The client can send the id of the last message read
+        (`message_id`), otherwise all the messages are marked as read.
+        :param data: Client JSON object
+        :param room: ChatRoom object
+        :return: Read state of the chat room
+        """
+        message_id = data.get('message_id')
+        try:
+            if message_id is not None:
+                message_id = parse_positive_integer(message_id, 'El id del mensaje es inválido.')
+        except ValueError as e:
+            await self.send_error('mark_read', str(e), room_name=room.name)
+            return
+
+        room_obj = await room.get()
+        state = await mark_room_read(room_obj, self.user, message_id) if room_obj is not None else None
+        if state is None:
+            await self.send_error('mark_read', 'Mensaje no encontrado.', room_name=room.name)
+            return
+
+        await self.send_frame({
+            'command': 'mark_read',
+            'room_name': room.name,
+            'last_read_message_id': state.last_read_message_id,
+            'unread_count': state.unread_count,
+        })
+
+    async def typing(self, data, room):
+        """
+        The user is typing (`typing` true, by default) or stopped typing in the chat room. A repeated `typing` true is
+        broadcast to the room at most once per interval, and stopping typing is always broadcast; the clients hide the
+        indicator after `expires_in` seconds.
+        :param data: Client JSON object
+        :param room: ChatRoom object
+        """
+        typing = bool(data.get('typing', True))
+        await sync_to_async(presence_registry.set_typing, thread_sensitive=False)(room.name, self.user.id, typing)
+        if await sync_to_async(presence_registry.should_broadcast, thread_sensitive=False)(
+            'typing', room.name, self.user.id, int(typing)
+        ):
+            await self.broadcast(room.name, {
+                'command': 'typing',
+                'room_name': room.name,
+                'user': self.user.username,
+                'typing': typing,
+                'expires_in': settings.CHAT_TYPING_TTL,
+            })
+
+    async def presence(self, data, room):
+        """
+        Register or refresh the presence of the connection. The client must send it before `expires_in` seconds to
+        stay online. The status (`online` or `away`) is broadcast to the subscribed chat rooms when it changes, and at
+        most once per interval otherwise, and the presence of the other users of the rooms is sent to the connection.
+        :param data: Client JSON object
+        :param room: Not used. The presence is of the user, not of a chat room.
+        """
+        status = data.get('status', 'online')
+        if status not in PRESENCE_STATUSES:
+            await self.send_error('presence', 'El estado es inválido.')
+            return
+
+        await sync_to_async(presence_registry.connect, thread_sensitive=False)(self.user.id, self.channel_name)
+        self.online = True
+        for chat_room in list(self.rooms.values()):
+            await self.announce_presence(chat_room, status)
+
+    async def upload_start(self, data, room):
+        """
+        Start a chunked upload of the file of a message (apps.chats.uploads) or resume it.
+
+        To start an upload the client sends the `type` of the message (AD, FL, IMG or VD) and the `name`, `size` and
+        SHA-256 `checksum` of the file. To resume an upload the client sends its `upload_id`. The response contains the
+        `upload_id`, the `offset` from which the chunks must be sent and the maximum `chunk_size`.
+
+        :param data: Client JSON object
+        :param room: ChatRoom object
+        """
+        room_obj = await room.get()
+        try:
+            if room_obj is None:
+                raise ValueError('El chat no existe.')
+            if data.get('upload_id') is not None:
+                upload = await self.get_upload(parse_upload_id(data['upload_id']), room_obj, refresh=True)
+            else:
+                upload = await create_upload(room_obj, self.user, validate_upload(data))
+                self.uploads[upload.id] = upload
+        except ValueError as e:
+            await self.send_error('upload_start', str(e), room_name=room.name)
+            return
+
+        await self.send_frame({
+            'command': 'upload_start',
+            'room_name': room.name,
+            'upload_id': str(upload.id),
+            'offset': upload.offset,
+            'chunk_size': settings.CHAT_UPLOAD_CHUNK_SIZE,
+        })
+
+    async def upload_chunk(self, data, room):
+        """
+        Write a chunk of the file of an upload. The client sends the `upload_id`, the `offset` of the chunk in the file,
+        the chunk (`data`, in base64 with JSON) and its SHA-256 `checksum`. The response contains the new `offset`. If
+        the offset of the chunk is not the offset of the upload, the error contains the `offset` from which the client
+        must resume.
+        :param data: Client JSON object
+        :param room: ChatRoom object
+        """
+        upload_id = data.get('upload_id')
+        room_obj = await room.get()
+        try:
+            if room_obj is None:
+                raise ValueError('El chat no existe.')
+            offset = parse_upload_offset(data.get('offset'))
+            chunk = parse_chunk_data(data.get('data'))
+            checksum = parse_checksum(data.get('checksum'))
+            upload = await self.get_upload(parse_upload_id(upload_id), room_obj)
+            validate_upload_chunk(upload, offset, chunk, checksum)
+            if not await claim_upload_chunk(upload, len(chunk)):
+                # Another connection claimed a chunk at the same offset
+                upload = await self.get_upload(upload.id, room_obj, refresh=True)
+                raise UploadOffsetError(upload.offset)
+            try:
+                await sync_to_async(write_upload_chunk, thread_sensitive=False)(upload, offset, chunk)
+            except Exception:
+                await release_upload_chunk(upload, offset, len(chunk))
+                raise
+        except UploadOffsetError as e:
+            await self.send_error('upload_chunk', str(e), room_name=room.name, upload_id=upload_id, offset=e.offset)
+            return
+        except ValueError as e:
+            await self.send_error('upload_chunk', str(e), room_name=room.name, upload_id=upload_id)
+            return
+
+        await self.send_frame({
+            'command': 'upload_chunk',
+            'room_name': room.name,
+            'upload_id': str(upload.id),
+            'offset': upload.offset,
+        })
+
+    async def upload_commit(self, data, room):
+        """
+        Create the message of an upload whose file was completely received. The checksum of the file is verified and
+        the message is broadcast to the chat room like the `create_message` command.
+        :param data: Client JSON object with the `upload_id`
+        :param room: ChatRoom object
+        """
+        upload_id = data.get('upload_id')
+        room_obj = await room.get()
+        try:
+            if room_obj is None:
+                raise ValueError('El chat no existe.')
+            upload = await self.get_upload(parse_upload_id(upload_id), room_obj, refresh=True)
+            file_name = await sync_to_async(store_upload_file, thread_sensitive=False)(upload)
+            message = await create_upload_message(upload, room_obj, self.user, file_name)
+            self.uploads.pop(upload.id, None)
+            if message is None:
+                raise ValueError('La carga no existe.')
+        except ValueError as e:
+            await self.send_error('upload_commit', str(e), room_name=room.name, upload_id=upload_id)
+            return
+
+        await self.broadcast(room.name, {
+            'command': 'create_message',
+            'room_name': room.name,
+            'upload_id': str(upload.id),
+            'message': message_to_json(message),
+        })
+
+    async def get_upload(self, upload_id, room, refresh=False):
+        """
+        Get an upload of the user in the chat room. The uploads are kept by the connection so the chunks do not
+        query them.
+        :param upload_id: Upload UUID
+        :param room: Room object
+        :param refresh: Get the upload from the database
+        :raises ValueError: If the upload does not exist
+        :return: MessageUpload object
+        """
+        upload = self.uploads.get(upload_id)
+        if upload is None or refresh or upload.room_id != room.id:
+            upload = await get_upload(upload_id, room, self.user)
+            if upload is None:
+                self.uploads.pop(upload_id, None)
+                raise ValueError('La carga no existe.')
+            self.uploads[upload_id] = upload
+        return upload
+
+    async def send_messages(self, command, room, page_size, after=None, before=None, limit=None, first_frame=None):
+        """
+        Send the chat room messages in frames of `page_size` messages
+        :param command: Command of the frames
+        :param room: ChatRoom object
+        :param page_size: Number of messages per frame
+        :param after: Cursor (created_at, id). Only messages sent after the cursor are sent
+        :param before: Cursor (created_at, id). Only messages sent before the cursor are sent
+        :param limit: Maximum number of messages to send
+        :param first_frame: Additional content of the first frame
+        """
+        backwards = before is not None and after is None
+        has_more = True
+        while has_more:
+            size = page_size if limit is None else min(page_size, limit)
+            messages = await get_messages(room.name, size + 1, after=after, before=before)
+            has_more = len(messages) > size
+            messages = messages[:size]
+            cursor = message_to_cursor(messages[-1]) if messages else None
+
+            if limit is not None:
+                limit -= len(messages)
+                has_more = has_more and limit > 0
+
+            if backwards:
+                before = (messages[-1].created_at, messages[-1].id) if messages else before
+                messages.reverse()
+            else:
+                after = (messages[-1].created_at, messages[-1].id) if messages else after
+
+            content = {
+                'command': command,
+                'room_name': room.name,
+                'messages': messages_to_json(messages),
+                'cursor': cursor,
+                'has_more': has_more,
+            }
+            if first_frame is not None:
+                content.update(first_frame)
+                first_frame = None
+            await self.send_frame(content)
+
+    async def user_deactivate(self, event):
+        """The user was deactivated or deleted. The connection is closed."""
+        await self.close()
+
+    async def room_invalidate(self, event):
+        """The chat room or its users changed. The room is resolved again when the next message is created."""
+        room = self.rooms.get(event['room_name'])
+        if room is not None:
+            room.pin(None)
+
+    async def chat_message(self, event):
+        """Send a frame of the room group to the WebSocket, encoded with the protocol of the connection"""
+        room = self.rooms.get(event['room_name'])
+        if room is None or not await self.check_room_access(room):
+            return
+
+        data = encode_broadcast_frame(event['frame_id'], event['content'], self.binary)
+        if self.binary:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    async def broadcast(self, room_name, content):
+        """
+        Send a frame to all the consumers of a chat room. The content is sent once through the channel layer and each
+        process encodes it once per protocol used by its consumers (encode_broadcast_frame).
+        :param room_name: Name of the chat room
+        :param content: Frame content
+        """
         await self.channel_layer.group_send(
-            self.room_id,
+            get_room_group_name(room_name),
             {
                 'type': 'chat_message',
-                'message': content,
+                'room_name': room_name,
+                'frame_id': uuid.uuid4().hex,
+                'content': content,
             }
         )
 
-    async def fetch_messages(self, data):
+    async def send_error(self, command, message, **kwargs):
+        """
+        Send an error frame to the WebSocket
+        :param command: Command that caused the error
+        :param message: Error message
+        :param kwargs: Additional content of the frame
+        """
+        await self.send_frame({'command': command, 'messages': message, **kwargs})
+
+    async def send_frame(self, content):
+        """
+        Send a frame to the WebSocket encoded with the protocol of the connection
+        :param content: Frame content
         """
-        Get chat room messages
+        if self.binary:
+            await self.send(bytes_data=encode_binary_frame(content))
+        else:
+            await self.send(text_data=encode_frame(content))
+
+
+class RoomsConsumer(MessageConsumer):
+    """
+    User consumer subscribed to many chat rooms over a single connection.
+
+    The client subscribes and unsubscribes with the `subscribe` and `unsubscribe` commands and sends the `room_name`
+    of the chat room in the commands of the rooms. All the frames of a room contain its `room_name`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands.update({
+            'subscribe': self.subscribe,
+            'unsubscribe': self.unsubscribe,
+        })
+
+    async def connect(self):
+        """Connect the user without subscribing to any chat room"""
+        self.user = self.scope["user"]
+        if self.user.is_anonymous or not self.user.is_active:
+            await self.close()
+        else:
+            await self.join_user_group()
+            self.start_commands()
+            await self.accept_subprotocol()
+
+    def get_command_room(self, data):
+        """
+        Get the chat room of the command
+        :param data: Client JSON object with the `room_name` field
+        :return: ChatRoom object or None if the connection is not subscribed to the room. The room name for the
+            `subscribe`, `unsubscribe` and `presence` commands.
+        """
+        room_name = data.get('room_name')
+        if not isinstance(room_name, str):
+            room_name = None
+        if data.get('command') in ('subscribe', 'unsubscribe', 'presence'):
+            return room_name or ''
+        return self.rooms.get(room_name)
+
+    @staticmethod
+    def is_valid_room_name(room_name):
+        return isinstance(room_name, str) and ROOM_NAME_RE.fullmatch(room_name) is not None
+
+    async def subscribe(self, data, room_name):
+        """
+        Subscribe the connection to a chat room
         :param data: Client JSON object
-        :return: All messages in JSON format
+        :param room_name: Room name
         """
-        messages = await get_messages(self.room_name)
-        content = {
-            'command': 'fetch_messages',
-            'messages': messages_to_json(messages)
-        }
-        await self.send(text_data=json.dumps(content))
+        if not self.is_valid_room_name(room_name):
+            await self.send_error('subscribe', 'El nombre del chat es inválido.', room_name=room_name)
+            return
+        if room_name not in self.rooms and len(self.rooms) >= settings.CHAT_MAX_ROOMS_PER_CONNECTION:
+            await self.send_error('subscribe', 'Ha superado el número máximo de chats.', room_name=room_name)
+            return
 
-    async def chat_message(self, event):
-        """Receive message from room group and send message to WebSocket"""
-        message = event['message']
-        await self.send(text_data=json.dumps(message))
+        room = await self.subscribe_room(room_name)
+        if room is None:
+            await self.send_error('subscribe', 'No tiene acceso al chat.', code='forbidden', room_name=room_name)
+            return
+        await self.send_frame({'command': 'subscribe', 'room_name': room_name})
+        if self.online:
+            await self.announce_presence(room)
+
+    async def unsubscribe(self, data, room_name):
+        """
+        Unsubscribe the connection from a chat room
+        :param data: Client JSON object
+        :param room_name: Room name
+        """
+        await self.unsubscribe_room(room_name)
+        await self.send_frame({'command': 'unsubscribe', 'room_name': room_name})
+
+    async def create_message(self, data, room):
+        """The message is created in the chat room of the command"""
+        data['data']['room_name'] = room.name
+        await super().create_message(data, room)
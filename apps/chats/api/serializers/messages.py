@@ -4,21 +4,53 @@ from rest_framework import serializers
 
 from apps.chats.models import Message
 from apps.accounts.api.serializers.users import UserListingField
+from apps.chats.utils import get_message_file_url
 
 
 class MessageListSerializer(serializers.ModelSerializer):
     """Message list serializer"""
 
     user = UserListingField(read_only=True)
+    file = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
-        fields = ('id', 'user', 'type', 'content', 'created_at', 'updated_at')
+        fields = ('id', 'user', 'type', 'content', 'file', 'created_at', 'updated_at')
 
+    def get_file(self, obj):
+        return get_message_file_url(obj)
 
-class LastMessageSerializer(serializers.ModelSerializer):
-    """Serializes the last message sent in the chat room"""
 
-    class Meta:
-        model = Message
-        fields = ('type', 'content', 'created_at', 'updated_at')
+class MessageSearchSerializer(MessageListSerializer):
+    """Message found in the search with the name of its chat room"""
+
+    room = serializers.SlugRelatedField(slug_field='name', read_only=True)
+
+    class Meta(MessageListSerializer.Meta):
+        fields = ('id', 'room', 'user', 'type', 'content', 'file', 'created_at', 'updated_at')
+
+
+class LastMessageSerializer(serializers.Serializer):
+    """
+    Serializes the last message sent in the chat room, with the preview of its content stored in the room.
+    The message must be obtained with the room (select_related('last_message')), so it does not query the messages.
+    """
+
+    id = serializers.IntegerField(source='last_message_id')
+    type = serializers.CharField(source='last_message.type')
+    content = serializers.CharField(source='last_message.content')
+    preview = serializers.CharField(source='last_message_preview')
+    created_at = serializers.DateTimeField(source='last_message.created_at')
+    updated_at = serializers.DateTimeField(source='last_message.updated_at')
+
+
+class LastMessagePreviewSerializer(serializers.Serializer):
+    """
+    Serializes the preview of the last message sent in the chat room.
+    Uses the last message fields stored in the room, so it does not query the messages.
+    """
+
+    id = serializers.IntegerField(source='last_message_id')
+    type = serializers.CharField(source='last_message_type')
+    preview = serializers.CharField(source='last_message_preview')
+    created_at = serializers.DateTimeField(source='last_message_at')
@@ -1,10 +1,12 @@
 """Room serializer"""
 
+from django.urls import reverse
 from rest_framework import serializers
 
-from apps.chats.models import Room, Message
+from apps.chats.models import Room, RoomExport
 from apps.accounts.api.serializers.users import UserListRelatedSerializer
-from apps.chats.api.serializers.messages import LastMessageSerializer
+from apps.chats.api.serializers.messages import LastMessagePreviewSerializer, LastMessageSerializer
+from apps.chats.utils import get_room_counterpart
 
 
 class RoomSerializer(serializers.ModelSerializer):
@@ -13,11 +15,59 @@ class RoomSerializer(serializers.ModelSerializer):
     user_owner = UserListRelatedSerializer(read_only=True)
     user_receiver = UserListRelatedSerializer(read_only=True)
     last_message = serializers.SerializerMethodField()
+    unread_count = serializers.IntegerField(read_only=True)
+    last_read_message_id = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Room
-        fields = '__all__'
+        exclude = ('last_message_type', 'last_message_at', 'last_message_preview', 'is_deleting')
 
     def get_last_message(self, obj):
-        msg = Message.objects.filter(room=obj).order_by('created_at').last()
-        return LastMessageSerializer(msg).data
+        if obj.last_message_id is None:
+            return None
+        return LastMessageSerializer(obj).data
+
+
+class InboxRoomSerializer(serializers.ModelSerializer):
+    """
+    Chat room of the inbox of a user, with the other user of the room.
+    The user is obtained from the `user` of the context.
+    """
+
+    user = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+    unread_count = serializers.IntegerField(read_only=True)
+    last_read_message_id = serializers.IntegerField(read_only=True)
+    last_activity_at = serializers.DateTimeField(read_only=True)
+
+    class Meta:
+        model = Room
+        fields = (
+            'id', 'name', 'user', 'last_message', 'unread_count', 'last_read_message_id', 'last_activity_at',
+            'created_at'
+        )
+
+    def get_user(self, obj):
+        return UserListRelatedSerializer(get_room_counterpart(obj, self.context['user'])).data
+
+    def get_last_message(self, obj):
+        if obj.last_message_id is None:
+            return None
+        return LastMessagePreviewSerializer(obj).data
+
+
+class RoomExportSerializer(serializers.ModelSerializer):
+    """Export of a chat room, with the URL of its file when it is done"""
+
+    type = serializers.CharField(source='format', read_only=True)
+    zip = serializers.BooleanField(source='compress', read_only=True)
+    file = serializers.SerializerMethodField()
+
+    class Meta:
+        model = RoomExport
+        fields = ('id', 'type', 'zip', 'status', 'file', 'created_at', 'finished_at')
+
+    def get_file(self, obj):
+        if obj.status != RoomExport.Status.DONE:
+            return None
+        return reverse('rooms-export-file', kwargs={'name': obj.room.name, 'pk': obj.pk})
@@ -4,8 +4,8 @@ from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
 from apps.accounts.api.urls import user_url
-from apps.chats.api.views.messages import MessageListViewSet
-from apps.chats.api.views.rooms import RoomListViewSet
+from apps.chats.api.views.messages import MessageFileViewSet, MessageListViewSet, MessageSearchViewSet
+from apps.chats.api.views.rooms import InboxViewSet, RoomExportViewSet, RoomListViewSet
 
 router = DefaultRouter()
 
@@ -21,6 +21,30 @@ router.register(
     basename='users-messages'
 )
 
+router.register(
+    f'{user_url}/inbox',
+    InboxViewSet,
+    basename='users-inbox'
+)
+
+router.register(
+    f'{user_url}/messages/search',
+    MessageSearchViewSet,
+    basename='users-messages-search'
+)
+
+router.register(
+    r'rooms/(?P<name>[^/.]+)/export',
+    RoomExportViewSet,
+    basename='rooms-export'
+)
+
+router.register(
+    r'messages/(?P<pk>\d+)/file',
+    MessageFileViewSet,
+    basename='messages-file'
+)
+
 urlpatterns = [
     path('v1/', include(router.urls)),
 ]
@@ -1,13 +1,21 @@
+"""Message views"""
+
+from django.db.models import Count, Q
 from rest_framework import status
+from rest_framework.exceptions import NotFound
 from rest_framework.mixins import ListModelMixin
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 
-from apps.chats.models import Message
+from apps.chats.models import Message, MessageToken, Room
 from apps.accounts.api.permissions import check_permissions
-from apps.chats.api.serializers.messages import MessageListSerializer
+from apps.accounts.api.resolvers import get_path_user
+from apps.chats.api.serializers.messages import MessageListSerializer, MessageSearchSerializer
 from apps.chats.api.views.rooms import RoomListViewSet
+from apps.chats.search import get_tokens
+from apps.chats.storage import get_file_response
+from gestion_consultas.utils import ResponseWithErrors
 
 
 class MessageListViewSet(ListModelMixin, GenericViewSet):
@@ -20,7 +28,10 @@ class MessageListViewSet(ListModelMixin, GenericViewSet):
 
     def get_queryset(self, room_name=None):
         """Get the list of items for this view."""
-        return Message.objects.filter(room__name=room_name).order_by('created_at')
+        return (
+            Message.objects.with_decrypted_content().select_related('user').filter(room__name=room_name).
+            order_by('created_at')
+        )
 
     def list(self, request, username=None, name=None, *args, **kwargs):
         """List room messages"""
@@ -30,3 +41,66 @@ class MessageListViewSet(ListModelMixin, GenericViewSet):
         queryset = self.get_queryset(name)
         data['room']['messages'] = self.get_serializer(queryset, many=True).data
         return Response(data, status=status.HTTP_200_OK)
+
+
+class MessageSearchViewSet(ListModelMixin, GenericViewSet):
+    """
+    Message search view set.
+
+    Searches the messages of the chat rooms of the user that contain all the words of the `q` parameter. The `room`
+    parameter restricts the search to a chat room. The messages are found with the blind index of their words, so only
+    the messages found are decrypted.
+    """
+
+    serializer_class = MessageSearchSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self, user_id=None, tokens=None, room_name=None):
+        """Get the list of items for this view."""
+        rooms = Room.objects.filter(Q(user_owner=user_id) | Q(user_receiver=user_id))
+        if room_name is not None:
+            rooms = rooms.filter(name=room_name)
+
+        matches = (
+            MessageToken.objects.filter(token__in=tokens, room__in=rooms).values('message').
+            annotate(matches=Count('token', distinct=True)).filter(matches=len(tokens)).values('message')
+        )
+        return (
+            Message.objects.with_decrypted_content().select_related('user', 'room').filter(id__in=matches).
+            order_by('-created_at', '-id')
+        )
+
+    def list(self, request, username=None, *args, **kwargs):
+        """Search messages"""
+        check_permissions(request.user, username, 'chats.view_message')
+        user = get_path_user(request, username)
+
+        tokens = get_tokens(request.query_params.get('q'))
+        if not tokens:
+            return ResponseWithErrors({'q': ['Debe ingresar las palabras a buscar.']})
+
+        queryset = self.get_queryset(user.id, tokens, request.query_params.get('room'))
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+
+class MessageFileViewSet(GenericViewSet):
+    """
+    Message file view set.
+
+    Downloads the file of a message (apps.chats.storage) with its original name. Only the users of the chat room and
+    ADMIN users can download it. If settings.CHAT_FILES_ACCEL_REDIRECT is set, the file is sent by nginx.
+    """
+
+    permission_classes = (IsAuthenticated,)
+
+    def list(self, request, pk=None, *args, **kwargs):
+        """Download the file of the message"""
+        queryset = Message.objects.filter(pk=pk).exclude(file='')
+        if not request.user.is_staff:
+            queryset = queryset.filter(Q(room__user_owner=request.user) | Q(room__user_receiver=request.user))
+        message = queryset.first()
+        if message is None:
+            raise NotFound(detail='Archivo no encontrado.')
+
+        return get_file_response(message.file, message.content)
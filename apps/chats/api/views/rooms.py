@@ -1,16 +1,25 @@
 """Room views"""
 
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
 from rest_framework import status
+from rest_framework.decorators import action
 from rest_framework.exceptions import NotFound
+from rest_framework.mixins import ListModelMixin
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
-from rest_framework.viewsets import ReadOnlyModelViewSet
+from rest_framework.viewsets import GenericViewSet, ReadOnlyModelViewSet
 
-from apps.accounts.api.permissions import check_permissions
-from apps.accounts.api.views.users import UserModelViewSet
-from apps.chats.api.serializers.rooms import RoomSerializer
-from apps.chats.models import Room
+from apps.accounts.api.permissions import IsAdminOrDoctorUser, check_permissions
+from apps.accounts.api.resolvers import get_path_user, get_user_serializer_class
+from apps.chats.api.serializers.rooms import InboxRoomSerializer, RoomExportSerializer, RoomSerializer
+from apps.chats.export import CONTENT_TYPES, get_export_file_name
+from apps.chats.models import Room, RoomExport
+from apps.chats.storage import get_file_response
+from apps.chats.tasks import export_room
+from gestion_consultas.utils import ResponseWithErrors
 
 
 class RoomListViewSet(ReadOnlyModelViewSet):
@@ -22,18 +31,16 @@ class RoomListViewSet(ReadOnlyModelViewSet):
     permission_classes = (IsAuthenticated,)
     lookup_field = 'name'
 
-    def get_user(self, request, username, *args, **kwargs):
-        """Get user from UserModelViewSet class"""
-        user_model_view_set = UserModelViewSet(
-            request=request,
-            format_kwarg=self.format_kwarg,
-            kwargs={'username': username}
-        )
-        return user_model_view_set.retrieve(request, username, *args, **kwargs).data
+    def get_user_data(self, request, user):
+        """Serialize the user of the URL with the fields that the requesting user can see"""
+        return get_user_serializer_class(request)(user, context=self.get_serializer_context()).data
 
     def get_queryset(self, user=None, pk=None):
-        """Get the list of items for this view."""
-        return Room.objects.order_by('-created_at').filter(Q(user_owner=user['id']) | Q(user_receiver=user['id']))
+        """Get the list of items for this view. The unread messages counter of the user is read from its read state."""
+        return (
+            Room.objects.select_related('user_owner', 'user_receiver', 'last_message').order_by('-created_at').
+            for_user(user.id)
+        )
 
     def get_object(self, user=None, room_name=None):
         queryset = self.filter_queryset(self.get_queryset(user=user))
@@ -45,20 +52,20 @@ class RoomListViewSet(ReadOnlyModelViewSet):
     def list(self, request, username=None, *args, **kwargs):
         """User list chat rooms"""
         check_permissions(request.user, username, 'chats.view_room')
-        user = self.get_user(request, username, *args, **kwargs)
+        user = get_path_user(request, username)
         queryset = self.filter_queryset(self.get_queryset(user))
         page = self.paginate_queryset(queryset)
 
         rooms = self.get_serializer(page, many=True).data
         for room in rooms:
-            if room['user_owner']['username'] == user['username']:
+            if room['user_owner']['username'] == user.username:
                 room.pop('user_owner')
 
-            if room['user_receiver']['username'] == user['username']:
+            if room['user_receiver']['username'] == user.username:
                 room.pop('user_receiver')
 
         data = {
-            'user': user,
+            'user': self.get_user_data(request, user),
             'rooms': rooms
         }
         return self.get_paginated_response(data)
@@ -66,18 +73,116 @@ class RoomListViewSet(ReadOnlyModelViewSet):
     def retrieve(self, request, username=None, name=None, *args, **kwargs):
         """User chat room given Id"""
         check_permissions(request.user, username, 'chats.view_room')
-        user = self.get_user(request, username, *args, **kwargs)
+        user = get_path_user(request, username)
         queryset = self.get_object(user, name)
 
         room = self.get_serializer(queryset).data
-        if room['user_owner']['username'] == user['username']:
+        if room['user_owner']['username'] == user.username:
             room.pop('user_owner')
 
-        if room['user_receiver']['username'] == user['username']:
+        if room['user_receiver']['username'] == user.username:
             room.pop('user_receiver')
 
         data = {
-            'user': user,
+            'user': self.get_user_data(request, user),
             'room': room
         }
         return Response(data, status=status.HTTP_200_OK)
+
+
+class InboxPagination(CursorPagination):
+    """Keyset pagination of the inbox, from the most recent activity"""
+
+    ordering = ('-last_activity_at', '-id')
+    page_size = settings.CHAT_INBOX_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.CHAT_INBOX_MAX_PAGE_SIZE
+
+
+class InboxViewSet(ListModelMixin, GenericViewSet):
+    """
+    Inbox view set.
+
+    Lists the chat rooms of the user ordered by their last activity, with the other user of the room, the last message
+    and the unread messages counter. The rooms are obtained with a single query.
+    """
+
+    serializer_class = InboxRoomSerializer
+    permission_classes = (IsAuthenticated,)
+    pagination_class = InboxPagination
+
+    def get_queryset(self, user=None):
+        """Get the list of items for this view."""
+        return Room.objects.select_related('user_owner', 'user_receiver').for_user(user.id).with_last_activity()
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['user'] = self.user
+        return context
+
+    def list(self, request, username=None, *args, **kwargs):
+        """User inbox"""
+        check_permissions(request.user, username, 'chats.view_room')
+        self.user = get_path_user(request, username)
+        page = self.paginate_queryset(self.get_queryset(self.user))
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+
+class RoomExportViewSet(GenericViewSet):
+    """
+    Room export view set.
+
+    The transcript of a chat room is written to a file by a Celery task (apps.chats.export), so it is not generated by
+    the ASGI server. ADMIN users can export any room and DOCTOR users only the rooms in which they participate. Each
+    user only gets its own exports.
+    """
+
+    serializer_class = RoomExportSerializer
+    permission_classes = (IsAdminOrDoctorUser,)
+    lookup_value_regex = '[0-9a-f-]{36}'
+
+    def get_queryset(self):
+        return RoomExport.objects.select_related('room').filter(room__name=self.kwargs['name'], user=self.request.user)
+
+    def get_object(self):
+        export = self.get_queryset().filter(pk=self.kwargs['pk']).first()
+        if export is None:
+            raise NotFound(detail='Exportación no encontrada.')
+        return export
+
+    def create(self, request, name=None, *args, **kwargs):
+        """
+        Request the export of the chat room. The `type` parameter is the format of the file (jsonl by default, or csv)
+        and the `zip` parameter compresses it in a ZIP file. The file is downloaded from the `file` URL of the export
+        when its status is DONE.
+        """
+        queryset = Room.objects.filter(name=name)
+        if not request.user.is_staff:
+            queryset = queryset.filter(Q(user_owner=request.user) | Q(user_receiver=request.user))
+        room = queryset.first()
+        if room is None:
+            raise NotFound(detail='Chat no encontrado.')
+
+        export_format = request.data.get('type', RoomExport.Format.JSONL)
+        if export_format not in RoomExport.Format.values:
+            return ResponseWithErrors({'type': ['El formato de exportación es inválido.']})
+        compress = str(request.data.get('zip')).lower() in ('true', '1')
+
+        export = RoomExport.objects.create(room=room, user=request.user, format=export_format, compress=compress)
+        transaction.on_commit(lambda: export_room.delay(export.id))
+        return Response(self.get_serializer(export).data, status=status.HTTP_202_ACCEPTED)
+
+    def retrieve(self, request, *args, **kwargs):
+        """Status of the export"""
+        return Response(self.get_serializer(self.get_object()).data)
+
+    @action(detail=True, methods=['get'])
+    def file(self, request, *args, **kwargs):
+        """Download the file of the export"""
+        export = self.get_object()
+        if export.status != RoomExport.Status.DONE:
+            raise NotFound(detail='Archivo no encontrado.')
+        return get_file_response(
+            export.file, get_export_file_name(export.room, export.format, export.compress),
+            CONTENT_TYPES['zip' if export.compress else export.format]
+        )
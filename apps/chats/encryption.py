@@ -0,0 +1,125 @@
+"""
+Batch decryption of the content of chat messages.
+
+The content of the messages is decrypted when the rows are read. `MessageQuerySet.with_decrypted_content` reads the
+encrypted content without decrypting it and decrypts each batch of rows in a single pass, using the in-process cache of
+decrypted contents when it is enabled (settings.CHAT_DECRYPTED_CONTENT_CACHE_SIZE).
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.query import ModelIterable
+
+ENCRYPTED_CONTENT_FIELD = '_content_data'
+CIPHERTEXT_ATTR = '_content_ciphertext'
+
+
+class DecryptedContentCache:
+    """
+    LRU cache of decrypted message contents keyed by (message id, updated_at).
+    The memory used by the contents is limited to settings.CHAT_DECRYPTED_CONTENT_CACHE_SIZE bytes. The cache is
+    disabled if the setting is 0.
+    """
+
+    def __init__(self):
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return settings.CHAT_DECRYPTED_CONTENT_CACHE_SIZE
+
+    def get(self, key):
+        """Get the content of the message or None if it is not in the cache"""
+        if self.max_size <= 0:
+            return None
+
+        with self.lock:
+            content = self.items.get(key)
+            if content is not None:
+                self.items.move_to_end(key)
+            return content
+
+    def set(self, key, content):
+        """Add the content of the message, removing the least recently used contents if the cache is full"""
+        size = sys.getsizeof(content)
+        if size > self.max_size:
+            return
+
+        with self.lock:
+            previous = self.items.pop(key, None)
+            if previous is not None:
+                self.size -= sys.getsizeof(previous)
+
+            self.items[key] = content
+            self.size += size
+            while self.size > self.max_size:
+                _, removed = self.items.popitem(last=False)
+                self.size -= sys.getsizeof(removed)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+
+decrypted_content_cache = DecryptedContentCache()
+
+
+def cache_message_content(message):
+    """Add the content of a saved message to the cache"""
+    decrypted_content_cache.set((message.id, message.updated_at), message.content)
+
+
+def decrypt_messages(messages, use_cache=True):
+    """
+    Decrypt the content of a batch of messages read with `MessageQuerySet.with_decrypted_content`
+    :param messages: Message list
+    :param use_cache: Get the contents from the cache and add the decrypted contents to it
+    :return: The same list with the content decrypted
+    """
+    if not messages:
+        return messages
+
+    field = messages[0]._meta.get_field(ENCRYPTED_CONTENT_FIELD)
+    for message in messages:
+        ciphertext = message.__dict__.pop(CIPHERTEXT_ATTR)
+        key = (message.id, message.updated_at)
+        content = decrypted_content_cache.get(key) if use_cache else None
+        if content is None and ciphertext is not None:
+            content = field.to_python(field.decrypt(ciphertext))
+            if use_cache:
+                decrypted_content_cache.set(key, content)
+
+        # Set the deferred field without reading it from the database
+        message.__dict__[ENCRYPTED_CONTENT_FIELD] = content
+    return messages
+
+
+class DecryptedMessageIterable(ModelIterable):
+    """Iterates over the messages decrypting their content in batches"""
+
+    batch_size = 100
+    use_cache = True
+
+    def __iter__(self):
+        batch = []
+        for message in super().__iter__():
+            batch.append(message)
+            if len(batch) >= self.batch_size:
+                yield from decrypt_messages(batch, self.use_cache)
+                batch = []
+        yield from decrypt_messages(batch, self.use_cache)
+
+
+class UncachedDecryptedMessageIterable(DecryptedMessageIterable):
+    """
+    Decrypts the content of the messages without using the cache. It is used to read many messages once, like the
+    exports of the chat rooms, without replacing the contents of the cache.
+    """
+
+    use_cache = False
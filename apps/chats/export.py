@@ -0,0 +1,185 @@
+"""
+Export of the transcript of a chat room.
+
+The export is requested through the API (RoomExport) and run by a Celery task, which writes the file in the storage of
+the files of the messages under EXPORTS_DIR. The user who requested it downloads the file when it is done, so the
+export never runs in the process of the ASGI server, whose event loop also serves the chat websockets. The files are
+deleted after settings.CHAT_EXPORT_EXPIRATION hours.
+
+The messages are read with a server-side cursor in chunks of settings.CHAT_EXPORT_CHUNK_SIZE rows, decrypted in batches
+without using the cache of decrypted contents, and written to the file as they are read, so the memory used does not
+depend on the number of messages of the room.
+
+Formats:
+    jsonl: one JSON object per message.
+    csv: one row per message with a header row.
+Both formats can be compressed in a ZIP file, which is also written as it is generated.
+"""
+
+import csv
+import os
+import uuid
+import zipfile
+from datetime import timedelta
+
+import orjson
+from django.conf import settings
+from django.utils import timezone
+
+from apps.chats.models import Message, RoomExport
+
+EXPORTS_DIR = 'exports'
+
+EXPORT_FIELDS = ('id', 'user', 'type', 'content', 'file', 'created_at', 'updated_at')
+
+# Minimum size of the blocks written to the file
+BLOCK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'zip': 'application/zip',
+}
+
+
+class StreamBuffer:
+    """Write-only file whose content is taken after each write. It is used to stream the CSV rows and the ZIP file."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """Get the content written since the last call"""
+        data = b''.join(chunk.encode() if isinstance(chunk, str) else chunk for chunk in self.chunks)
+        self.chunks = []
+        return data
+
+
+def get_export_messages(room):
+    """Get the messages of the chat room from the oldest, using a server-side cursor"""
+    return (
+        Message.objects.with_decrypted_content(use_cache=False).select_related('user').filter(room=room).
+        order_by('created_at', 'id').iterator(chunk_size=settings.CHAT_EXPORT_CHUNK_SIZE)
+    )
+
+
+def message_to_row(message):
+    """Converts a message to the values of the export fields"""
+    return (
+        message.id,
+        message.user.username,
+        message.type,
+        message.content,
+        message.file.name or None,
+        message.created_at.isoformat(),
+        message.updated_at.isoformat(),
+    )
+
+
+def export_jsonl(messages):
+    """Export the messages as JSON lines"""
+    for message in messages:
+        yield orjson.dumps(dict(zip(EXPORT_FIELDS, message_to_row(message)))) + b'\n'
+
+
+def export_csv(messages):
+    """Export the messages as CSV rows"""
+    buffer = StreamBuffer()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    yield buffer.take()
+    for message in messages:
+        writer.writerow(message_to_row(message))
+        yield buffer.take()
+
+
+def export_zip(chunks, file_name):
+    """
+    Compress the exported file in a ZIP file
+    :param chunks: Chunks of the exported file
+    :param file_name: Name of the exported file in the ZIP file
+    """
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(file_name, 'w', force_zip64=True) as f:
+            for chunk in chunks:
+                f.write(chunk)
+                data = buffer.take()
+                if data:
+                    yield data
+    yield buffer.take()
+
+
+def get_export_file_name(room, export_format, compress=False):
+    return f'chat_{room.name}.{"zip" if compress else export_format}'
+
+
+def export_room(room, export_format, compress=False):
+    """
+    Export the transcript of the chat room
+    :param room: Room object
+    :param export_format: jsonl or csv
+    :param compress: Compress the transcript in a ZIP file
+    :return: Iterator of the bytes of the file
+    """
+    messages = get_export_messages(room)
+    chunks = export_jsonl(messages) if export_format == 'jsonl' else export_csv(messages)
+    if compress:
+        chunks = export_zip(chunks, get_export_file_name(room, export_format))
+    return join_chunks(chunks)
+
+
+def join_chunks(chunks):
+    """Join the chunks in blocks of at least BLOCK_SIZE bytes, so each row is not written separately"""
+    block = []
+    size = 0
+    for chunk in chunks:
+        block.append(chunk)
+        size += len(chunk)
+        if size >= BLOCK_SIZE:
+            yield b''.join(block)
+            block = []
+            size = 0
+    if block:
+        yield b''.join(block)
+
+
+def write_export(export):
+    """
+    Write the file of the export. The file is written with a temporary name and renamed when it is complete.
+    :param export: RoomExport object
+    """
+    extension = 'zip' if export.compress else export.format
+    name = f'{EXPORTS_DIR}/{uuid.uuid4().hex}.{extension}'
+    path = export.file.storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with open(f'{path}.part', 'wb') as f:
+            for block in export_room(export.room, export.format, export.compress):
+                f.write(block)
+        os.replace(f'{path}.part', path)
+    except BaseException:
+        if os.path.exists(f'{path}.part'):
+            os.remove(f'{path}.part')
+        raise
+    export.file.name = name
+
+
+def delete_expired_exports():
+    """
+    Delete the exports requested more than settings.CHAT_EXPORT_EXPIRATION hours ago, with their files
+    :return: Number of deleted exports
+    """
+    exports = RoomExport.objects.filter(
+        created_at__lt=timezone.now() - timedelta(hours=settings.CHAT_EXPORT_EXPIRATION)
+    )
+    for export in exports.exclude(file=''):
+        export.file.delete(save=False)
+    return exports.delete()[0]
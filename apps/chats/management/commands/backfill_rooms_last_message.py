@@ -0,0 +1,34 @@
+"""Saves the last message of the existing chat rooms"""
+
+from django.core.management.base import BaseCommand
+
+from apps.chats.models import Room, Message
+from apps.chats.utils import update_room_last_message
+
+
+class Command(BaseCommand):
+    help = 'Saves the last message of the chat rooms that do not have it stored.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500, help='Number of rooms obtained per query. Default 500.'
+        )
+
+    def handle(self, *args, **options):
+        queryset = Room.objects.filter(last_message__isnull=True).order_by('id').only('id')
+
+        updated = 0
+        last_id = 0
+        while True:
+            rooms = list(queryset.filter(id__gt=last_id)[:options['batch_size']])
+            if not rooms:
+                break
+
+            for room in rooms:
+                message = Message.objects.filter(room=room).order_by('-created_at', '-id').first()
+                if message is not None:
+                    updated += update_room_last_message(message, force=True)
+
+            last_id = rooms[-1].id
+
+        self.stdout.write(self.style.SUCCESS(f'Last message saved in {updated} chat rooms.'))
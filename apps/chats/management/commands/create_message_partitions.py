@@ -0,0 +1,22 @@
+"""Creates the partitions of the messages of the next months"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.chats.partitions import add_months, create_partitions, get_month
+
+
+class Command(BaseCommand):
+    help = 'Creates the monthly partitions of the messages from the current month to the next months.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months', type=int, default=settings.CHAT_MESSAGE_PARTITIONS_AHEAD,
+            help=f'Number of months ahead. Default {settings.CHAT_MESSAGE_PARTITIONS_AHEAD}.'
+        )
+
+    def handle(self, *args, **options):
+        month = get_month(timezone.now())
+        created = create_partitions(month, add_months(month, options['months']))
+        self.stdout.write(self.style.SUCCESS(f'{len(created)} message partitions created.'))
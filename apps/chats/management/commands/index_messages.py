@@ -0,0 +1,36 @@
+"""Indexes the words of the existing chat messages"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.chats.models import Message, MessageToken
+
+
+class Command(BaseCommand):
+    help = 'Saves the search tokens of the chat messages. The previous tokens of the messages are replaced.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500, help='Number of messages obtained per query. Default 500.'
+        )
+
+    def handle(self, *args, **options):
+        queryset = (
+            Message.objects.with_decrypted_content(use_cache=False).order_by('id').only('id', 'room_id', 'updated_at')
+        )
+
+        indexed = 0
+        last_id = 0
+        while True:
+            messages = list(queryset.filter(id__gt=last_id)[:options['batch_size']])
+            if not messages:
+                break
+
+            with transaction.atomic():
+                MessageToken.objects.filter(message__in=[m.id for m in messages]).delete()
+                MessageToken.objects.bulk_create(MessageToken.for_messages(messages))
+
+            indexed += len(messages)
+            last_id = messages[-1].id
+
+        self.stdout.write(self.style.SUCCESS(f'{indexed} chat messages indexed.'))
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+import encrypted_fields.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0002_message_room_created_at_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chats.message', verbose_name='último mensaje'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='fecha del último mensaje'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_preview',
+            field=encrypted_fields.fields.EncryptedTextField(blank=True, default='', verbose_name='vista previa del último mensaje'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_type',
+            field=models.CharField(blank=True, max_length=4, null=True, verbose_name='tipo del último mensaje'),
+        ),
+    ]
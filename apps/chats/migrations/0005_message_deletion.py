@@ -0,0 +1,35 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_message_created_at_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room_id', models.BigIntegerField(verbose_name='chat')),
+                ('message_id', models.BigIntegerField(verbose_name='mensaje')),
+                ('deleted_at', models.DateTimeField(auto_now_add=True, verbose_name='fecha de eliminación')),
+            ],
+            options={
+                'verbose_name': 'mensaje eliminado',
+                'verbose_name_plural': 'mensajes eliminados',
+                'db_table': 'message_deletion',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'updated_at'], name='message_room_updated_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagedeletion',
+            index=models.Index(fields=['room_id', 'deleted_at'], name='message_deletion_room_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chats', '0005_message_deletion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(blank=True, null=True, verbose_name='último mensaje leído')),
+                ('unread_count', models.PositiveIntegerField(default=0, verbose_name='mensajes sin leer')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='fecha de actualización')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chats.room', verbose_name='chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='usuario')),
+            ],
+            options={
+                'verbose_name': 'estado de lectura',
+                'verbose_name_plural': 'estados de lectura',
+                'db_table': 'room_read_state',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='roomreadstate',
+            constraint=models.UniqueConstraint(fields=('room', 'user'), name='room_read_state_room_user_unique'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0006_room_read_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64, verbose_name='token')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='chats.message', verbose_name='mensaje')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chats.room', verbose_name='chat')),
+            ],
+            options={
+                'verbose_name': 'token de mensaje',
+                'verbose_name_plural': 'tokens de mensajes',
+                'db_table': 'message_token',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='messagetoken',
+            index=models.Index(fields=['token', 'room'], name='message_token_token_room_idx'),
+        ),
+    ]
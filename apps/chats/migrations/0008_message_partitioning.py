@@ -0,0 +1,111 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:44
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+from apps.chats.partitions import add_months, create_partitions
+
+# Moves the indexes and foreign keys of the message table to the partitioned table
+PARTITION_MESSAGE_TABLE = """
+ALTER TABLE message RENAME TO message_old;
+ALTER TABLE message_old DROP CONSTRAINT message_pkey;
+
+CREATE TABLE message (LIKE message_old INCLUDING DEFAULTS) PARTITION BY LIST (archived);
+ALTER SEQUENCE message_id_seq OWNED BY message.id;
+ALTER TABLE message ADD CONSTRAINT message_pkey PRIMARY KEY (id, created_at, archived);
+
+CREATE TABLE message_archive PARTITION OF message FOR VALUES IN (true) WITH (fillfactor = 100);
+CREATE TABLE message_hot PARTITION OF message FOR VALUES IN (false) PARTITION BY RANGE (created_at);
+CREATE TABLE message_hot_default PARTITION OF message_hot DEFAULT;
+
+DO $$
+DECLARE r record;
+BEGIN
+    FOR r IN SELECT conname, pg_get_constraintdef(oid) AS def FROM pg_constraint
+            WHERE conrelid = 'message_old'::regclass AND contype = 'f' LOOP
+        EXECUTE format('ALTER TABLE message_old DROP CONSTRAINT %I', r.conname);
+        EXECUTE format('ALTER TABLE message ADD CONSTRAINT %I %s', r.conname, r.def);
+    END LOOP;
+    FOR r IN SELECT indexname, indexdef FROM pg_indexes WHERE tablename = 'message_old' LOOP
+        EXECUTE format('DROP INDEX %I', r.indexname);
+        EXECUTE replace(r.indexdef, ' ON public.message_old ', ' ON public.message ');
+    END LOOP;
+END $$;
+"""
+
+# Restores the indexes and foreign keys of the message table before it was partitioned
+UNPARTITION_MESSAGE_TABLE = """
+ALTER SEQUENCE message_id_seq OWNED BY message_old.id;
+
+DO $$
+DECLARE r record;
+BEGIN
+    FOR r IN SELECT conname, pg_get_constraintdef(oid) AS def FROM pg_constraint
+            WHERE conrelid = 'message'::regclass AND contype = 'f' LOOP
+        EXECUTE format('ALTER TABLE message DROP CONSTRAINT %I', r.conname);
+        EXECUTE format('ALTER TABLE message_old ADD CONSTRAINT %I %s', r.conname, r.def);
+    END LOOP;
+    FOR r IN SELECT indexname, indexdef FROM pg_indexes
+            WHERE tablename = 'message' AND indexname <> 'message_pkey' LOOP
+        EXECUTE format('DROP INDEX %I', r.indexname);
+        EXECUTE replace(replace(r.indexdef, ' ON ONLY public.message ', ' ON public.message_old '),
+                        ' ON public.message ', ' ON public.message_old ');
+    END LOOP;
+END $$;
+
+DROP TABLE message;
+ALTER TABLE message_old RENAME TO message;
+ALTER TABLE message ADD CONSTRAINT message_pkey PRIMARY KEY (id);
+"""
+
+# The messages are copied in the transaction of the migration, which locks the message table until it is committed.
+# The API and the chat must be stopped while the migration runs, for a time proportional to the number of messages.
+COPY_MESSAGES = """
+INSERT INTO message SELECT * FROM message_old;
+DROP TABLE message_old;
+"""
+
+RESTORE_MESSAGES = """
+CREATE TABLE message_old (LIKE message INCLUDING DEFAULTS);
+INSERT INTO message_old SELECT * FROM message;
+"""
+
+
+def create_message_partitions(apps, schema_editor):
+    """Create the partitions of the months of the existing messages and the next months"""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT MIN(created_at) FROM message_old')
+        first_message_at = cursor.fetchone()[0]
+
+    now = timezone.now()
+    create_partitions(first_message_at or now, add_months(now, settings.CHAT_MESSAGE_PARTITIONS_AHEAD))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_message_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='archived',
+            field=models.BooleanField(default=False, editable=False, verbose_name='archivado'),
+        ),
+        migrations.AlterField(
+            model_name='messagetoken',
+            name='message',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='chats.message', verbose_name='mensaje'),
+        ),
+        migrations.AlterField(
+            model_name='room',
+            name='last_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chats.message', verbose_name='último mensaje'),
+        ),
+        migrations.RunSQL(PARTITION_MESSAGE_TABLE, UNPARTITION_MESSAGE_TABLE),
+        migrations.RunPython(create_message_partitions, migrations.RunPython.noop),
+        migrations.RunSQL(COPY_MESSAGES, RESTORE_MESSAGES),
+    ]
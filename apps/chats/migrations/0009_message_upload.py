@@ -0,0 +1,42 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:55
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chats', '0008_message_partitioning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='file',
+            field=models.FileField(blank=True, max_length=255, upload_to='chats/files', verbose_name='archivo'),
+        ),
+        migrations.CreateModel(
+            name='MessageUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('type', models.CharField(choices=[('AD', 'Audio'), ('FL', 'Archivo'), ('IMG', 'Imagen'), ('TXT', 'Texto'), ('VD', 'Video')], max_length=4, verbose_name='tipo de mensaje')),
+                ('name', models.CharField(max_length=255, verbose_name='nombre del archivo')),
+                ('size', models.PositiveBigIntegerField(verbose_name='tamaño')),
+                ('checksum', models.CharField(blank=True, max_length=64, verbose_name='checksum SHA-256')),
+                ('offset', models.PositiveBigIntegerField(default=0, verbose_name='bytes recibidos')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='fecha de registro')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='fecha de actualización')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chats.room', verbose_name='chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='usuario')),
+            ],
+            options={
+                'verbose_name': 'carga de archivo',
+                'verbose_name_plural': 'cargas de archivos',
+                'db_table': 'message_upload',
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.11 on 2026-10-18 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0009_message_upload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessagePurge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('ROOM', 'Chat'), ('USER', 'Usuario'), ('RET', 'Retención')], max_length=4, verbose_name='tipo')),
+                ('status', models.CharField(choices=[('PEN', 'Pendiente'), ('RUN', 'En ejecución'), ('DONE', 'Terminado')], default='PEN', max_length=4, verbose_name='estado')),
+                ('room_id', models.BigIntegerField(blank=True, null=True, verbose_name='chat')),
+                ('user_id', models.BigIntegerField(blank=True, null=True, verbose_name='usuario')),
+                ('created_before', models.DateTimeField(blank=True, null=True, verbose_name='mensajes enviados antes de')),
+                ('last_message_id', models.BigIntegerField(default=0, verbose_name='último mensaje eliminado')),
+                ('deleted_messages', models.PositiveBigIntegerField(default=0, verbose_name='mensajes eliminados')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='fecha de registro')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='fecha de actualización')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='fecha de finalización')),
+            ],
+            options={
+                'verbose_name': 'eliminación de mensajes',
+                'verbose_name_plural': 'eliminaciones de mensajes',
+                'db_table': 'message_purge',
+            },
+        ),
+    ]
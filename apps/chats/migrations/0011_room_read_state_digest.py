@@ -0,0 +1,27 @@
+# Generated by Django 3.2.11 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0010_message_purge'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomreadstate',
+            name='notified_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='fecha de notificación'),
+        ),
+        migrations.AddField(
+            model_name='roomreadstate',
+            name='unread_since',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='fecha del primer mensaje sin leer'),
+        ),
+        migrations.AddIndex(
+            model_name='roomreadstate',
+            index=models.Index(condition=models.Q(('unread_count__gt', 0)), fields=['unread_since'], name='room_read_state_unread_idx'),
+        ),
+    ]
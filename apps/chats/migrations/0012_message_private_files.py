@@ -0,0 +1,44 @@
+# Generated by Django 3.2.11 on 2026-10-18 14:34
+
+import os
+import shutil
+
+import apps.chats.storage
+from django.conf import settings
+from django.db import migrations, models
+
+from apps.chats import storage as chats_storage
+
+PUBLIC_FILES_DIR = 'chats/files/'
+
+
+def move_message_files(apps, schema_editor):
+    """Move the files of the messages from MEDIA_ROOT to the storage of the message files, with random names"""
+    Message = apps.get_model('chats', 'Message')
+    storage = chats_storage.ChatFileStorage()
+    queryset = Message.objects.filter(file__startswith=PUBLIC_FILES_DIR).values_list('id', 'file')
+    for message_id, name in queryset.iterator():
+        path = os.path.join(settings.MEDIA_ROOT, name)
+        if not os.path.exists(path):
+            continue
+        new_name = chats_storage.get_message_file_path(None, name)
+        new_path = storage.path(new_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        shutil.move(path, new_path)
+        Message.objects.filter(id=message_id).update(file=new_name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0011_room_read_state_digest'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='file',
+            field=models.FileField(blank=True, max_length=255, storage=apps.chats.storage.ChatFileStorage(), upload_to=apps.chats.storage.get_message_file_path, verbose_name='archivo'),
+        ),
+        migrations.RunPython(move_message_files, migrations.RunPython.noop),
+    ]
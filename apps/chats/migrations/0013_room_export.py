@@ -0,0 +1,37 @@
+# Generated by Django 3.2.11 on 2026-10-18 14:38
+
+import apps.chats.storage
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chats', '0012_message_private_files'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomExport',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('format', models.CharField(choices=[('jsonl', 'JSON lines'), ('csv', 'CSV')], default='jsonl', max_length=5, verbose_name='formato')),
+                ('compress', models.BooleanField(default=False, verbose_name='comprimido')),
+                ('status', models.CharField(choices=[('PEN', 'Pendiente'), ('RUN', 'En ejecución'), ('DONE', 'Terminado'), ('ERR', 'Fallido')], default='PEN', max_length=4, verbose_name='estado')),
+                ('file', models.FileField(blank=True, max_length=255, storage=apps.chats.storage.ChatFileStorage(), upload_to='', verbose_name='archivo')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='fecha de registro')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='fecha de finalización')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chats.room', verbose_name='chat')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='usuario')),
+            ],
+            options={
+                'verbose_name': 'exportación de chat',
+                'verbose_name_plural': 'exportaciones de chats',
+                'db_table': 'room_export',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.11 on 2026-10-18 14:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0013_room_export'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='messageupload',
+            name='checksum',
+            field=models.CharField(max_length=64, verbose_name='checksum SHA-256'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.11 on 2026-10-18 14:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0014_message_upload_checksum_required'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='is_deleting',
+            field=models.BooleanField(default=False, editable=False, verbose_name='en eliminación'),
+        ),
+    ]
@@ -1,9 +1,42 @@
 """Chats models"""
 
-from django.db import models
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import ExpressionWrapper, F, FilteredRelation, Q
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from encrypted_fields import fields
 
+from apps.chats.encryption import (
+    CIPHERTEXT_ATTR, ENCRYPTED_CONTENT_FIELD, DecryptedMessageIterable, UncachedDecryptedMessageIterable
+)
+from apps.chats.search import get_tokens
+from apps.chats.storage import ChatFileStorage, get_message_file_path
+
+
+class RoomQuerySet(models.QuerySet):
+    """Room queryset"""
+
+    def for_user(self, user_id):
+        """Chat rooms of the user, with the unread messages counter and the last message read by the user"""
+        return self.filter(Q(user_owner=user_id) | Q(user_receiver=user_id)).annotate(
+            read_state=FilteredRelation('read_states', condition=Q(read_states__user=user_id)),
+            unread_count=Coalesce(F('read_state__unread_count'), 0),
+            last_read_message_id=F('read_state__last_read_message_id'),
+        )
+
+    def with_last_activity(self):
+        """Annotates the date of the last activity of the room: its last message, or its creation"""
+        return self.annotate(last_activity_at=Coalesce(F('last_message_at'), F('created_at')))
+
 
 class Room(models.Model):
     """Room model. Represents a chat room"""
@@ -16,8 +49,18 @@ class Room(models.Model):
         on_delete=models.CASCADE
     )
     name = models.CharField(_('nombre'), max_length=60, unique=True)
+    last_message = models.ForeignKey(
+        'chats.Message', verbose_name=_('último mensaje'), related_name='+', null=True, blank=True,
+        on_delete=models.SET_NULL, db_constraint=False
+    )
+    last_message_type = models.CharField(_('tipo del último mensaje'), max_length=4, null=True, blank=True)
+    last_message_at = models.DateTimeField(_('fecha del último mensaje'), null=True, blank=True)
+    last_message_preview = fields.EncryptedTextField(_('vista previa del último mensaje'), default='', blank=True)
+    is_deleting = models.BooleanField(_('en eliminación'), default=False, editable=False)
     created_at = models.DateTimeField(_('fecha de registro'), auto_now_add=True)
 
+    objects = RoomQuerySet.as_manager()
+
     class Meta:
         db_table = 'room'
         verbose_name = _('chat')
@@ -33,8 +76,41 @@ class Room(models.Model):
         return f'{self.user_owner.username} | {self.user_receiver.username}'
 
 
+class MessageQuerySet(models.QuerySet):
+    """Message queryset"""
+
+    def with_decrypted_content(self, use_cache=True):
+        """
+        Read the encrypted content without decrypting it row by row. The content is decrypted in batches and the
+        contents already decrypted are obtained from the cache.
+        :param use_cache: Use the cache of decrypted contents. Disable it to read many messages once.
+        """
+        queryset = self.defer(ENCRYPTED_CONTENT_FIELD).annotate(**{
+            CIPHERTEXT_ATTR: ExpressionWrapper(F(ENCRYPTED_CONTENT_FIELD), output_field=models.BinaryField())
+        })
+        queryset._iterable_class = DecryptedMessageIterable if use_cache else UncachedDecryptedMessageIterable
+        return queryset
+
+    def sent_after(self, cursor):
+        """
+        Messages sent after a message. Only the messages of the inactive chat rooms are archived
+        (archive_inactive_rooms task), so the messages sent in the last settings.CHAT_ARCHIVE_ROOMS_AFTER_DAYS days are
+        never archived: if the message is more recent, the archive partition is not read.
+        :param cursor: Cursor (created_at, id) of the message
+        """
+        created_at, pk = cursor
+        queryset = self.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+        if created_at > timezone.now() - timedelta(days=settings.CHAT_ARCHIVE_ROOMS_AFTER_DAYS):
+            queryset = queryset.filter(archived=False)
+        return queryset
+
+
 class Message(models.Model):
-    """Message model"""
+    """
+    Message model.
+    The table is partitioned (apps.chats.partitions), so the primary key of the table is (id, created_at, archived)
+    and the foreign keys to the messages are not enforced by the database.
+    """
 
     class Type(models.TextChoices):
         AUDIO = 'AD', _('Audio')
@@ -52,13 +128,23 @@ class Message(models.Model):
         encrypted_field_name="_content_data",
         verbose_name=_('contenido')
     )
-    created_at = models.DateTimeField(_('fecha de registro'), auto_now_add=True)
+    created_at = models.DateTimeField(_('fecha de registro'), default=timezone.now, editable=False)
     updated_at = models.DateTimeField(_('fecha de actualización'), auto_now=True)
+    archived = models.BooleanField(_('archivado'), default=False, editable=False)
+    file = models.FileField(
+        _('archivo'), upload_to=get_message_file_path, storage=ChatFileStorage(), max_length=255, blank=True
+    )
+
+    objects = MessageQuerySet.as_manager()
 
     class Meta:
         db_table = 'message'
         verbose_name = _('mensaje')
         verbose_name_plural = _('mensajes')
+        indexes = [
+            models.Index(fields=['room', 'created_at', 'id'], name='message_room_created_at_idx'),
+            models.Index(fields=['room', 'updated_at'], name='message_room_updated_at_idx'),
+        ]
         permissions = [
             ('add_message_from_me', 'Can add my messages'),
             ('change_message_from_me', 'Can change my messages'),
@@ -68,3 +154,251 @@ class Message(models.Model):
 
     def __str__(self):
         return self.content
+
+
+class MessageToken(models.Model):
+    """HMAC of a word of a message. It is used to search the encrypted messages (apps.chats.search)."""
+
+    message = models.ForeignKey(
+        Message, verbose_name=_('mensaje'), related_name='tokens', on_delete=models.CASCADE, db_constraint=False
+    )
+    room = models.ForeignKey(Room, verbose_name=_('chat'), related_name='+', on_delete=models.CASCADE)
+    token = models.CharField(_('token'), max_length=64)
+
+    class Meta:
+        db_table = 'message_token'
+        verbose_name = _('token de mensaje')
+        verbose_name_plural = _('tokens de mensajes')
+        indexes = [
+            models.Index(fields=['token', 'room'], name='message_token_token_room_idx'),
+        ]
+
+    def __str__(self):
+        return self.token
+
+    @staticmethod
+    def for_messages(messages):
+        """
+        Get the tokens of the words of the messages
+        :param messages: Message list
+        :return: MessageToken list not yet saved
+        """
+        return [
+            MessageToken(message_id=message.id, room_id=message.room_id, token=token)
+            for message in messages for token in get_tokens(message.content)
+        ]
+
+
+class MessageDeletion(models.Model):
+    """Deleted message. It is used to synchronize the deletions with the clients."""
+
+    room_id = models.BigIntegerField(_('chat'))
+    message_id = models.BigIntegerField(_('mensaje'))
+    deleted_at = models.DateTimeField(_('fecha de eliminación'), auto_now_add=True)
+
+    class Meta:
+        db_table = 'message_deletion'
+        verbose_name = _('mensaje eliminado')
+        verbose_name_plural = _('mensajes eliminados')
+        indexes = [
+            models.Index(fields=['room_id', 'deleted_at'], name='message_deletion_room_idx'),
+        ]
+
+    def __str__(self):
+        return str(self.message_id)
+
+
+class MessageUpload(models.Model):
+    """
+    Chunked upload of the file of a message, in progress. The received chunks are stored in a partial file
+    (apps.chats.uploads).
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey(Room, verbose_name=_('chat'), related_name='+', on_delete=models.CASCADE)
+    user = models.ForeignKey('accounts.User', verbose_name=_('usuario'), on_delete=models.CASCADE)
+    type = models.CharField(_('tipo de mensaje'), max_length=4, choices=Message.Type.choices)
+    name = models.CharField(_('nombre del archivo'), max_length=255)
+    size = models.PositiveBigIntegerField(_('tamaño'))
+    checksum = models.CharField(_('checksum SHA-256'), max_length=64)
+    offset = models.PositiveBigIntegerField(_('bytes recibidos'), default=0)
+    created_at = models.DateTimeField(_('fecha de registro'), auto_now_add=True)
+    updated_at = models.DateTimeField(_('fecha de actualización'), auto_now=True)
+
+    class Meta:
+        db_table = 'message_upload'
+        verbose_name = _('carga de archivo')
+        verbose_name_plural = _('cargas de archivos')
+
+    def __str__(self):
+        return self.name
+
+
+class MessagePurge(models.Model):
+    """
+    Job that deletes messages in batches (apps.chats.purge): the messages of a chat room or of a user before deleting
+    the room or the user, or the messages older than the retention period.
+    """
+
+    class Type(models.TextChoices):
+        ROOM = 'ROOM', _('Chat')
+        USER = 'USER', _('Usuario')
+        RETENTION = 'RET', _('Retención')
+
+    class Status(models.TextChoices):
+        PENDING = 'PEN', _('Pendiente')
+        RUNNING = 'RUN', _('En ejecución')
+        DONE = 'DONE', _('Terminado')
+
+    type = models.CharField(_('tipo'), max_length=4, choices=Type.choices)
+    status = models.CharField(_('estado'), max_length=4, choices=Status.choices, default=Status.PENDING)
+    room_id = models.BigIntegerField(_('chat'), null=True, blank=True)
+    user_id = models.BigIntegerField(_('usuario'), null=True, blank=True)
+    created_before = models.DateTimeField(_('mensajes enviados antes de'), null=True, blank=True)
+    last_message_id = models.BigIntegerField(_('último mensaje eliminado'), default=0)
+    deleted_messages = models.PositiveBigIntegerField(_('mensajes eliminados'), default=0)
+    created_at = models.DateTimeField(_('fecha de registro'), auto_now_add=True)
+    updated_at = models.DateTimeField(_('fecha de actualización'), auto_now=True)
+    finished_at = models.DateTimeField(_('fecha de finalización'), null=True, blank=True)
+
+    class Meta:
+        db_table = 'message_purge'
+        verbose_name = _('eliminación de mensajes')
+        verbose_name_plural = _('eliminaciones de mensajes')
+
+    def __str__(self):
+        return f'{self.get_type_display()} | {self.get_status_display()}'
+
+
+class RoomExport(models.Model):
+    """
+    Export of the transcript of a chat room (apps.chats.export). The file is written by a Celery task in the storage of
+    the files of the messages and downloaded by the user who requested it.
+    """
+
+    class Format(models.TextChoices):
+        JSONL = 'jsonl', 'JSON lines'
+        CSV = 'csv', 'CSV'
+
+    class Status(models.TextChoices):
+        PENDING = 'PEN', _('Pendiente')
+        RUNNING = 'RUN', _('En ejecución')
+        DONE = 'DONE', _('Terminado')
+        FAILED = 'ERR', _('Fallido')
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey(Room, verbose_name=_('chat'), related_name='+', on_delete=models.CASCADE)
+    user = models.ForeignKey('accounts.User', verbose_name=_('usuario'), on_delete=models.CASCADE)
+    format = models.CharField(_('formato'), max_length=5, choices=Format.choices, default=Format.JSONL)
+    compress = models.BooleanField(_('comprimido'), default=False)
+    status = models.CharField(_('estado'), max_length=4, choices=Status.choices, default=Status.PENDING)
+    file = models.FileField(_('archivo'), max_length=255, storage=ChatFileStorage(), blank=True)
+    created_at = models.DateTimeField(_('fecha de registro'), auto_now_add=True)
+    finished_at = models.DateTimeField(_('fecha de finalización'), null=True, blank=True)
+
+    class Meta:
+        db_table = 'room_export'
+        verbose_name = _('exportación de chat')
+        verbose_name_plural = _('exportaciones de chats')
+
+    def __str__(self):
+        return f'{self.room_id} | {self.get_status_display()}'
+
+
+class RoomReadState(models.Model):
+    """Read state of a chat room for one of its users"""
+
+    room = models.ForeignKey(Room, verbose_name=_('chat'), related_name='read_states', on_delete=models.CASCADE)
+    user = models.ForeignKey('accounts.User', verbose_name=_('usuario'), on_delete=models.CASCADE)
+    last_read_message_id = models.BigIntegerField(_('último mensaje leído'), null=True, blank=True)
+    unread_count = models.PositiveIntegerField(_('mensajes sin leer'), default=0)
+    unread_since = models.DateTimeField(_('fecha del primer mensaje sin leer'), null=True, blank=True)
+    notified_at = models.DateTimeField(_('fecha de notificación'), null=True, blank=True)
+    updated_at = models.DateTimeField(_('fecha de actualización'), auto_now=True)
+
+    class Meta:
+        db_table = 'room_read_state'
+        verbose_name = _('estado de lectura')
+        verbose_name_plural = _('estados de lectura')
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='room_read_state_room_user_unique'),
+        ]
+        indexes = [
+            models.Index(
+                fields=['unread_since'], name='room_read_state_unread_idx', condition=models.Q(unread_count__gt=0)
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.room_id} | {self.user_id}'
+
+
+def invalidate_rooms(room_names):
+    """
+    Notify the consumers of the chat rooms that the room or its users changed, so they do not use the room resolved
+    when connecting.
+    :param room_names: Room names
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    for room_name in room_names:
+        async_to_sync(channel_layer.group_send)(
+            f'chat_{room_name}', {'type': 'room_invalidate', 'room_name': room_name}
+        )
+
+
+def get_user_group_name(user_id):
+    """Group of the websocket connections of the user"""
+    return f'chat_user_{user_id}'
+
+
+def disconnect_user(user_id):
+    """Close the websocket connections of the user"""
+    channel_layer = get_channel_layer()
+    if channel_layer is not None:
+        async_to_sync(channel_layer.group_send)(get_user_group_name(user_id), {'type': 'user_deactivate'})
+
+
+@receiver([post_save, post_delete], sender=Room)
+def invalidate_room(sender, instance, created=False, **kwargs):
+    if not created:
+        transaction.on_commit(lambda: invalidate_rooms([instance.name]))
+
+
+@receiver(post_save, sender='accounts.User')
+def invalidate_user_rooms(sender, instance, created=False, update_fields=None, **kwargs):
+    if created or update_fields is not None and not {'username', 'is_active'}.intersection(update_fields):
+        return
+
+    room_names = list(
+        Room.objects.filter(Q(user_owner=instance) | Q(user_receiver=instance)).values_list('name', flat=True)
+    )
+    if room_names:
+        transaction.on_commit(lambda: invalidate_rooms(room_names))
+
+
+@receiver([post_save, post_delete], sender='accounts.User')
+def disconnect_inactive_user(sender, instance, created=False, **kwargs):
+    """The inactive and deleted users cannot keep their websocket connections"""
+    if created or kwargs['signal'] is post_save and instance.is_active:
+        return
+
+    user_id = instance.id
+    transaction.on_commit(lambda: disconnect_user(user_id))
+
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, created=False, update_fields=None, **kwargs):
+    if update_fields is not None and not {'content', ENCRYPTED_CONTENT_FIELD}.intersection(update_fields):
+        return
+
+    if not created:
+        MessageToken.objects.filter(message=instance).delete()
+    MessageToken.objects.bulk_create(MessageToken.for_messages([instance]))
+
+
+@receiver(post_delete, sender=Message)
+def create_message_deletion(sender, instance, **kwargs):
+    MessageDeletion.objects.create(room_id=instance.room_id, message_id=instance.id)
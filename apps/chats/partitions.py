@@ -0,0 +1,88 @@
+"""
+Partitions of the message table.
+
+The `message` table is partitioned by the `archived` field:
+    message_archive: messages of the inactive chat rooms (archive_inactive_rooms task).
+    message_hot: the other messages, partitioned by month of `created_at` (message_yYYYYmMM tables). The messages sent
+        in months without partition are saved in the `message_hot_default` partition.
+
+Queries of recent messages only read the partitions of the last months. The partitions of the next months are created
+by the `create_message_partitions` command.
+"""
+
+from datetime import datetime, timezone
+
+from django.db import connection, transaction
+
+HOT_TABLE = 'message_hot'
+DEFAULT_PARTITION = 'message_hot_default'
+
+
+def get_month(date):
+    """Get the first day of the month of the date"""
+    return datetime(date.year, date.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, months):
+    """Get the first day of the month `months` months after the month"""
+    month_index = month.year * 12 + month.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def get_partition_name(month):
+    return f'message_y{month.year}m{month.month:02d}'
+
+
+def get_partitions():
+    """Get the names of the monthly partitions of the messages"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = %s::regclass",
+            [HOT_TABLE]
+        )
+        return {row[0] for row in cursor.fetchall()} - {DEFAULT_PARTITION}
+
+
+def create_partition(month):
+    """
+    Create the partition of the messages sent in the month. The messages of the month saved in the default partition
+    are moved to the new partition.
+    :param month: First day of the month
+    :return: Partition name
+    """
+    name = get_partition_name(month)
+    start, end = month, add_months(month, 1)
+    quote_name = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE TABLE {quote_name(name)} (LIKE {HOT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+        )
+        cursor.execute(
+            f'WITH moved AS ('
+            f'DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s RETURNING *'
+            f') INSERT INTO {quote_name(name)} SELECT * FROM moved',
+            [start, end]
+        )
+        cursor.execute(
+            f'ALTER TABLE {HOT_TABLE} ATTACH PARTITION {quote_name(name)} FOR VALUES FROM (%s) TO (%s)',
+            [start, end]
+        )
+    return name
+
+
+def create_partitions(start, end):
+    """
+    Create the monthly partitions that do not exist between two dates
+    :param start: Date of the first month
+    :param end: Date of the last month
+    :return: Names of the partitions created
+    """
+    partitions = get_partitions()
+    created = []
+    month, last_month = get_month(start), get_month(end)
+    while month <= last_month:
+        if get_partition_name(month) not in partitions:
+            created.append(create_partition(month))
+        month = add_months(month, 1)
+    return created
@@ -0,0 +1,94 @@
+"""
+Presence and typing registry of the chat users, stored in Redis.
+
+Presence: each open connection of a user is a member of the sorted set `chats:presence:{user_id}` with its expiration
+time as score. The connections refresh it with the `presence` command; the user is online while a connection has not
+expired (settings.CHAT_PRESENCE_TTL).
+Typing: `chats:typing:{room_name}:{user_id}` exists while the user is typing in the room (settings.CHAT_TYPING_TTL).
+
+The events are coalesced: an event that repeats the state last broadcast by the user to the chat room (the same
+presence status, or typing again) is only broadcast once every settings.CHAT_PRESENCE_INTERVAL milliseconds, using a key
+with the last state that expires at the end of the interval. The state changes (typing false, away, offline) are always
+broadcast.
+"""
+
+import time
+
+import redis
+from django.conf import settings
+
+PRESENCE_KEY = 'chats:presence:{user_id}'
+TYPING_KEY = 'chats:typing:{room_name}:{user_id}'
+BROADCAST_KEY = 'chats:{event}:broadcast:{room_name}:{user_id}'
+
+# Saves the state for the interval unless it is the state already broadcast in the interval.
+# KEYS: broadcast key. ARGV: state, interval in milliseconds.
+BROADCAST_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+
+class PresenceRegistry:
+    """Redis registry of the connections of the users and of the users typing"""
+
+    def __init__(self):
+        self._redis = None
+        self._broadcast_script = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = redis.Redis.from_url(settings.CHAT_PRESENCE_REDIS_URL)
+        return self._redis
+
+    def connect(self, user_id, channel_name):
+        """Register or refresh a connection of the user"""
+        key = PRESENCE_KEY.format(user_id=user_id)
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zadd(key, {channel_name: now + settings.CHAT_PRESENCE_TTL})
+        pipe.expire(key, settings.CHAT_PRESENCE_TTL)
+        pipe.execute()
+
+    def disconnect(self, user_id, channel_name):
+        """
+        Remove a connection of the user
+        :return: True if the user has other connections
+        """
+        key = PRESENCE_KEY.format(user_id=user_id)
+        pipe = self.redis.pipeline()
+        pipe.zrem(key, channel_name)
+        pipe.zremrangebyscore(key, '-inf', time.time())
+        pipe.zcard(key)
+        return pipe.execute()[-1] > 0
+
+    def is_online(self, user_id):
+        return self.redis.zcount(PRESENCE_KEY.format(user_id=user_id), time.time(), '+inf') > 0
+
+    def set_typing(self, room_name, user_id, typing):
+        """Register that the user is typing in the chat room, or that they stopped typing"""
+        key = TYPING_KEY.format(room_name=room_name, user_id=user_id)
+        if typing:
+            self.redis.set(key, 1, ex=settings.CHAT_TYPING_TTL)
+        else:
+            self.redis.delete(key)
+
+    def should_broadcast(self, event, room_name, user_id, state):
+        """
+        Coalesce the events of the user in the chat room
+        :param event: `presence` or `typing`
+        :param state: State of the event, e.g. the presence status
+        :return: True if the state is not the one broadcast by the user to the room in the current interval
+        """
+        if self._broadcast_script is None:
+            self._broadcast_script = self.redis.register_script(BROADCAST_SCRIPT)
+        key = BROADCAST_KEY.format(event=event, room_name=room_name, user_id=user_id)
+        return bool(self._broadcast_script(keys=[key], args=[state, settings.CHAT_PRESENCE_INTERVAL]))
+
+
+presence_registry = PresenceRegistry()
@@ -0,0 +1,220 @@
+"""
+Deletion of chat messages in batches.
+
+Deleting a user or a chat room with the ORM deletes all their messages in a single transaction, which locks the message
+table while it runs. Instead, a MessagePurge job is created and the `run_message_purge` task deletes the messages in
+batches of settings.CHAT_PURGE_BATCH_SIZE ids, one transaction per batch, waiting settings.CHAT_PURGE_BATCH_DELAY
+milliseconds between batches. Each batch saves the id of the last deleted message and the number of deleted messages
+in the job, so an interrupted job continues where it stopped. The room or the user is only deleted when no messages are
+left. The chat rooms are marked as being deleted (Room.is_deleting) when the job is created, so no new messages are
+saved in them while their messages are deleted.
+
+The retention policy (settings.CHAT_MESSAGE_RETENTION_DAYS) deletes the old messages with a job of the same pipeline.
+"""
+
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.accounts.models import User
+from apps.chats.models import Message, MessageDeletion, MessagePurge, MessageToken, Room, invalidate_rooms
+from apps.chats.tasks import run_message_purge
+from apps.chats.utils import update_room_last_message
+
+
+def create_purge(purge_type, **kwargs):
+    """
+    Create a purge job and run it when the transaction is committed
+    :param purge_type: MessagePurge.Type
+    :param kwargs: Other fields of the job
+    :return: MessagePurge object
+    """
+    job = MessagePurge.objects.create(type=purge_type, **kwargs)
+    transaction.on_commit(lambda: run_message_purge.delay(job.id))
+    return job
+
+
+def close_rooms(rooms):
+    """
+    Mark the chat rooms as being deleted. The messages are saved with the rooms locked (apps.chats.utils.lock_rooms), so
+    once the transaction is committed no new messages are saved in them.
+    :param rooms: Room queryset
+    """
+    room_names = list(rooms.values_list('name', flat=True))
+    rooms.update(is_deleting=True)
+    transaction.on_commit(lambda: invalidate_rooms(room_names))
+
+
+def purge_room(room):
+    """Block the new messages of the chat room and delete its messages in batches and then the room"""
+    with transaction.atomic():
+        close_rooms(Room.objects.filter(id=room.id))
+        return create_purge(MessagePurge.Type.ROOM, room_id=room.id)
+
+
+def purge_user(user):
+    """
+    Deactivate the user and delete the messages of its chat rooms in batches and then the user. The user cannot log in
+    and no messages can be sent to its chat rooms while the messages are deleted.
+    """
+    with transaction.atomic():
+        user.is_active = False
+        user.save(update_fields=['is_active'])
+        close_rooms(Room.objects.filter(Q(user_owner=user) | Q(user_receiver=user)))
+        return create_purge(MessagePurge.Type.USER, user_id=user.id)
+
+
+def purge_old_messages():
+    """
+    Delete the messages sent before the retention period (settings.CHAT_MESSAGE_RETENTION_DAYS)
+    :return: MessagePurge object or None if the retention is disabled or a retention job is not finished
+    """
+    if settings.CHAT_MESSAGE_RETENTION_DAYS <= 0:
+        return None
+    if MessagePurge.objects.filter(type=MessagePurge.Type.RETENTION).exclude(status=MessagePurge.Status.DONE).exists():
+        return None
+
+    created_before = timezone.now() - timedelta(days=settings.CHAT_MESSAGE_RETENTION_DAYS)
+    return create_purge(MessagePurge.Type.RETENTION, created_before=created_before)
+
+
+def resume_purges():
+    """
+    Run again the jobs that are not finished and were not updated in the last hour, for example because the worker
+    stopped
+    :return: Number of resumed jobs
+    """
+    updated_before = timezone.now() - timedelta(hours=1)
+    job_ids = list(
+        MessagePurge.objects.exclude(status=MessagePurge.Status.DONE).
+        filter(updated_at__lt=updated_before).values_list('id', flat=True)
+    )
+    for job_id in job_ids:
+        run_message_purge.delay(job_id)
+    return len(job_ids)
+
+
+def get_purge_messages(job):
+    """Get the messages that the job must delete"""
+    queryset = Message.objects.all()
+    if job.type == MessagePurge.Type.ROOM:
+        return queryset.filter(room_id=job.room_id)
+    if job.type == MessagePurge.Type.USER:
+        rooms = Room.objects.filter(Q(user_owner=job.user_id) | Q(user_receiver=job.user_id)).values('id')
+        return queryset.filter(room__in=rooms)
+    return queryset.filter(created_at__lt=job.created_before)
+
+
+def delete_messages(job, messages):
+    """
+    Delete a batch of messages without loading them. The search tokens of the messages and their files are deleted.
+    The chat rooms whose last message was deleted lose it with its encrypted preview, and with the retention policy the
+    newest message left becomes their last message. The deletions of the retention policy are saved so the clients
+    remove the messages when synchronizing.
+    :param job: MessagePurge object
+    :param messages: List of (id, room_id, file) of the messages
+    """
+    message_ids = [message_id for message_id, _, _ in messages]
+    MessageToken.objects.filter(message_id__in=message_ids).delete()
+    room_ids = list(Room.objects.filter(last_message_id__in=message_ids).values_list('id', flat=True))
+    if room_ids:
+        Room.objects.filter(id__in=room_ids).update(
+            last_message=None, last_message_type=None, last_message_at=None, last_message_preview=''
+        )
+    if job.type == MessagePurge.Type.RETENTION:
+        MessageDeletion.objects.bulk_create([
+            MessageDeletion(room_id=room_id, message_id=message_id) for message_id, room_id, _ in messages
+        ])
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {Message._meta.db_table} WHERE id = ANY(%s)', [message_ids])
+
+    # The rooms of the users and rooms purged are deleted, the rooms of the retention policy keep their last message
+    if room_ids and job.type == MessagePurge.Type.RETENTION:
+        update_rooms_last_message(room_ids)
+
+    files = [file for _, _, file in messages if file]
+    if files:
+        transaction.on_commit(lambda: delete_files(files))
+
+
+def update_rooms_last_message(room_ids):
+    """Save the newest message left in each chat room as its last message"""
+    for room_id in room_ids:
+        message = Message.objects.filter(room_id=room_id).order_by('-created_at', '-id').first()
+        if message is not None:
+            update_room_last_message(message, force=True)
+
+
+def delete_files(files):
+    """Delete the files of deleted messages from the storage"""
+    storage = Message._meta.get_field('file').storage
+    for file in files:
+        storage.delete(file)
+
+
+def finish_purge(job):
+    """Delete the chat room or the user of the job when its messages were deleted"""
+    if job.type == MessagePurge.Type.ROOM:
+        Room.objects.filter(id=job.room_id).delete()
+    elif job.type == MessagePurge.Type.USER:
+        User.objects.filter(id=job.user_id).delete()
+
+    job.status = MessagePurge.Status.DONE
+    job.finished_at = timezone.now()
+
+
+def purge_batch(job_id):
+    """
+    Delete the next batch of messages of the job in a transaction. If there are no messages left, the job is finished.
+    :param job_id: MessagePurge id
+    :return: MessagePurge object or None if the job is finished or is run by another worker
+    """
+    with transaction.atomic():
+        job = (
+            MessagePurge.objects.select_for_update(skip_locked=True).
+            filter(id=job_id).exclude(status=MessagePurge.Status.DONE).first()
+        )
+        if job is None:
+            return None
+
+        messages = list(
+            get_purge_messages(job).filter(id__gt=job.last_message_id).order_by('id').
+            values_list('id', 'room_id', 'file')[:settings.CHAT_PURGE_BATCH_SIZE]
+        )
+        if messages:
+            delete_messages(job, messages)
+            job.status = MessagePurge.Status.RUNNING
+            job.last_message_id = messages[-1][0]
+            job.deleted_messages += len(messages)
+        else:
+            finish_purge(job)
+        job.save()
+    return job
+
+
+def run_purge(job_id, max_batches=None):
+    """
+    Run a purge job
+    :param job_id: MessagePurge id
+    :param max_batches: Maximum number of batches to delete. By default, until the job is finished
+    :return: MessagePurge object after the last batch or None if the job is finished or is run by another worker
+    """
+    job = None
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        if batches and settings.CHAT_PURGE_BATCH_DELAY:
+            time.sleep(settings.CHAT_PURGE_BATCH_DELAY / 1000)
+
+        batch_job = purge_batch(job_id)
+        if batch_job is None:
+            break
+        job = batch_job
+        batches += 1
+        if job.status == MessagePurge.Status.DONE:
+            break
+    return job
@@ -0,0 +1,42 @@
+"""
+Blind index of the words of chat messages.
+
+The content of the messages is encrypted, so it cannot be searched in the database. When a message is saved, its words
+are normalized (lowercase and without accents) and the HMAC of each word is stored in the `MessageToken` table. The
+messages are searched by joining the HMACs of the words searched, without decrypting the other messages.
+"""
+
+import hashlib
+import hmac
+import re
+import unicodedata
+
+from django.conf import settings
+
+WORD_RE = re.compile(r'\w+')
+
+
+def normalize_text(text):
+    """Convert the text to lowercase and remove the accents"""
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def get_words(text):
+    """
+    Get the normalized words of the text, without duplicates
+    :param text: Message content or searched text
+    :return: Word list
+    """
+    words = WORD_RE.findall(normalize_text(text or ''))
+    return list(dict.fromkeys(w[:settings.CHAT_SEARCH_MAX_WORD_LENGTH] for w in words))
+
+
+def hash_word(word):
+    """Get the HMAC of a normalized word"""
+    return hmac.new(settings.CHAT_SEARCH_HASH_KEY.encode(), word.encode(), hashlib.sha256).hexdigest()
+
+
+def get_tokens(text):
+    """Get the HMACs of the words of the text"""
+    return [hash_word(word) for word in get_words(text)]
@@ -0,0 +1,59 @@
+"""
+Storage of the files of the chat messages.
+
+The files are stored under settings.CHAT_FILES_ROOT, outside MEDIA_ROOT, with random names, so they cannot be downloaded
+from the public media location. They are served by an authenticated view to the users of the chat room
+(apps.chats.api.views.messages.MessageFileViewSet).
+"""
+
+import mimetypes
+import os
+import uuid
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.http import FileResponse, HttpResponse
+from django.utils.deconstruct import deconstructible
+
+FILES_DIR = 'files'
+
+
+@deconstructible
+class ChatFileStorage(FileSystemStorage):
+    """File system storage under settings.CHAT_FILES_ROOT. The files have no public URL."""
+
+    @property
+    def base_location(self):
+        return settings.CHAT_FILES_ROOT
+
+    @property
+    def location(self):
+        return os.path.abspath(self.base_location)
+
+    def url(self, name):
+        raise ValueError('The files of the chat messages have no public URL.')
+
+
+def get_message_file_path(instance, filename):
+    """Get a random name for the file of a message. Only the extension of the original name is kept."""
+    extension = os.path.splitext(filename)[1].lower()
+    return f'{FILES_DIR}/{uuid.uuid4().hex}{extension}'
+
+
+def get_file_response(file, filename, content_type=None):
+    """
+    Get the response that downloads a file of the storage. If settings.CHAT_FILES_ACCEL_REDIRECT is set, the file is
+    sent by nginx.
+    :param file: FieldFile stored in ChatFileStorage
+    :param filename: Name of the downloaded file
+    :param content_type: Content type of the file, guessed from its name by default
+    """
+    if not settings.CHAT_FILES_ACCEL_REDIRECT:
+        return FileResponse(file.open('rb'), as_attachment=True, filename=filename, content_type=content_type)
+
+    content_type = content_type or mimetypes.guess_type(file.name)[0] or 'application/octet-stream'
+    response = HttpResponse(content_type=content_type)
+    response['X-Accel-Redirect'] = f"{settings.CHAT_FILES_ACCEL_REDIRECT.rstrip('/')}/{file.name}"
+    response['Content-Disposition'] = f"attachment; filename*=utf-8''{quote(filename)}"
+    return response
@@ -1,26 +1,208 @@
 """Chats Celery tasks"""
 
+from datetime import timedelta
+
 from django.conf import settings
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
 from celery import shared_task
 
-from apps.accounts.models import User
-from apps.chats.models import Room
-from gestion_consultas.utils import send_email
+from apps.chats.models import Message, MessageDeletion, MessagePurge, Room, RoomExport, RoomReadState
+from apps.chats.utils import get_room_counterpart
+from gestion_consultas.utils import SendEmailsError, build_email, send_emails
 
 
-@shared_task(autoretry_for=(Exception,), retry_kwargs={'max_retries': 2})
-def send_chat_message_notification(user_receiver_pk, user_owner_pk, room_name):
+@shared_task(autoretry_for=(SendEmailsError,), retry_kwargs={'max_retries': 2})
+def send_chat_digests():
     """
-    Sends an e-mail to the user receiving the chat.
-    It is used when creating the chat room.
+    Sends to each user a single e-mail with the chat rooms in which they have unread messages.
+    A room is included when its first unread message is older than settings.CHAT_DIGEST_WINDOW minutes, once per
+    unread period, so the rooms read in the meantime are skipped. The e-mails of settings.CHAT_DIGEST_BATCH_SIZE users
+    are sent over a single connection. If an e-mail cannot be sent, the rooms of the users not notified are pending
+    again and the task is retried.
+    :return: Number of e-mails sent
     """
-    users = User.objects.filter(pk__in=[user_receiver_pk, user_owner_pk])
-    room = Room.objects.get(name=room_name)
-    user_receiver = users[0]
+    pending = (
+        RoomReadState.objects.
+        filter(unread_count__gt=0, unread_since__lte=timezone.now() - timedelta(minutes=settings.CHAT_DIGEST_WINDOW)).
+        filter(Q(notified_at__isnull=True) | Q(notified_at__lt=F('unread_since'))).
+        filter(user__is_active=True, user__email__isnull=False).exclude(user__email='')
+    )
+
+    sent = 0
+    while True:
+        user_ids = list(
+            pending.order_by('user_id').values_list('user_id', flat=True).distinct()[:settings.CHAT_DIGEST_BATCH_SIZE]
+        )
+        if not user_ids:
+            break
+
+        # The rooms are claimed before sending the e-mails, so the locks are not kept while sending
+        with transaction.atomic():
+            states = list(
+                pending.filter(user_id__in=user_ids).select_for_update(skip_locked=True, of=('self',)).
+                select_related('user', 'room__user_owner', 'room__user_receiver').order_by('user_id', 'room_id')
+            )
+            if not states:
+                break
+            RoomReadState.objects.filter(pk__in=[state.pk for state in states]).update(notified_at=timezone.now())
+
+        rooms = {}
+        for state in states:
+            rooms.setdefault(state.user, []).append(state)
+
+        try:
+            sent += send_emails([
+                build_email(
+                    user.email, 'accounts/email/chat_digest_notification', get_digest_context(user, user_states)
+                )
+                for user, user_states in rooms.items()
+            ])
+        except SendEmailsError as e:
+            # The claim of the rooms of the users whose e-mail was not sent is undone
+            unsent_states = [state for user_states in list(rooms.values())[e.sent:] for state in user_states]
+            RoomReadState.objects.bulk_update(unsent_states, ['notified_at'])
+            raise
+    return sent
+
 
-    context = {
-        'user': user_receiver,
-        'user_owner': users[1],
-        'chat_url': f'{settings.CLIENT_DOMAIN}/chat/{room.name}'
+def get_digest_context(user, states):
+    """
+    Get the context of the digest e-mail of the user
+    :param user: User object
+    :param states: RoomReadState objects of the rooms with unread messages of the user
+    """
+    rooms = [
+        {
+            'user': get_room_counterpart(state.room, user),
+            'unread_count': state.unread_count,
+            'chat_url': f'{settings.CLIENT_DOMAIN}/chat/{state.room.name}',
+        }
+        for state in states
+    ]
+    return {
+        'user': user,
+        'rooms': rooms,
+        'unread_count': sum(room['unread_count'] for room in rooms),
     }
-    send_email(user_receiver.email, 'accounts/email/chat_message_notification', context)
+
+
+@shared_task
+def create_message_partitions():
+    """Create the partitions of the messages of the next months"""
+    call_command('create_message_partitions')
+
+
+@shared_task
+def archive_inactive_rooms():
+    """
+    Move the messages of the chat rooms without recent messages to the archive partition of the messages.
+    The rooms are archived in batches of settings.CHAT_ARCHIVE_BATCH_SIZE rooms.
+    :return: Number of archived messages
+    """
+    inactive_since = timezone.now() - timedelta(days=settings.CHAT_ARCHIVE_ROOMS_AFTER_DAYS)
+    rooms = (
+        Room.objects.filter(last_message_at__lt=inactive_since).
+        filter(Exists(Message.objects.filter(room=OuterRef('pk'), archived=False))).
+        order_by('id').values_list('id', flat=True)
+    )
+
+    archived = 0
+    last_id = 0
+    while True:
+        room_ids = list(rooms.filter(id__gt=last_id)[:settings.CHAT_ARCHIVE_BATCH_SIZE])
+        if not room_ids:
+            break
+
+        with transaction.atomic():
+            archived += Message.objects.filter(room_id__in=room_ids, archived=False).update(archived=True)
+        last_id = room_ids[-1]
+    return archived
+
+
+@shared_task
+def delete_message_deletions():
+    """
+    Delete the records of the messages deleted more than settings.CHAT_SYNC_WINDOW days ago. The clients whose last
+    synchronization is older get the history again (sync command).
+    :return: Number of deleted records
+    """
+    deleted_before = timezone.now() - timedelta(days=settings.CHAT_SYNC_WINDOW)
+    return MessageDeletion.objects.filter(deleted_at__lt=deleted_before).delete()[0]
+
+
+@shared_task
+def delete_expired_uploads():
+    """
+    Delete the file uploads of the messages not updated in the last settings.CHAT_UPLOAD_EXPIRATION hours
+    :return: Number of deleted uploads
+    """
+    from apps.chats.uploads import delete_expired_uploads as delete_uploads
+
+    return delete_uploads()
+
+
+@shared_task
+def run_message_purge(job_id):
+    """
+    Delete the messages of a purge job in batches (apps.chats.purge). Each task deletes up to
+    settings.CHAT_PURGE_BATCHES_PER_TASK batches and queues the job again if it is not finished.
+    """
+    from apps.chats.purge import run_purge
+
+    job = run_purge(job_id, settings.CHAT_PURGE_BATCHES_PER_TASK)
+    if job is not None and job.status != MessagePurge.Status.DONE:
+        run_message_purge.delay(job_id)
+
+
+@shared_task
+def purge_old_messages():
+    """
+    Delete the messages older than the retention period and resume the purge jobs that stopped
+    :return: Id of the retention job or None if it was not created
+    """
+    from apps.chats.purge import purge_old_messages as purge_messages, resume_purges
+
+    resume_purges()
+    job = purge_messages()
+    return job.id if job is not None else None
+
+
+@shared_task(soft_time_limit=settings.CHAT_EXPORT_TIME_LIMIT, time_limit=settings.CHAT_EXPORT_TIME_LIMIT + 60)
+def export_room(export_id):
+    """
+    Write the file of the export of a chat room (apps.chats.export)
+    :return: Status of the export
+    """
+    from apps.chats.export import write_export
+
+    updated = RoomExport.objects.filter(pk=export_id, status=RoomExport.Status.PENDING).update(
+        status=RoomExport.Status.RUNNING
+    )
+    if not updated:
+        return None
+
+    export = RoomExport.objects.select_related('room').get(pk=export_id)
+    try:
+        write_export(export)
+        export.status = RoomExport.Status.DONE
+    except Exception:
+        export.status = RoomExport.Status.FAILED
+        raise
+    finally:
+        export.finished_at = timezone.now()
+        export.save(update_fields=['file', 'status', 'finished_at'])
+    return export.status
+
+
+@shared_task
+def delete_expired_exports():
+    """
+    Delete the exports of the chat rooms requested more than settings.CHAT_EXPORT_EXPIRATION hours ago
+    :return: Number of deleted exports
+    """
+    from apps.chats.export import delete_expired_exports as delete_exports
+
+    return delete_exports()
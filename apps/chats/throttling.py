@@ -0,0 +1,85 @@
+"""
+Rate limiting of the commands of the chat websocket.
+
+Each connection and each user have a token bucket. A command consumes a token of both buckets, and only if both have a
+token, so a rejected command does not consume tokens. The buckets are refilled at `rate` tokens per second up to `burst`
+tokens (settings.CHAT_CONNECTION_RATE_LIMIT and CHAT_USER_RATE_LIMIT). The buckets of the users are shared by all the
+connections of the user in the process.
+"""
+
+import math
+import time
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second up to `capacity` tokens"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def has_tokens(self, tokens=1):
+        """There are enough tokens to consume"""
+        self.refill()
+        return self.tokens >= tokens
+
+    def consume(self, tokens=1):
+        """
+        Consume tokens if there are enough
+        :return: True if the tokens were consumed
+        """
+        if not self.has_tokens(tokens):
+            return False
+        self.tokens -= tokens
+        return True
+
+    def retry_after(self, tokens=1):
+        """Seconds until there are enough tokens. math.inf if the bucket is not refilled (rate 0)."""
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate if self.rate > 0 else math.inf
+
+
+def consume_all(buckets, tokens=1):
+    """
+    Consume tokens of all the buckets, only if all of them have enough tokens
+    :return: True if the tokens were consumed
+    """
+    if not all(bucket.has_tokens(tokens) for bucket in buckets):
+        return False
+    for bucket in buckets:
+        bucket.tokens -= tokens
+    return True
+
+
+class UserBuckets:
+    """Token buckets of the users with open connections. The bucket is removed when the last connection closes."""
+
+    def __init__(self):
+        self.buckets = {}
+
+    def acquire(self, user_id, rate, capacity):
+        """Get the bucket of the user for a new connection"""
+        bucket, connections = self.buckets.get(user_id, (None, 0))
+        if bucket is None:
+            bucket = TokenBucket(rate, capacity)
+        self.buckets[user_id] = (bucket, connections + 1)
+        return bucket
+
+    def release(self, user_id):
+        """Release the bucket of the user when a connection closes"""
+        bucket, connections = self.buckets.get(user_id, (None, 0))
+        if connections <= 1:
+            self.buckets.pop(user_id, None)
+        else:
+            self.buckets[user_id] = (bucket, connections - 1)
+
+
+user_buckets = UserBuckets()
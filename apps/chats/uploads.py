@@ -0,0 +1,309 @@
+"""
+Resumable chunked uploads of the files of chat messages (audio, file, image and video messages).
+
+The client starts the upload with the type, name, size and SHA-256 checksum of the file (`upload_start` command) and
+sends the file in chunks of at most settings.CHAT_UPLOAD_CHUNK_SIZE bytes, each one with its offset and SHA-256 checksum
+(`upload_chunk` command). Each chunk is written at its offset in a partial file under CHAT_FILES_ROOT/uploads as soon as
+it is received, so the file is never kept in memory. The offset of each chunk is claimed in the database before writing
+it, so two connections never write at the same offset. If the connection is lost, the client gets the offset of the
+upload with `upload_start` and its `upload_id` and continues from there. When the whole file was received
+(`upload_commit` command), its checksum is always verified, the partial file is moved to the storage and the message is
+created.
+
+The file IO functions do not use the database, so they can run outside the database thread of the consumer.
+"""
+
+import base64
+import binascii
+import hashlib
+import os
+import uuid
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from apps.chats.models import Message, MessageUpload
+from apps.chats.utils import save_chat_message
+
+UPLOADS_DIR = 'uploads'
+
+UPLOAD_TYPES = (Message.Type.AUDIO, Message.Type.FILE, Message.Type.IMAGE, Message.Type.VIDEO)
+
+# Size of the blocks read to compute the checksum of the file
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class UploadOffsetError(ValueError):
+    """The offset of the chunk is not the offset of the upload. The client must resume from `offset`."""
+
+    def __init__(self, offset):
+        super().__init__('El offset del fragmento es inválido.')
+        self.offset = offset
+
+
+class PartialFile(File):
+    """
+    Partial file of an upload. The storage moves it instead of copying it, like the uploaded files saved in a
+    temporary file.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def get_upload_path(upload_id):
+    """Get the path of the partial file of the upload"""
+    return os.path.join(settings.CHAT_FILES_ROOT, UPLOADS_DIR, f'{upload_id}.part')
+
+
+def parse_upload_id(upload_id):
+    """
+    Converts the upload id sent by the client into a UUID
+    :raises ValueError: If the id is invalid
+    """
+    try:
+        return uuid.UUID(str(upload_id))
+    except ValueError:
+        raise ValueError('La carga es inválida.')
+
+
+def parse_upload_offset(offset):
+    """
+    Converts the offset of a chunk sent by the client into an integer
+    :raises ValueError: If the offset is not an integer greater than or equal to 0
+    """
+    if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+        raise ValueError('El offset del fragmento es inválido.')
+    return offset
+
+
+def parse_checksum(checksum):
+    """
+    Validate the SHA-256 checksum sent by the client
+    :param checksum: Hexadecimal checksum
+    :raises ValueError: If the checksum is invalid or was not sent
+    :return: Checksum in lowercase
+    """
+    try:
+        if len(checksum) != 64:
+            raise ValueError
+        bytes.fromhex(checksum)
+    except (TypeError, ValueError):
+        raise ValueError('El checksum es inválido.')
+    return checksum.lower()
+
+
+def parse_chunk_data(data):
+    """
+    Get the bytes of a chunk. The chunks are sent as bytes with the binary protocol and in base64 with JSON.
+    :raises ValueError: If the chunk is invalid
+    """
+    if isinstance(data, bytes):
+        return data
+
+    try:
+        return base64.b64decode(data, validate=True)
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('El fragmento es inválido.')
+
+
+def validate_upload(data):
+    """
+    Validate the file of a new upload
+    :param data: Client JSON object with the `type`, `name`, `size` and `checksum` of the file
+    :raises ValueError: If the file is invalid
+    :return: Dict with the fields of the upload
+    """
+    file_type = data.get('type')
+    if file_type not in UPLOAD_TYPES:
+        raise ValueError('El tipo de mensaje es inválido.')
+
+    name = data.get('name')
+    if not isinstance(name, str) or not os.path.basename(name).strip():
+        raise ValueError('El nombre del archivo es inválido.')
+    name = os.path.basename(name).strip()[:MessageUpload._meta.get_field('name').max_length]
+
+    extension = os.path.splitext(name)[1][1:].lower()
+    if extension not in settings.CHAT_UPLOAD_EXTENSIONS[file_type]:
+        raise ValueError('La extensión del archivo no está permitida.')
+
+    size = data.get('size')
+    if not isinstance(size, int) or isinstance(size, bool) or size < 1:
+        raise ValueError('El tamaño del archivo es inválido.')
+    if size > settings.CHAT_UPLOAD_MAX_SIZE:
+        raise ValueError('El archivo supera el tamaño máximo permitido.')
+
+    return {
+        'type': file_type,
+        'name': name,
+        'size': size,
+        'checksum': parse_checksum(data.get('checksum')),
+    }
+
+
+@database_sync_to_async
+def create_upload(room, user, fields):
+    """
+    Start an upload and create its empty partial file
+    :param room: Room object
+    :param user: User sending the file
+    :param fields: Fields of the upload (validate_upload)
+    :return: MessageUpload object
+    """
+    upload = MessageUpload.objects.create(room=room, user=user, **fields)
+    path = get_upload_path(upload.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return upload
+
+
+@database_sync_to_async
+def get_upload(upload_id, room, user):
+    """Get an upload of the user in the chat room. None if it does not exist."""
+    return MessageUpload.objects.filter(id=upload_id, room=room, user=user).first()
+
+
+def validate_upload_chunk(upload, offset, data, checksum):
+    """
+    Validate a chunk of the upload before writing it
+    :param upload: MessageUpload object
+    :param offset: Offset of the chunk in the file
+    :param data: Bytes of the chunk
+    :param checksum: SHA-256 checksum of the chunk
+    :raises UploadOffsetError: If the offset is not the offset of the upload
+    :raises ValueError: If the chunk is invalid
+    """
+    if offset != upload.offset:
+        raise UploadOffsetError(upload.offset)
+    if not data or len(data) > settings.CHAT_UPLOAD_CHUNK_SIZE or offset + len(data) > upload.size:
+        raise ValueError('El tamaño del fragmento es inválido.')
+    if hashlib.sha256(data).hexdigest() != checksum:
+        raise ValueError('El checksum del fragmento no coincide.')
+
+
+@database_sync_to_async
+def claim_upload_chunk(upload, length):
+    """
+    Claim the offset of the upload before writing a chunk, so two connections never write a chunk at the same offset.
+    The offset is only updated if no other chunk was claimed at the same offset.
+    :param upload: MessageUpload object
+    :param length: Length of the chunk
+    :return: True if the offset was updated
+    """
+    updated = MessageUpload.objects.filter(id=upload.id, offset=upload.offset).update(
+        offset=upload.offset + length, updated_at=timezone.now()
+    )
+    if updated:
+        upload.offset += length
+    return bool(updated)
+
+
+@database_sync_to_async
+def release_upload_chunk(upload, offset, length):
+    """
+    Undo the claim of a chunk that could not be written. If a next chunk was already claimed the claim is not undone;
+    the file then has a gap and its checksum does not match when the upload is committed.
+    :param upload: MessageUpload object
+    :param offset: Offset of the chunk
+    :param length: Length of the chunk
+    """
+    updated = MessageUpload.objects.filter(id=upload.id, offset=offset + length).update(
+        offset=offset, updated_at=timezone.now()
+    )
+    if updated:
+        upload.offset = offset
+
+
+def write_upload_chunk(upload, offset, data):
+    """
+    Write a chunk at its offset in the partial file of the upload. It does not use the database.
+    :param upload: MessageUpload object
+    :param offset: Offset of the chunk in the file
+    :param data: Bytes of the chunk
+    :raises ValueError: If the upload does not exist
+    """
+    try:
+        fd = os.open(get_upload_path(upload.id), os.O_WRONLY)
+    except FileNotFoundError:
+        raise ValueError('La carga no existe.')
+    try:
+        os.pwrite(fd, data, offset)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def store_upload_file(upload):
+    """
+    Verify the checksum of the received file and move it to the storage of the message files. It does not use the
+    database.
+    :param upload: MessageUpload object
+    :raises ValueError: If the file is incomplete or its checksum does not match
+    :return: Name of the file in the storage
+    """
+    if upload.offset != upload.size:
+        raise ValueError('El archivo está incompleto.')
+
+    path = get_upload_path(upload.id)
+    try:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256()
+            for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+                digest.update(block)
+            if digest.hexdigest() != upload.checksum:
+                raise ValueError('El checksum del archivo no coincide.')
+            f.seek(0)
+
+            field = Message._meta.get_field('file')
+            name = field.generate_filename(None, upload.name)
+            name = field.storage.save(name, PartialFile(f, name=name), max_length=field.max_length)
+    except FileNotFoundError:
+        raise ValueError('La carga no existe.')
+
+    # The storages that do not move the file copy it
+    if os.path.exists(path):
+        os.remove(path)
+    return name
+
+
+@database_sync_to_async
+def create_upload_message(upload, room, user, file_name):
+    """
+    Create the message of a committed upload and delete the upload
+    :param upload: MessageUpload object
+    :param room: Room object
+    :param user: User sending the file
+    :param file_name: Name of the file in the storage
+    :return: Message object or None if the upload was already committed
+    """
+    storage = Message._meta.get_field('file').storage
+    try:
+        with transaction.atomic():
+            deleted, _ = MessageUpload.objects.filter(id=upload.id).delete()
+            message = save_chat_message(room, user, upload.name, type=upload.type, file=file_name) if deleted else None
+    except Exception:
+        storage.delete(file_name)
+        raise
+
+    if message is None:
+        storage.delete(file_name)
+    return message
+
+
+def delete_expired_uploads():
+    """
+    Delete the uploads not updated in the last settings.CHAT_UPLOAD_EXPIRATION hours and their partial files
+    :return: Number of deleted uploads
+    """
+    expired_at = timezone.now() - timedelta(hours=settings.CHAT_UPLOAD_EXPIRATION)
+    upload_ids = list(MessageUpload.objects.filter(updated_at__lt=expired_at).values_list('id', flat=True))
+    for upload_id in upload_ids:
+        path = get_upload_path(upload_id)
+        if os.path.exists(path):
+            os.remove(path)
+    MessageUpload.objects.filter(id__in=upload_ids).delete()
+    return len(upload_ids)
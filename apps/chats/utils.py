@@ -1,34 +1,352 @@
 """Chats utilities"""
 
+from collections import OrderedDict
+
+import msgpack
+import orjson
 from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.db.models import DateTimeField, F, Q, Value
+from django.db.models.functions import Coalesce
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from apps.accounts.models import User
-from apps.chats.models import Room, Message
-from apps.chats.tasks import send_chat_message_notification
+from apps.chats.encryption import cache_message_content
+from apps.chats.models import Room, Message, MessageDeletion, RoomReadState
 
 
-@database_sync_to_async
-def create_chat_message(data, user):
-    """Create a new message in DB"""
-    user_receiver = User.objects.get(username=data['user_receiver'])
-    room = Room.objects.filter(name=data['room_name']).first()
+def get_or_create_room(data, user):
+    """
+    Get the chat room. If it does not exist, it is created. The user receiver is notified of the new messages by the
+    chat digest e-mails (send_chat_digests task).
+    :param data: Client JSON object with the `room_name` and `user_receiver` fields
+    :param user: User sending the message
+    :raises PermissionDenied: If the room exists and the user does not participate in it
+    :return: Room object
+    """
+    room = Room.objects.select_related('user_owner', 'user_receiver').filter(name=data['room_name']).first()
+    if room is not None and not is_room_member(room, user):
+        raise PermissionDenied('The user does not participate in the chat room.')
     if room is None:
+        user_receiver = User.objects.get(username=data['user_receiver'])
         room = Room.objects.create(
             name=data['room_name'],
             user_owner=user,
             user_receiver=user_receiver
         )
 
-        if user_receiver.email:
-            send_chat_message_notification.delay(user_receiver.id, user.id, room.name)
+    return room
+
+
+@database_sync_to_async
+def get_room(room_name):
+    """Get the chat room with its users. None if the room does not exist."""
+    return Room.objects.select_related('user_owner', 'user_receiver').filter(name=room_name).first()
+
+
+def is_room_member(room, user):
+    """The user participates in the chat room"""
+    return user.id in (room.user_owner_id, room.user_receiver_id)
+
+
+def get_room_counterpart(room, user):
+    """Get the user with whom the user shares the chat room"""
+    return room.user_receiver if room.user_owner_id == user.id else room.user_owner
+
+
+def get_room_counterpart_id(room, user_id):
+    """Get the id of the user with whom the user shares the chat room"""
+    return room.user_receiver_id if room.user_owner_id == user_id else room.user_owner_id
+
+
+@database_sync_to_async
+def create_chat_message(data, user, room=None):
+    """
+    Create a new message in DB
+    :param data: Client JSON object to create message
+    :param user: User sending the message
+    :param room: Chat room already resolved. If it is not given, the room is obtained or created.
+    :return: Message object
+    """
+    if room is None:
+        room = get_or_create_room(data, user)
+    return save_chat_message(room, user, data['content'])
+
+
+def save_chat_message(room, user, content, **kwargs):
+    """
+    Save a new message of the chat room and update the last message and the unread messages counter of the room
+    :param room: Room object
+    :param user: User sending the message
+    :param content: Message content
+    :param kwargs: Other fields of the message
+    :raises ValueError: If the chat room is being deleted
+    :return: Message object
+    """
+    with transaction.atomic():
+        if lock_rooms([room.id]):
+            raise ValueError('El chat está siendo eliminado.')
+        message = Message.objects.create(room=room, user=user, content=content, **kwargs)
+        update_room_last_message(message)
+        increment_unread_count(room.id, get_room_counterpart_id(room, user.id))
+    cache_message_content(message)
+    return message
+
+
+def lock_rooms(room_ids):
+    """
+    Lock the chat rooms in which messages are saved, so they cannot be marked as being deleted (apps.chats.purge) until
+    the messages are saved. The rooms are locked in the order of their ids.
+    :param room_ids: Room ids
+    :return: Ids of the rooms being deleted, in which no messages can be saved
+    """
+    rooms = Room.objects.select_for_update().filter(id__in=room_ids).order_by('id').values_list('id', 'is_deleting')
+    return {room_id for room_id, is_deleting in rooms if is_deleting}
+
+
+def get_message_preview(message):
+    """Get the content of the message truncated to settings.CHAT_LAST_MESSAGE_PREVIEW_LENGTH characters"""
+    return message.content[:settings.CHAT_LAST_MESSAGE_PREVIEW_LENGTH]
+
 
-    return Message.objects.create(room=room, user=user, content=data['content'])
+def update_room_last_message(message, force=False):
+    """
+    Saves the last message in the chat room. The room is only updated if the message is newer than the current last
+    message of the room.
+    :param message: Message object
+    :param force: Update the room even if the message is older than the current last message
+    :return: Number of updated rooms
+    """
+    queryset = Room.objects.filter(pk=message.room_id)
+    if not force:
+        queryset = queryset.filter(Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.created_at))
+
+    return queryset.update(
+        last_message=message,
+        last_message_type=message.type,
+        last_message_at=message.created_at,
+        last_message_preview=get_message_preview(message)
+    )
+
+
+def increment_unread_count(room_id, user_id, count=1):
+    """
+    Increment the unread messages counter of the user in the chat room and save the date of the first unread message.
+    The read state is created if it does not exist.
+    :param room_id: Room id
+    :param user_id: Id of the user receiving the messages
+    :param count: Number of new messages
+    """
+    now = timezone.now()
+    changes = {
+        'unread_count': F('unread_count') + count,
+        'unread_since': Coalesce(F('unread_since'), Value(now, output_field=DateTimeField())),
+    }
+    queryset = RoomReadState.objects.filter(room_id=room_id, user_id=user_id)
+    if queryset.update(**changes):
+        return
+
+    _, created = RoomReadState.objects.get_or_create(
+        room_id=room_id, user_id=user_id, defaults={'unread_count': count, 'unread_since': now}
+    )
+    if not created:
+        queryset.update(**changes)
+
+
+def increment_unread_counts(messages):
+    """
+    Increment the unread messages counters of the users receiving the messages
+    :param messages: Message list
+    """
+    counts = {}
+    for message in messages:
+        key = (message.room_id, message.user_id)
+        counts[key] = counts.get(key, 0) + 1
+
+    rooms = Room.objects.only('user_owner_id', 'user_receiver_id').in_bulk({room_id for room_id, _ in counts})
+    for (room_id, user_id), count in counts.items():
+        room = rooms.get(room_id)
+        if room is not None:
+            increment_unread_count(room_id, get_room_counterpart_id(room, user_id), count)
 
 
 @database_sync_to_async
-def get_messages(room_name):
-    """Get chat room messages"""
-    return list(Message.objects.select_related('user').order_by('created_at').filter(room__name=room_name))
+def mark_room_read(room, user, message_id=None):
+    """
+    Mark the messages of the chat room as read by the user until a message. The unread messages counter is set to
+    the number of messages of the other user sent after that message.
+
+    The read state is locked before counting the messages, so the counter is not incremented (increment_unread_count)
+    between the count and the update: a message saved meanwhile is either counted or increments the counter after the
+    update.
+    :param room: Room object
+    :param user: User reading the messages
+    :param message_id: Id of the last message read. If it is not given, all the messages are read
+    :return: RoomReadState object or None if the message does not exist
+    """
+    messages = Message.objects.filter(room=room)
+    if message_id is None:
+        cursor = messages.order_by('-created_at', '-id').values_list('created_at', 'id').first()
+    else:
+        cursor = messages.filter(id=message_id).values_list('created_at', 'id').first()
+    if cursor is None and message_id is not None:
+        return None
+
+    with transaction.atomic():
+        RoomReadState.objects.get_or_create(room=room, user=user)
+        state = RoomReadState.objects.select_for_update().get(room=room, user=user)
+
+        state.unread_count = 0
+        if cursor is not None:
+            message_id = cursor[1]
+            state.unread_count = messages.exclude(user=user).sent_after(cursor).count()
+        state.last_read_message_id = message_id
+        if state.unread_count == 0:
+            state.unread_since = None
+        state.save(update_fields=['last_read_message_id', 'unread_count', 'unread_since', 'updated_at'])
+    return state
+
+
+@database_sync_to_async
+def get_messages(room_name, page_size, after=None, before=None):
+    """
+    Get a page of chat room messages using a keyset query on (room, created_at, id)
+    :param room_name: Room name
+    :param page_size: Maximum number of messages to get
+    :param after: Cursor (created_at, id). Only messages sent after the cursor are obtained
+    :param before: Cursor (created_at, id). Only messages sent before the cursor are obtained
+    :return: Message list. Sorted from newest to oldest if only the `before` cursor is given, otherwise sorted from
+        oldest to newest
+    """
+    queryset = Message.objects.with_decrypted_content().select_related('user').filter(room__name=room_name)
+    if after is not None:
+        queryset = queryset.sent_after(after)
+
+    if before is not None:
+        created_at, pk = before
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+    if before is not None and after is None:
+        return list(queryset.order_by('-created_at', '-id')[:page_size])
+    return list(queryset.order_by('created_at', 'id')[:page_size])
+
+
+@database_sync_to_async
+def get_message_cursor(room, message_id):
+    """
+    Get the cursor (created_at, id) of a message of the chat room
+    :return: Cursor or None if the message does not exist
+    """
+    message = Message.objects.filter(room=room, id=message_id).values_list('created_at', 'id').first()
+    return tuple(message) if message is not None else None
+
+
+@database_sync_to_async
+def get_message_changes(room, cursor, since, max_size):
+    """
+    Get the messages updated and deleted since a date, sent until the cursor
+    :param room: Room object
+    :param cursor: Cursor (created_at, id) of the last message of the client
+    :param since: Date of the last synchronization
+    :param max_size: Maximum number of changes. Up to `max_size` + 1 changes are obtained to know if there are more
+    :return: Updated message list and deleted message id list
+    """
+    created_at, pk = cursor
+    updated = list(
+        Message.objects.with_decrypted_content().select_related('user').
+        filter(room=room, updated_at__gt=since).
+        filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lte=pk)).
+        order_by('updated_at', 'id')[:max_size + 1]
+    )
+    deleted = list(
+        MessageDeletion.objects.filter(room_id=room.id, deleted_at__gt=since).
+        order_by('deleted_at').values_list('message_id', flat=True)[:max_size + 1]
+    )
+    return updated, deleted
+
+
+def parse_message_cursor(cursor):
+    """
+    Converts the cursor sent by the client into a (created_at, id) tuple
+    :param cursor: Object with the `id` and `created_at` of a message
+    :raises ValueError: If the cursor is invalid
+    :return: Cursor tuple or None if no cursor was sent
+    """
+    if cursor is None:
+        return None
+
+    try:
+        created_at = parse_datetime_value(cursor['created_at'])
+        pk = int(cursor['id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('El cursor es inválido.')
+    return created_at, pk
+
+
+def parse_datetime_value(value):
+    """
+    Converts a date sent by the client in ISO format into an aware datetime
+    :param value: Date string
+    :raises ValueError: If the date is invalid
+    """
+    try:
+        value = parse_datetime(value)
+    except (TypeError, ValueError):
+        value = None
+
+    if value is None:
+        raise ValueError('La fecha es inválida.')
+
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+def parse_positive_integer(value, error_message):
+    """
+    Converts the value sent by the client into a positive integer
+    :param value: Value sent by the client
+    :param error_message: Message of the error raised if the value is invalid
+    :raises ValueError: If the value is not a positive integer
+    """
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(error_message)
+
+    if value < 1:
+        raise ValueError(error_message)
+    return value
+
+
+def parse_page_size(page_size):
+    """
+    Get the number of messages per frame of the chat history
+    :param page_size: Page size sent by the client
+    :raises ValueError: If the page size is invalid
+    :return: Page size between 1 and settings.CHAT_MESSAGES_MAX_PAGE_SIZE
+    """
+    if page_size is None:
+        return settings.CHAT_MESSAGES_PAGE_SIZE
+
+    page_size = parse_positive_integer(page_size, 'El tamaño de página es inválido.')
+    return min(page_size, settings.CHAT_MESSAGES_MAX_PAGE_SIZE)
+
+
+def message_to_cursor(message):
+    """
+    Get the cursor of a message
+    :param message: Message object
+    :return: Cursor in JSON format
+    """
+    return {
+        'id': message.id,
+        'created_at': message.created_at.isoformat(),
+    }
 
 
 def messages_to_json(messages):
@@ -40,6 +358,16 @@ def messages_to_json(messages):
     return [message_to_json(message) for message in messages]
 
 
+def get_message_file_url(message):
+    """
+    Get the URL to download the file of the message. The file is only served to the users of the chat room, and the
+    URL does not contain the name of the file.
+    :param message: Message object
+    :return: URL or None if the message has no file
+    """
+    return reverse('messages-file-list', kwargs={'pk': message.id}) if message.file else None
+
+
 def message_to_json(message):
     """
     Converts a message object to JSON format
@@ -52,6 +380,67 @@ def message_to_json(message):
         'user': message.user.username,
         'type': message.type,
         'content': message.content,
-        'created_at': str(message.created_at),
-        'updated_at': str(message.updated_at),
+        'file': get_message_file_url(message),
+        'created_at': message.created_at.isoformat(),
+        'updated_at': message.updated_at.isoformat(),
     }
+
+
+def encode_frame(content):
+    """
+    Encode a frame to be sent through the WebSocket
+    :param content: Frame content
+    :return: Frame in JSON format
+    """
+    return orjson.dumps(content).decode()
+
+
+def encode_binary_frame(content):
+    """
+    Encode a frame to be sent through the WebSocket with the binary protocol
+    :param content: Frame content
+    :return: Frame in MessagePack format
+    """
+    return msgpack.packb(content)
+
+
+# Number of frames broadcast to the chat rooms whose encodings are kept in the process
+ENCODED_FRAMES_SIZE = 256
+_encoded_frames = OrderedDict()
+
+
+def encode_broadcast_frame(frame_id, content, binary=False):
+    """
+    Encode a frame broadcast to a chat room with the protocol of a connection. The encoded frames are kept by frame id,
+    so each frame is encoded once per process for all the connections of the room using the same protocol, and only
+    with the protocols that the connections use.
+    :param frame_id: Id of the broadcast frame
+    :param content: Frame content
+    :param binary: The connection uses the binary protocol
+    :return: Frame in MessagePack format (binary protocol) or JSON
+    """
+    key = (frame_id, binary)
+    data = _encoded_frames.get(key)
+    if data is None:
+        data = encode_binary_frame(content) if binary else encode_frame(content)
+        _encoded_frames[key] = data
+        while len(_encoded_frames) > ENCODED_FRAMES_SIZE:
+            _encoded_frames.popitem(last=False)
+    return data
+
+
+def decode_frame(text_data=None, bytes_data=None, binary=False):
+    """
+    Decode a frame received from the WebSocket
+    :param text_data: Frame in JSON format
+    :param bytes_data: Frame in MessagePack format (binary protocol) or JSON
+    :param binary: The connection uses the binary protocol
+    :raises ValueError: If the frame cannot be decoded
+    :return: Frame content
+    """
+    try:
+        if bytes_data is not None and binary:
+            return msgpack.unpackb(bytes_data)
+        return orjson.loads(text_data if text_data is not None else bytes_data)
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise ValueError('La trama es inválida.') from e
@@ -0,0 +1,407 @@
+"""
+Write-behind persistence of chat messages.
+
+When settings.CHAT_WRITE_BEHIND is enabled, the consumer assigns the message id and broadcasts the message before it is
+saved. The messages are queued in the process and saved with `bulk_create` every CHAT_WRITE_BEHIND_FLUSH_INTERVAL
+milliseconds or when CHAT_WRITE_BEHIND_BATCH_SIZE messages are queued.
+
+Durability (settings.CHAT_WRITE_BEHIND_DURABILITY):
+    memory: the queued messages are only kept in the memory of the process. If a batch cannot be saved it is queued
+        again, but the messages not yet saved are lost if the process stops.
+    redis: before being broadcast, each message is added (encrypted) to the journal of the process in Redis and
+        removed when it is saved. Each process keeps a heartbeat key that expires after
+        CHAT_WRITE_BEHIND_OWNER_TIMEOUT seconds; the journals of the processes without heartbeat are moved atomically
+        to the journal of a running process and saved by it. Messages are saved at least once; duplicates are ignored
+        because the id is assigned before saving.
+
+If a batch cannot be saved, its messages are saved one by one. The messages that cannot be saved because of their data
+(for example, their chat room was deleted) are logged and removed from the queue, and with `redis` durability they are
+moved from the journal to a dead-letter hash, so they do not block the other messages. If the database is unavailable,
+the messages are queued again.
+
+The queue is stopped, saving the queued messages, when the ASGI server shuts down (gestion_consultas.lifespan).
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+
+import redis
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from apps.chats.models import Message, MessageToken
+from apps.chats.utils import get_or_create_room, increment_unread_counts, lock_rooms, update_room_last_message
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_KEY = 'chats:write_behind:journal'
+OWNERS_KEY = 'chats:write_behind:owners'
+HEARTBEAT_KEY = 'chats:write_behind:heartbeat'
+DEAD_LETTER_KEY = 'chats:write_behind:dead_letter'
+
+# Moves the journals of the processes without heartbeat to the journal of this process and returns their entries.
+# KEYS: owners set, journal of this process. ARGV: journal key prefix, heartbeat key prefix, owner of this process.
+RECOVER_SCRIPT = """
+local entries = {}
+for _, owner in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    if owner ~= ARGV[3] and redis.call('EXISTS', ARGV[2] .. owner) == 0 then
+        local journal = redis.call('HGETALL', ARGV[1] .. owner)
+        for i = 1, #journal, 2 do
+            redis.call('HSET', KEYS[2], journal[i], journal[i + 1])
+            table.insert(entries, journal[i + 1])
+        end
+        redis.call('DEL', ARGV[1] .. owner)
+        redis.call('SREM', KEYS[1], owner)
+    end
+end
+return entries
+"""
+
+
+def reserve_message_ids(count):
+    """
+    Get ids for new messages from the sequence of the message table
+    :param count: Number of ids
+    :return: Id list
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            [Message._meta.db_table, count]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def save_messages(messages):
+    """
+    Save the messages in the database with their search tokens and update the last message and the unread messages
+    counters of their chat rooms. Messages that were already saved, and messages of chat rooms being deleted, are
+    ignored.
+    :param messages: Message list with the id assigned
+    """
+    with transaction.atomic():
+        deleting = lock_rooms({message.room_id for message in messages})
+        if deleting:
+            logger.warning('Discarded the chat messages of the rooms being deleted %s.', sorted(deleting))
+            messages = [message for message in messages if message.room_id not in deleting]
+        inserted = insert_messages(messages)
+        new_messages = [m for m in messages if m.id in inserted]
+
+        last_messages = {}
+        for message in new_messages:
+            last = last_messages.get(message.room_id)
+            if last is None or (last.created_at, last.id) < (message.created_at, message.id):
+                last_messages[message.room_id] = message
+        for message in last_messages.values():
+            update_room_last_message(message)
+        MessageToken.objects.bulk_create(MessageToken.for_messages(new_messages))
+        increment_unread_counts(new_messages)
+
+
+def save_messages_one_by_one(messages):
+    """
+    Save the messages one at a time, when a batch could not be saved. The messages that fail because of their data are
+    skipped; if the database is unavailable, the remaining messages are returned to be retried.
+    :param messages: Message list with the id assigned
+    :return: Tuple with the saved messages, the messages that cannot be saved and the messages to retry
+    """
+    saved, failed = [], []
+    for index, message in enumerate(messages):
+        try:
+            save_messages([message])
+        except (OperationalError, InterfaceError):
+            logger.exception('Could not save chat messages, they will be retried.')
+            return saved, failed, messages[index:]
+        except Exception:
+            logger.exception('Could not save the chat message %s of the room %s.', message.id, message.room_id)
+            failed.append(message)
+        else:
+            saved.append(message)
+    return saved, failed, []
+
+
+def insert_messages(messages):
+    """
+    Insert the messages ignoring those already saved (INSERT ... ON CONFLICT DO NOTHING RETURNING id), so concurrent
+    flushers saving the same messages only apply the counters and search tokens of the rows that each one inserted.
+    :param messages: Message list with the id assigned
+    :return: Ids of the inserted messages
+    """
+    if not messages:
+        return set()
+    rows = Message.objects._insert(
+        messages, fields=Message._meta.concrete_fields, returning_fields=[Message._meta.pk], ignore_conflicts=True
+    )
+    return {row[0] for row in rows if row}
+
+
+def message_to_journal(message):
+    """Converts a queued message to a journal entry. The content is encrypted."""
+    return json.dumps({
+        'id': message.id,
+        'room': message.room_id,
+        'user': message.user_id,
+        'type': message.type,
+        'content': Message._meta.get_field('_content_data').encrypt(message.content).hex(),
+        'created_at': message.created_at.isoformat(),
+    })
+
+
+def journal_to_message(entry):
+    """Converts a journal entry to a message"""
+    data = json.loads(entry)
+    return Message(
+        id=data['id'],
+        room_id=data['room'],
+        user_id=data['user'],
+        type=data['type'],
+        content=Message._meta.get_field('_content_data').decrypt(bytes.fromhex(data['content'])),
+        created_at=parse_datetime(data['created_at']),
+    )
+
+
+class MessageWriteBehindQueue:
+    """Process queue of messages pending to be saved in the database"""
+
+    def __init__(self):
+        self.messages = []
+        self.ids = deque()
+        self.full = None
+        self.task = None
+        self.owner = None
+        self.heartbeat_at = None
+        self.recover_at = None
+        self._redis = None
+        self._recover_script = None
+
+    @property
+    def journal(self):
+        """Redis client of the journal. None if the durability is `memory`."""
+        if settings.CHAT_WRITE_BEHIND_DURABILITY != 'redis':
+            return None
+        if self._redis is None:
+            self._redis = redis.Redis.from_url(settings.CHAT_WRITE_BEHIND_REDIS_URL)
+        return self._redis
+
+    @property
+    def journal_key(self):
+        """Key of the journal of this process"""
+        return f'{JOURNAL_KEY}:{self.owner}'
+
+    async def get_message_id(self):
+        """Get an id for a new message. The ids are reserved in batches."""
+        if not self.ids:
+            ids = await database_sync_to_async(reserve_message_ids)(settings.CHAT_WRITE_BEHIND_BATCH_SIZE)
+            self.ids.extend(ids)
+        return self.ids.popleft()
+
+    async def create_message(self, data, user, room=None):
+        """
+        Create a message with its id and queue it to be saved
+        :param data: Client JSON object to create message
+        :param user: User sending the message
+        :param room: Chat room already resolved. If it is not given, the room is obtained or created.
+        :raises ValueError: If the chat room is being deleted
+        :return: Message not yet saved
+        """
+        if room is None:
+            room = await database_sync_to_async(get_or_create_room)(data, user)
+        if room.is_deleting:
+            raise ValueError('El chat está siendo eliminado.')
+        now = timezone.now()
+        message = Message(
+            id=await self.get_message_id(),
+            room=room,
+            user=user,
+            content=data['content'],
+            created_at=now,
+            updated_at=now,
+        )
+        await self.put(message)
+        return message
+
+    async def put(self, message):
+        """Queue a message. With `redis` durability the message is first added to the journal of the process."""
+        self.start()
+        journal = self.journal
+        if journal is not None:
+            await self.heartbeat()
+            await sync_to_async(journal.hset, thread_sensitive=False)(
+                self.journal_key, message.id, message_to_journal(message)
+            )
+
+        self.messages.append(message)
+        if len(self.messages) >= settings.CHAT_WRITE_BEHIND_BATCH_SIZE:
+            self.full.set()
+
+    async def get_pending_message(self, message_id):
+        """
+        Get a message queued and not yet saved, from the queue of this process or, with `redis` durability, from the
+        journals of all the processes
+        :param message_id: Message id
+        :return: Message or None if the message is not queued
+        """
+        for message in self.messages:
+            if message.id == message_id:
+                return message
+
+        journal = self.journal
+        if journal is None:
+            return None
+
+        def find():
+            owners = journal.smembers(OWNERS_KEY)
+            with journal.pipeline(transaction=False) as pipe:
+                for owner in owners:
+                    pipe.hget(f'{JOURNAL_KEY}:{owner.decode()}', message_id)
+                entries = pipe.execute()
+            return next((journal_to_message(entry) for entry in entries if entry is not None), None)
+
+        return await sync_to_async(find, thread_sensitive=False)()
+
+    def start(self):
+        """Start the flusher in the running event loop if it is not running"""
+        loop = asyncio.get_running_loop()
+        if self.task is not None and not self.task.done() and self.task.get_loop() is loop:
+            return
+
+        if self.owner is None:
+            self.owner = uuid.uuid4().hex
+        self.full = asyncio.Event()
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        """Save the queued messages periodically"""
+        interval = settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL / 1000
+        while True:
+            try:
+                await self.heartbeat()
+                await self.recover()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Could not recover the chat messages of the write-behind journals.')
+            try:
+                await asyncio.wait_for(self.full.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            await self.flush()
+
+    async def stop(self):
+        """
+        Stop the flusher and save the queued messages. The heartbeat of the process is removed, so the messages that
+        could not be saved are recovered by other processes.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+        journal = self.journal
+        if journal is not None and self.owner is not None:
+            await sync_to_async(self.unregister, thread_sensitive=False)(journal)
+        self.heartbeat_at = None
+        self.recover_at = None
+
+    def unregister(self, journal):
+        """Remove the heartbeat of the process, and the process from the owners of journals if its journal is empty"""
+        with journal.pipeline() as pipe:
+            pipe.delete(f'{HEARTBEAT_KEY}:{self.owner}')
+            if not self.messages:
+                pipe.srem(OWNERS_KEY, self.owner)
+            pipe.execute()
+
+    async def heartbeat(self):
+        """
+        Refresh the heartbeat of the process, at most every third of settings.CHAT_WRITE_BEHIND_OWNER_TIMEOUT, and add
+        the process to the owners of journals
+        """
+        journal = self.journal
+        timeout = settings.CHAT_WRITE_BEHIND_OWNER_TIMEOUT
+        now = time.monotonic()
+        if journal is None or (self.heartbeat_at is not None and now - self.heartbeat_at < timeout / 3):
+            return
+
+        def refresh():
+            with journal.pipeline() as pipe:
+                pipe.set(f'{HEARTBEAT_KEY}:{self.owner}', 1, ex=timeout)
+                pipe.sadd(OWNERS_KEY, self.owner)
+                pipe.execute()
+
+        await sync_to_async(refresh, thread_sensitive=False)()
+        self.heartbeat_at = now
+
+    async def recover(self):
+        """
+        Queue the messages of the journals of the stopped processes, at most every third of
+        settings.CHAT_WRITE_BEHIND_OWNER_TIMEOUT. The journals are moved atomically to the journal of this process, so
+        each journal is recovered by a single process.
+        """
+        journal = self.journal
+        now = time.monotonic()
+        if journal is None or (self.recover_at is not None and now < self.recover_at):
+            return
+
+        if self._recover_script is None:
+            self._recover_script = journal.register_script(RECOVER_SCRIPT)
+        entries = await sync_to_async(self._recover_script, thread_sensitive=False)(
+            keys=[OWNERS_KEY, self.journal_key], args=[f'{JOURNAL_KEY}:', f'{HEARTBEAT_KEY}:', self.owner]
+        )
+        self.recover_at = now + settings.CHAT_WRITE_BEHIND_OWNER_TIMEOUT / 3
+        if entries:
+            logger.info('Recovered %s chat messages of stopped processes.', len(entries))
+            self.messages = [journal_to_message(entry) for entry in entries] + self.messages
+
+    async def flush(self):
+        """
+        Save the queued messages. If the batch cannot be saved, the messages are saved one by one: the messages that
+        cannot be saved are dead-lettered and the messages not saved because the database is unavailable are queued
+        again.
+        """
+        messages, self.messages = self.messages, []
+        if not messages:
+            return
+
+        try:
+            try:
+                await database_sync_to_async(save_messages)(messages)
+                saved, failed, retry = messages, [], []
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Could not save %s chat messages, they will be saved one by one.', len(messages))
+                saved, failed, retry = await database_sync_to_async(save_messages_one_by_one)(messages)
+        except asyncio.CancelledError:
+            self.messages = messages + self.messages
+            raise
+
+        self.messages = retry + self.messages
+        journal = self.journal
+        if journal is None:
+            return
+
+        def remove():
+            with journal.pipeline() as pipe:
+                if failed:
+                    pipe.hset(DEAD_LETTER_KEY, mapping={m.id: message_to_journal(m) for m in failed})
+                if saved or failed:
+                    pipe.hdel(self.journal_key, *[m.id for m in saved + failed])
+                pipe.execute()
+
+        await sync_to_async(remove, thread_sensitive=False)()
+
+
+write_behind_queue = MessageWriteBehindQueue()
@@ -24,18 +24,23 @@ from channels.auth import AuthMiddlewareStack  # NOQA
 from channels.routing import ProtocolTypeRouter, URLRouter  # NOQA
 from channels.security.websocket import AllowedHostsOriginValidator  # NOQA
 
+from gestion_consultas.lifespan import LifespanApp, register_daphne_shutdown  # NOQA
 from gestion_consultas.middleware import JwtAuthMiddleware  # NOQA
 from apps.chats.api.consumers import messages  # NOQA
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
+    'lifespan': LifespanApp(),
     'websocket': AllowedHostsOriginValidator(
         JwtAuthMiddleware(
             AuthMiddlewareStack(
                 URLRouter([
-                    re_path(r'ws/v1/chat/(?P<room_name>\w+)/$', messages.MessageConsumer.as_asgi())
+                    re_path(r'ws/v1/chat/$', messages.RoomsConsumer.as_asgi()),
+                    re_path(r'ws/v1/chat/(?P<room_name>\w+)/$', messages.MessageConsumer.as_asgi()),
                 ])
             )
         )
     )
 })
+
+register_daphne_shutdown()
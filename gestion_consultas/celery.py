@@ -34,4 +34,32 @@ app.conf.beat_schedule = {
         # Schedule
         'schedule': crontab(minute=0, hour=0),
     },
+    'send_chat_digests': {
+        'task': 'apps.chats.tasks.send_chat_digests',
+        'schedule': crontab(minute='*/5'),
+    },
+    'create_message_partitions_daily': {
+        'task': 'apps.chats.tasks.create_message_partitions',
+        'schedule': crontab(minute=30, hour=0),
+    },
+    'archive_inactive_rooms_daily': {
+        'task': 'apps.chats.tasks.archive_inactive_rooms',
+        'schedule': crontab(minute=0, hour=3),
+    },
+    'purge_old_messages_daily': {
+        'task': 'apps.chats.tasks.purge_old_messages',
+        'schedule': crontab(minute=0, hour=4),
+    },
+    'delete_expired_uploads_hourly': {
+        'task': 'apps.chats.tasks.delete_expired_uploads',
+        'schedule': crontab(minute=15),
+    },
+    'delete_message_deletions_daily': {
+        'task': 'apps.chats.tasks.delete_message_deletions',
+        'schedule': crontab(minute=30, hour=4),
+    },
+    'delete_expired_exports_hourly': {
+        'task': 'apps.chats.tasks.delete_expired_exports',
+        'schedule': crontab(minute=45),
+    },
 }
@@ -0,0 +1,40 @@
+"""Startup and shutdown of the ASGI server"""
+
+import asyncio
+import sys
+
+from apps.chats.write_behind import write_behind_queue
+
+
+async def shutdown():
+    """Save the chat messages queued by the write-behind persistence (apps.chats.write_behind)"""
+    await write_behind_queue.stop()
+
+
+class LifespanApp:
+    """ASGI application of the `lifespan` protocol, used by the servers that support it (uvicorn, hypercorn)"""
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def register_daphne_shutdown():
+    """
+    Daphne does not support the `lifespan` protocol, so the shutdown is run before the Twisted reactor of Daphne stops.
+    Nothing is done if the application is not run by Daphne.
+    """
+    if 'daphne.server' not in sys.modules:
+        return
+
+    from twisted.internet import defer, reactor
+
+    reactor.addSystemEventTrigger(
+        'before', 'shutdown', lambda: defer.Deferred.fromFuture(asyncio.ensure_future(shutdown()))
+    )
@@ -7,20 +7,18 @@ from channels.middleware import BaseMiddleware
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.db import close_old_connections
-from jwt import decode as jwt_decode
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from rest_framework_simplejwt.tokens import UntypedToken
 
-from apps.accounts.models import User
+from apps.accounts.tokens import get_cached_user, verify_token
 
 
 @database_sync_to_async
 def get_user(username):
-    try:
-        user = User.objects.get(username=username)
-        return user
-    except User.DoesNotExist:
+    """Get the user from the cache of authenticated users or from the database. The inactive users are anonymous."""
+    user = get_cached_user(username)
+    if user is None or not user.is_active:
         return AnonymousUser()
+    return user
 
 
 class JwtAuthMiddleware(BaseMiddleware):
@@ -41,16 +39,13 @@ class JwtAuthMiddleware(BaseMiddleware):
 
         # Try to authenticate the user
         try:
-            # This will automatically validate the token and raise an error if token is invalid
-            UntypedToken(token)
+            # Validate and decode the token in a single pass. The claims of the verified tokens are cached.
+            decoded_data = verify_token(token)
         except (InvalidToken, TokenError) as e:
             # Token is invalid
             print(e)
             return None
         else:
-            # Then token is valid, decode it
-            decoded_data = jwt_decode(token, settings.SECRET_KEY, algorithms=[settings.SIMPLE_JWT['ALGORITHM']])
-
             # Get the user using username
-            scope["user"] = await get_user(decoded_data['user_username'])
+            scope["user"] = await get_user(decoded_data[settings.SIMPLE_JWT['USER_ID_CLAIM']])
         return await super().__call__(scope, receive, send)
@@ -72,6 +72,19 @@ MIDDLEWARE = [
 # Auth
 AUTHENTICATION_BACKENDS = ['django.contrib.auth.backends.AllowAllUsersModelBackend']
 
+# Cache of the authentication (apps.accounts.tokens). The claims of up to JWT_CLAIMS_CACHE_SIZE verified tokens of the
+# websocket connections are kept in memory for JWT_CLAIMS_CACHE_TTL seconds. The authenticated users and their
+# permissions are kept in the default cache for AUTH_USER_CACHE_TTL seconds and, up to AUTH_USER_LOCAL_CACHE_SIZE users,
+# in memory. 0 disables the caches.
+JWT_CLAIMS_CACHE_TTL = 60
+JWT_CLAIMS_CACHE_SIZE = 10000
+AUTH_USER_CACHE_TTL = 300
+AUTH_USER_LOCAL_CACHE_SIZE = 1000
+
+# Sessions
+# The sessions are saved with their user (apps.accounts.models.UserSession) so they can be deleted by user.
+SESSION_ENGINE = 'apps.accounts.sessions'
+
 ROOT_URLCONF = 'gestion_consultas.urls'
 
 TEMPLATES = [
@@ -153,6 +166,12 @@ FILE_UPLOAD_PERMISSIONS = 0o644
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR.parent / 'media'
 
+# Files of the chat messages (apps.chats.storage). They are stored outside MEDIA_ROOT with random names and are only
+# served to the users of the chat room. If CHAT_FILES_ACCEL_REDIRECT is set (e.g. /protected/chats/), the view only
+# checks the access and nginx sends the file from its `internal` location with that prefix.
+CHAT_FILES_ROOT = config('CHAT_FILES_ROOT', default=str(BASE_DIR.parent / 'private' / 'chats'))
+CHAT_FILES_ACCEL_REDIRECT = config('CHAT_FILES_ACCEL_REDIRECT', default='')
+
 # User model
 AUTH_USER_MODEL = 'accounts.User'
 
@@ -190,3 +209,100 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_TIME_LIMIT = 5 * 60
 CELERY_TASK_SOFT_TIME_LIMIT = 60
+
+# Chats
+# Number of messages sent in each frame of the chat history (fetch_messages command).
+CHAT_MESSAGES_PAGE_SIZE = 50
+CHAT_MESSAGES_MAX_PAGE_SIZE = 200
+
+# Days during which the deleted messages are kept to synchronize the clients (sync command). The clients that did not
+# synchronize in that period get the history again.
+CHAT_SYNC_WINDOW = config('CHAT_SYNC_WINDOW', default=30, cast=int)
+
+# Number of chat rooms per page of the inbox.
+CHAT_INBOX_PAGE_SIZE = 20
+CHAT_INBOX_MAX_PAGE_SIZE = 100
+
+# Maximum length of the last message preview stored in the chat room.
+CHAT_LAST_MESSAGE_PREVIEW_LENGTH = 100
+
+# Write-behind mode: the messages are broadcast before being saved and are saved in batches (apps.chats.write_behind).
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+# The queued messages are saved every CHAT_WRITE_BEHIND_FLUSH_INTERVAL milliseconds or when
+# CHAT_WRITE_BEHIND_BATCH_SIZE messages are queued.
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = config('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', default=50, cast=int)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config('CHAT_WRITE_BEHIND_BATCH_SIZE', default=100, cast=int)
+# Durability of the queued messages:
+#   memory = queued messages are lost if the process stops.
+#   redis = queued messages are kept in a Redis journal and saved at least once.
+CHAT_WRITE_BEHIND_DURABILITY = config('CHAT_WRITE_BEHIND_DURABILITY', default='redis')
+CHAT_WRITE_BEHIND_REDIS_URL = config('REDIS_URL')
+# Seconds after which the journal of a process that does not refresh its heartbeat is recovered by other processes.
+CHAT_WRITE_BEHIND_OWNER_TIMEOUT = config('CHAT_WRITE_BEHIND_OWNER_TIMEOUT', default=30, cast=int)
+
+# Memory (bytes) of the in-process LRU cache of decrypted message contents. 0 disables the cache.
+CHAT_DECRYPTED_CONTENT_CACHE_SIZE = config('CHAT_DECRYPTED_CONTENT_CACHE_SIZE', default=0, cast=int)
+
+# Key of the HMACs of the words of the messages used to search them (apps.chats.search). If it changes, the messages
+# must be indexed again (index_messages command).
+CHAT_SEARCH_HASH_KEY = config('CHAT_SEARCH_HASH_KEY', default=SECRET_KEY)
+CHAT_SEARCH_MAX_WORD_LENGTH = 50
+
+# Number of months ahead for which the message partitions are created (create_message_partitions command).
+CHAT_MESSAGE_PARTITIONS_AHEAD = 3
+# The messages of the chat rooms without messages in the last CHAT_ARCHIVE_ROOMS_AFTER_DAYS days are moved to the
+# archive partition. CHAT_ARCHIVE_BATCH_SIZE rooms are archived per transaction.
+CHAT_ARCHIVE_ROOMS_AFTER_DAYS = config('CHAT_ARCHIVE_ROOMS_AFTER_DAYS', default=180, cast=int)
+CHAT_ARCHIVE_BATCH_SIZE = 100
+
+# Limits of the commands of each chat websocket connection and of each user: (commands per second, burst). The
+# commands are run in order; up to CHAT_COMMAND_QUEUE_SIZE commands of a connection wait to be run and the next ones are
+# rejected.
+CHAT_CONNECTION_RATE_LIMIT = (10, 20)
+CHAT_USER_RATE_LIMIT = (20, 40)
+CHAT_COMMAND_QUEUE_SIZE = 16
+
+# Presence and typing events of the chat (apps.chats.presence). A connection is online for CHAT_PRESENCE_TTL seconds
+# after connecting or sending the presence command, and a user is typing for CHAT_TYPING_TTL seconds. An event that
+# repeats the last state of the user in the room is broadcast at most once every CHAT_PRESENCE_INTERVAL milliseconds.
+CHAT_PRESENCE_TTL = 60
+CHAT_TYPING_TTL = 5
+CHAT_PRESENCE_INTERVAL = 2000
+CHAT_PRESENCE_REDIS_URL = config('REDIS_URL')
+
+# Maximum number of chat rooms to which a connection of the multiplexed endpoint can be subscribed
+CHAT_MAX_ROOMS_PER_CONNECTION = config('CHAT_MAX_ROOMS_PER_CONNECTION', default=100, cast=int)
+
+# Export of the transcript of the chat rooms (apps.chats.export): rows read per query of the server-side cursor, time
+# limit in seconds of the task that writes the file and hours after which the files are deleted.
+CHAT_EXPORT_CHUNK_SIZE = 500
+CHAT_EXPORT_TIME_LIMIT = 60 * 60
+CHAT_EXPORT_EXPIRATION = 24
+
+# Digest e-mails of the unread chat messages (send_chat_digests task). The users are notified when their first unread
+# message of a room is older than CHAT_DIGEST_WINDOW minutes. The e-mails of CHAT_DIGEST_BATCH_SIZE users are sent over
+# a single connection.
+CHAT_DIGEST_WINDOW = config('CHAT_DIGEST_WINDOW', default=15, cast=int)
+CHAT_DIGEST_BATCH_SIZE = 100
+
+# Deletion of messages in batches (apps.chats.purge): CHAT_PURGE_BATCH_SIZE messages per transaction, waiting
+# CHAT_PURGE_BATCH_DELAY milliseconds between batches. Each task deletes up to CHAT_PURGE_BATCHES_PER_TASK batches.
+# The messages older than CHAT_MESSAGE_RETENTION_DAYS days are deleted daily; 0 keeps the messages forever.
+CHAT_PURGE_BATCH_SIZE = config('CHAT_PURGE_BATCH_SIZE', default=1000, cast=int)
+CHAT_PURGE_BATCH_DELAY = config('CHAT_PURGE_BATCH_DELAY', default=100, cast=int)
+CHAT_PURGE_BATCHES_PER_TASK = 50
+CHAT_MESSAGE_RETENTION_DAYS = config('CHAT_MESSAGE_RETENTION_DAYS', default=0, cast=int)
+
+# Chunked uploads of the files of the messages (apps.chats.uploads). The chunks are sent in websocket frames of at most
+# CHAT_UPLOAD_CHUNK_SIZE bytes (before base64 encoding with JSON). The uploads not updated in CHAT_UPLOAD_EXPIRATION
+# hours are deleted.
+CHAT_UPLOAD_CHUNK_SIZE = 256 * 1024
+CHAT_UPLOAD_MAX_SIZE = config('CHAT_UPLOAD_MAX_SIZE', default=50 * 1024 * 1024, cast=int)
+CHAT_UPLOAD_EXPIRATION = 24
+# Extensions of the files allowed for each message type
+CHAT_UPLOAD_EXTENSIONS = {
+    'AD': ['mp3', 'mp4', 'ogg', 'm4a', 'wav', 'webm'],
+    'FL': ['pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'txt', 'csv', 'zip'],
+    'IMG': ['jpg', 'jpeg', 'png', 'webp', 'gif'],
+    'VD': ['mp4', 'webm', 'mov'],
+}
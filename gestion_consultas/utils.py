@@ -1,7 +1,7 @@
 """Project utilities"""
 
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.db.models import Value
 from django.db.models.functions import Concat
 from django.template.loader import render_to_string
@@ -70,11 +70,46 @@ def filter_by_full_name(queryset, first_name_field, last_name_field, value):
             filter(full_name__unaccent__icontains=value))
 
 
-def send_email(recipient_email, template_prefix, template_context):
-    """Send reset password link to given user."""
+def build_email(recipient_email, template_prefix, template_context):
+    """Build the e-mail of the template for the given recipient."""
     subject = render_to_string(f'{template_prefix}_subject.txt', template_context)
     subject = " ".join(subject.splitlines()).strip()  # Remove superfluous line breaks
     content = render_to_string(f'{template_prefix}.html', template_context)
     msg = EmailMultiAlternatives(subject, content, settings.DEFAULT_FROM_EMAIL, [recipient_email])
     msg.attach_alternative(content, "text/html")
-    return msg.send()
+    return msg
+
+
+def send_email(recipient_email, template_prefix, template_context):
+    """Send reset password link to given user."""
+    return build_email(recipient_email, template_prefix, template_context).send()
+
+
+class SendEmailsError(Exception):
+    """An e-mail could not be sent. The `sent` previous e-mails were sent."""
+
+    def __init__(self, sent):
+        super().__init__(f'Error sending the e-mail {sent + 1}.')
+        self.sent = sent
+
+
+def send_emails(messages):
+    """
+    Send many e-mails over a single connection to the e-mail server, in order.
+
+    :param messages: List of e-mails (build_email)
+    :raises SendEmailsError: If an e-mail cannot be sent. The e-mails after it are not sent.
+    :return: Number of e-mails sent
+    """
+    if not messages:
+        return 0
+
+    sent = 0
+    try:
+        with get_connection() as connection:
+            for message in messages:
+                connection.send_messages([message])
+                sent += 1
+    except Exception as e:
+        raise SendEmailsError(sent) from e
+    return sent
@@ -1,12 +1,20 @@
 """Accounts tests"""
 
+from unittest import mock
+
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
 from django.urls import reverse
 from rest_framework import status
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.test import APITestCase
 
-from apps.accounts.models import User
-from tests.accounts.factories import UserFactory, USER_FACTORY_DICT
-from tests.utils import TEST_PASSWORD, RefreshTokenTest
+from apps.accounts import tokens
+from apps.accounts.api.permissions import check_permissions
+from apps.accounts.models import User, UserSession
+from apps.accounts.permissions import group_permissions_cache
+from tests.accounts.factories import UserAdminFactory, UserDoctorFactory, UserFactory, USER_FACTORY_DICT
+from tests.utils import TEST_PASSWORD, AccessTokenTest, RefreshTokenTest
 
 
 class SignUpAPIViewTest(APITestCase):
@@ -32,6 +40,22 @@ class LoginAPIViewTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertContains(response, user.role, status_code=status.HTTP_201_CREATED)
 
+    def test_post_deletes_only_user_sessions(self):
+        user = UserFactory()
+        other_user = UserFactory()
+        self.client_class().force_login(user)
+        self.client_class().force_login(other_user)
+        self.assertEqual(UserSession.objects.filter(user=user).count(), 1)
+
+        data = {
+            'username': user.username,
+            'password': TEST_PASSWORD,
+        }
+        response = self.client.post(reverse('login'), data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(UserSession.objects.filter(user=user).exists())
+        self.assertTrue(UserSession.objects.filter(user=other_user).exists())
+
 
 class LogoutAPIViewTest(APITestCase):
     """Verify that the user is logged out"""
@@ -72,3 +96,78 @@ class PasswordResetEmailAPIViewTest(APITestCase):
         response = self.client.post(reverse('password_reset_email'), {'username': user.username})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertDictEqual(response.data, expected)
+
+
+class TokenCacheTest(APITestCase):
+    """Verify the cache of the verified tokens and of the authenticated users"""
+
+    def setUp(self):
+        tokens.token_claims_cache.clear()
+        tokens.local_user_cache.clear()
+        group_permissions_cache.clear()
+
+    def test_token_is_verified_once(self):
+        user = UserFactory()
+        token = str(AccessTokenTest().for_user(user))
+        with mock.patch.object(tokens, 'UntypedToken', wraps=tokens.UntypedToken) as untyped_token:
+            self.assertEqual(tokens.verify_token(token)['user_username'], user.username)
+            self.assertEqual(tokens.verify_token(token)['user_username'], user.username)
+        self.assertEqual(untyped_token.call_count, 1)
+
+    def test_cached_user_is_removed_when_saved(self):
+        user = UserFactory()
+        self.assertEqual(tokens.get_cached_user(user.username), user)
+        with self.assertNumQueries(0):
+            self.assertTrue(tokens.get_cached_user(user.username).is_active)
+
+        user = User.objects.get(pk=user.pk)
+        user.is_active = False
+        user.username = f'{user.username}2'
+        user.save()
+        self.assertFalse(tokens.get_cached_user(user.username).is_active)
+        self.assertIsNone(tokens.get_cached_user(user._loaded_username))
+
+    def test_cached_user_without_password(self):
+        """The password hash is not cached, and it is read from the database when it is used"""
+        user = UserFactory()
+        tokens.get_cached_user(user.username)
+        cached_user = cache.get(tokens.get_user_cache_key(user.username, tokens.get_user_version(user.username)))
+        self.assertNotIn('password', cached_user.__dict__)
+        self.assertTrue(tokens.get_cached_user(user.username).check_password(TEST_PASSWORD))
+
+    def test_cached_user_permissions_change_with_version(self):
+        """The cached users and their permissions are used until the user, its groups or permissions change"""
+        UserAdminFactory()
+        user = UserDoctorFactory()
+        doctor_permissions = tokens.get_cached_user(user.username).get_group_permissions()
+        self.assertTrue(doctor_permissions)
+        with self.assertNumQueries(0):
+            cached_user = tokens.get_cached_user(user.username)
+            self.assertTrue(all(cached_user.has_perm(permission) for permission in doctor_permissions))
+            self.assertFalse(cached_user.has_perm('accounts.delete_user'))
+
+        user.user_permissions.add(Permission.objects.get(codename='delete_user'))
+        self.assertTrue(tokens.get_cached_user(user.username).has_perm('accounts.delete_user'))
+
+        Group.objects.get(name='Doctors').permissions.clear()
+        cached_user = tokens.get_cached_user(user.username)
+        self.assertFalse(any(cached_user.has_perm(permission) for permission in doctor_permissions))
+
+        # The users cached by other processes are only used with the current version
+        tokens.local_user_cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(tokens.get_cached_user(user.username).get_all_permissions(), {'accounts.delete_user'})
+
+    def test_permissions_checked_without_queries(self):
+        """The user is loaded in a single query with the compiled permissions of its role"""
+        UserAdminFactory()
+        user = UserDoctorFactory()
+        tokens.load_user(user.username)
+        with self.assertNumQueries(1):
+            loaded_user = tokens.load_user(user.username)
+        self.assertEqual(loaded_user.get_all_permissions(), User.objects.get(pk=user.pk).get_all_permissions())
+
+        with self.assertNumQueries(0):
+            check_permissions(loaded_user, user.username, 'chats.view_room')
+            with self.assertRaises(PermissionDenied):
+                check_permissions(loaded_user, 'other_user', 'chats.view_room')
@@ -1,14 +1,18 @@
 """Users tests"""
 
+from django.test import override_settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 
 from apps.accounts.models import User
+from apps.chats.models import Message, MessagePurge, Room
+from apps.chats.purge import run_purge
 from tests.accounts.factories import (
     UserFactory, UserAdminFactory, UserDoctorFactory, USER_FACTORY_DICT, USER_ADMIN_FACTORY_DICT,
     USER_DOCTOR_FACTORY_DICT
 )
+from tests.chats.factories import MessageFactory, RoomFactory
 from tests.utils import TEST_PASSWORD, API_ENDPOINT_V1, AccessTokenTest
 
 
@@ -75,6 +79,24 @@ class UsersAdminAPITestCase(APITestCase):
         self.assertEqual(response.data.get('username'), user.username)
         self.assertContains(response, 'password_reset_url')
 
+    @override_settings(CHAT_PURGE_BATCH_SIZE=2, CHAT_PURGE_BATCH_DELAY=0)
+    def test_user_admin_delete_user(self) -> None:
+        """The user is deactivated and deleted after deleting the messages of its chat rooms in batches"""
+        user = UserFactory()
+        room = RoomFactory(user_owner=self.user, user_receiver=user)
+        MessageFactory.create_batch(3, room=room, user=user)
+
+        with self.captureOnCommitCallbacks():
+            response = self.client.delete(f'{self.url}{user.username}/')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(User.objects.get(pk=user.pk).is_active)
+
+        job = run_purge(MessagePurge.objects.get(user_id=user.id).id)
+        self.assertEqual((job.status, job.deleted_messages), (MessagePurge.Status.DONE, 3))
+        self.assertFalse(User.objects.filter(pk=user.pk).exists())
+        self.assertFalse(Room.objects.filter(pk=room.pk).exists())
+        self.assertFalse(Message.objects.filter(room_id=room.pk).exists())
+
 
 class UsersDoctorAPITestCase(APITestCase):
     """Users with DOCTOR role API test case"""
@@ -1,15 +1,36 @@
 """Message consumer tests"""
 
+import base64
+import hashlib
 import json
+import math
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
+
+import msgpack
 
 from channels.db import database_sync_to_async
 from channels.routing import URLRouter
 from channels.testing import WebsocketCommunicator
-from django.test import TransactionTestCase
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
 from django.urls import re_path
+from django.utils import timezone
 
-from apps.chats.api.consumers.messages import MessageConsumer
+from apps.chats.api.consumers.messages import MSGPACK_SUBPROTOCOL, MessageConsumer, RoomsConsumer
+from apps.chats import utils
+from apps.chats.models import Message, MessageDeletion, Room, RoomReadState
+from apps.chats.presence import PRESENCE_KEY, presence_registry
+from apps.chats.tasks import delete_message_deletions
+from apps.chats.throttling import TokenBucket, consume_all
+from apps.chats.write_behind import (
+    DEAD_LETTER_KEY, HEARTBEAT_KEY, MessageWriteBehindQueue, message_to_journal, reserve_message_ids, save_messages,
+    write_behind_queue
+)
+from gestion_consultas.middleware import JwtAuthMiddleware
 from tests.accounts.factories import UserAdminFactory, UserFactory
+from tests.chats.benchmark import latency_summary, percentile
 from tests.chats.factories import MessageFactory, RoomFactory
 from tests.utils import API_VERSION_V1, AccessTokenTest
 
@@ -48,6 +69,7 @@ class MessageConsumerTransactionTestCase(TransactionTestCase):
         self.room_name = 'roomtest'
         self.message = 'Mensaje de prueba'
         self.application = URLRouter([
+            re_path(r'ws/v1/chat/$', RoomsConsumer.as_asgi()),
             re_path(r'ws/v1/chat/(?P<room_name>\w+)/$', MessageConsumer.as_asgi())
         ])
 
@@ -76,6 +98,11 @@ class MessageConsumerTransactionTestCase(TransactionTestCase):
 
         self.assertEqual(message['user'], self.user_owner.username)
         self.assertEqual(message['content'], self.message)
+        self.assertEqual(datetime.fromisoformat(message['created_at']).isoformat(), message['created_at'])
+
+        room = await database_sync_to_async(Room.objects.get)(name=self.room_name)
+        self.assertEqual(room.last_message_id, message['id'])
+        self.assertEqual(room.last_message_preview, self.message)
         await communicator.disconnect()
 
     async def test_fetch_messages_by_user_receiver(self) -> None:
@@ -104,3 +131,682 @@ class MessageConsumerTransactionTestCase(TransactionTestCase):
         self.assertEqual(message['content'], msg.content)
 
         await communicator.disconnect()
+
+    async def test_fetch_messages_paginated(self) -> None:
+        """Get the messages of the chat room in frames using a cursor"""
+        room, msg = await create_room_and_message(self.user_owner, self.user_receiver)
+        messages = [msg]
+        for _ in range(4):
+            messages.append(await database_sync_to_async(MessageFactory)(room=room, user=self.user_receiver))
+
+        token = get_user_token(self.user_receiver)
+        url = f'/ws/{API_VERSION_V1}/chat/{room.name}/?token={token}'
+
+        communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_receiver)
+        connected, subprotocol = await communicator.connect()
+
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({
+            'command': 'fetch_messages',
+            'after': {'id': messages[0].id, 'created_at': messages[0].created_at.isoformat()},
+            'page_size': 2,
+        })
+
+        frames = [json.loads(await communicator.receive_from()) for _ in range(2)]
+
+        self.assertEqual([m['id'] for m in frames[0]['messages']], [messages[1].id, messages[2].id])
+        self.assertTrue(frames[0]['has_more'])
+        self.assertEqual(frames[0]['cursor']['id'], messages[2].id)
+        self.assertEqual([m['id'] for m in frames[1]['messages']], [messages[3].id, messages[4].id])
+        self.assertFalse(frames[1]['has_more'])
+
+        await communicator.send_json_to({
+            'command': 'fetch_messages',
+            'before': {'id': messages[4].id, 'created_at': messages[4].created_at.isoformat()},
+            'page_size': 3,
+            'limit': 3,
+        })
+
+        response = json.loads(await communicator.receive_from())
+
+        self.assertEqual([m['id'] for m in response['messages']], [m.id for m in messages[1:4]])
+        self.assertFalse(response['has_more'])
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_DURABILITY='redis')
+    async def test_create_message_write_behind(self) -> None:
+        """Create a message that is broadcast before being saved in the database"""
+        token = get_user_token(self.user_owner)
+        url = f'/ws/{API_VERSION_V1}/chat/{self.room_name}/?token={token}'
+
+        communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_owner)
+        connected, subprotocol = await communicator.connect()
+
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({
+            'command': 'create_message',
+            'data': {
+                'room_name': self.room_name,
+                'user_receiver': self.user_receiver.username,
+                'content': self.message
+            }
+        })
+
+        response = json.loads(await communicator.receive_from())
+        message = response['message']
+
+        self.assertIsNotNone(message['id'])
+        self.assertEqual(message['content'], self.message)
+
+        await write_behind_queue.stop()
+
+        msg = await database_sync_to_async(Message.objects.get)(pk=message['id'])
+        room = await database_sync_to_async(Room.objects.get)(name=self.room_name)
+        journal = await database_sync_to_async(write_behind_queue.journal.hexists)(
+            write_behind_queue.journal_key, message['id']
+        )
+
+        self.assertEqual(msg.content, self.message)
+        self.assertEqual(room.last_message_id, msg.id)
+        self.assertFalse(journal)
+        await communicator.disconnect()
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_DURABILITY='redis')
+    async def test_write_behind_recovers_journals_of_stopped_processes(self) -> None:
+        """Only the journals of the processes without heartbeat are recovered, and their messages are saved once"""
+        room = await database_sync_to_async(RoomFactory)(user_owner=self.user_owner, user_receiver=self.user_receiver)
+        stopped, running, recovering = MessageWriteBehindQueue(), MessageWriteBehindQueue(), MessageWriteBehindQueue()
+        journal = recovering.journal
+
+        for queue, message_id in zip([stopped, running], await database_sync_to_async(reserve_message_ids)(2)):
+            queue.owner = f'test-{message_id}'
+            await queue.heartbeat()
+            message = Message(id=message_id, room=room, user=self.user_owner, content=self.message)
+            await database_sync_to_async(journal.hset)(queue.journal_key, message_id, message_to_journal(message))
+        # The process stopped without removing its heartbeat
+        await database_sync_to_async(journal.delete)(f'{HEARTBEAT_KEY}:{stopped.owner}')
+
+        recovering.owner = 'test-recovering'
+        await recovering.recover()
+        messages = list(recovering.messages)
+        self.assertEqual([m.id for m in messages], [int(stopped.owner.split('-')[1])])
+        self.assertFalse(await database_sync_to_async(journal.exists)(stopped.journal_key))
+        self.assertTrue(await database_sync_to_async(journal.exists)(running.journal_key))
+
+        await recovering.flush()
+        # A flusher saving the same messages again does not count them twice
+        await database_sync_to_async(save_messages)(messages)
+
+        state = await database_sync_to_async(RoomReadState.objects.get)(room=room, user=self.user_receiver)
+        room = await database_sync_to_async(Room.objects.get)(pk=room.pk)
+        self.assertEqual(state.unread_count, 1)
+        self.assertEqual(room.last_message_id, messages[0].id)
+        self.assertFalse(await database_sync_to_async(journal.exists)(recovering.journal_key))
+
+        for queue in [running, recovering]:
+            await database_sync_to_async(journal.delete)(queue.journal_key)
+            await database_sync_to_async(queue.unregister)(journal)
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_DURABILITY='redis')
+    async def test_write_behind_dead_letters_messages_that_cannot_be_saved(self) -> None:
+        """A message that cannot be saved does not block the other messages of the queue"""
+        room = await database_sync_to_async(RoomFactory)(user_owner=self.user_owner, user_receiver=self.user_receiver)
+        deleted_room = await database_sync_to_async(RoomFactory)(user_owner=self.user_owner)
+        closed_room = await database_sync_to_async(RoomFactory)(user_owner=self.user_owner)
+        queue = MessageWriteBehindQueue()
+        journal = queue.journal
+
+        messages = []
+        for message_room in (deleted_room, room, closed_room):
+            messages.append(await queue.create_message({'content': self.message}, self.user_owner, message_room))
+        await database_sync_to_async(Room.objects.filter(pk=deleted_room.pk).delete)()
+        # The messages of a chat room being deleted are discarded
+        await database_sync_to_async(Room.objects.filter(pk=closed_room.pk).update)(is_deleting=True)
+        await queue.stop()
+
+        self.assertEqual(queue.messages, [])
+        self.assertTrue(await database_sync_to_async(Message.objects.filter(pk=messages[1].id).exists)())
+        self.assertFalse(await database_sync_to_async(journal.exists)(queue.journal_key))
+        self.assertTrue(await database_sync_to_async(journal.hexists)(DEAD_LETTER_KEY, messages[0].id))
+        self.assertFalse(await database_sync_to_async(Message.objects.filter(pk=messages[2].id).exists)())
+        self.assertFalse(await database_sync_to_async(journal.hexists)(DEAD_LETTER_KEY, messages[2].id))
+        await database_sync_to_async(journal.hdel)(DEAD_LETTER_KEY, messages[0].id)
+
+    async def test_create_messages_with_pinned_room(self) -> None:
+        """The chat room is resolved once per connection and again when it changes"""
+        token = get_user_token(self.user_owner)
+        url = f'/ws/{API_VERSION_V1}/chat/{self.room_name}/?token={token}'
+
+        communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_owner)
+        connected, subprotocol = await communicator.connect()
+
+        self.assertTrue(connected)
+
+        data = {
+            'command': 'create_message',
+            'data': {
+                'room_name': self.room_name,
+                'user_receiver': self.user_receiver.username,
+                'content': self.message
+            }
+        }
+        with mock.patch.object(utils, 'get_or_create_room', wraps=utils.get_or_create_room) as get_or_create_room:
+            for _ in range(2):
+                await communicator.send_json_to(data)
+                await communicator.receive_from()
+
+            self.assertEqual(get_or_create_room.call_count, 1)
+
+            await database_sync_to_async(Room.objects.filter(name=self.room_name).delete)()
+            await communicator.send_json_to(data)
+            response = json.loads(await communicator.receive_from())
+
+            self.assertEqual(get_or_create_room.call_count, 2)
+
+        room = await database_sync_to_async(Room.objects.get)(name=self.room_name)
+        self.assertEqual(response['message']['room'], room.id)
+        await communicator.disconnect()
+
+    async def test_unread_count_and_mark_read(self) -> None:
+        """The unread messages counter is incremented by new messages and reset by the receiver"""
+        room = await database_sync_to_async(RoomFactory)(user_owner=self.user_owner, user_receiver=self.user_receiver)
+        data = {
+            'command': 'create_message',
+            'data': {'room_name': room.name, 'user_receiver': self.user_receiver.username, 'content': self.message}
+        }
+
+        url = f'/ws/{API_VERSION_V1}/chat/{room.name}/?token={get_user_token(self.user_owner)}'
+        owner = AuthWebsocketCommunicator(self.application, url, user=self.user_owner)
+        await owner.connect()
+        messages = []
+        for _ in range(3):
+            await owner.send_json_to(data)
+            messages.append(json.loads(await owner.receive_from())['message'])
+        await owner.disconnect()
+
+        state = await database_sync_to_async(RoomReadState.objects.get)(room=room, user=self.user_receiver)
+        self.assertEqual(state.unread_count, 3)
+        self.assertIsNotNone(state.unread_since)
+
+        url = f'/ws/{API_VERSION_V1}/chat/{room.name}/?token={get_user_token(self.user_receiver)}'
+        receiver = AuthWebsocketCommunicator(self.application, url, user=self.user_receiver)
+        await receiver.connect()
+
+        await receiver.send_json_to({'command': 'mark_read', 'message_id': messages[0]['id']})
+        response = json.loads(await receiver.receive_from())
+        self.assertEqual(response['last_read_message_id'], messages[0]['id'])
+        self.assertEqual(response['unread_count'], 2)
+
+        await receiver.send_json_to({'command': 'mark_read'})
+        response = json.loads(await receiver.receive_from())
+        self.assertEqual(response['last_read_message_id'], messages[-1]['id'])
+        self.assertEqual(response['unread_count'], 0)
+
+        state = await database_sync_to_async(RoomReadState.objects.get)(room=room, user=self.user_receiver)
+        self.assertEqual(state.unread_count, 0)
+        self.assertIsNone(state.unread_since)
+        await receiver.disconnect()
+
+    async def test_create_and_fetch_messages_with_binary_protocol(self) -> None:
+        """Create and get messages using the MessagePack subprotocol"""
+        token = get_user_token(self.user_owner)
+        url = f'/ws/{API_VERSION_V1}/chat/{self.room_name}/?token={token}'
+
+        communicator = AuthWebsocketCommunicator(
+            self.application, url, subprotocols=[MSGPACK_SUBPROTOCOL], user=self.user_owner
+        )
+        connected, subprotocol = await communicator.connect()
+
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+
+        await communicator.send_to(bytes_data=msgpack.packb({
+            'command': 'create_message',
+            'data': {
+                'room_name': self.room_name,
+                'user_receiver': self.user_receiver.username,
+                'content': self.message
+            }
+        }))
+
+        response = msgpack.unpackb(await communicator.receive_from())
+        message = response['message']
+
+        self.assertEqual(message['user'], self.user_owner.username)
+        self.assertEqual(message['content'], self.message)
+
+        # The connections of the room using JSON receive the same frame as JSON
+        receiver = AuthWebsocketCommunicator(self.application, url, user=self.user_receiver)
+        await receiver.connect()
+        await communicator.send_to(bytes_data=msgpack.packb({
+            'command': 'create_message',
+            'data': {'room_name': self.room_name, 'content': self.message}
+        }))
+        binary_frame = msgpack.unpackb(await communicator.receive_from())
+        self.assertEqual(json.loads(await receiver.receive_from()), binary_frame)
+        await receiver.disconnect()
+
+        await communicator.send_to(bytes_data=msgpack.packb({'command': 'fetch_messages'}))
+
+        response = msgpack.unpackb(await communicator.receive_from())
+
+        self.assertEqual(response['messages'][-1]['id'], binary_frame['message']['id'])
+        await communicator.disconnect()
+
+    async def test_sync_messages_after_reconnecting(self) -> None:
+        """Get the messages sent, updated and deleted since the last synchronization"""
+        room, msg_1 = await create_room_and_message(self.user_owner, self.user_receiver)
+        msg_2 = await database_sync_to_async(MessageFactory)(room=room, user=self.user_receiver)
+        msg_3 = await database_sync_to_async(MessageFactory)(room=room, user=self.user_owner)
+        msg_2_id = msg_2.id
+        watermark = timezone.now()
+
+        msg_1.content = 'Mensaje editado'
+        await database_sync_to_async(msg_1.save)()
+        await database_sync_to_async(msg_2.delete)()
+        msg_4 = await database_sync_to_async(MessageFactory)(room=room, user=self.user_receiver)
+
+        token = get_user_token(self.user_receiver)
+        url = f'/ws/{API_VERSION_V1}/chat/{room.name}/?token={token}'
+
+        communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_receiver)
+        connected, subprotocol = await communicator.connect()
+
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({
+            'command': 'sync',
+            'last_message_id': msg_3.id,
+            'watermark': watermark.isoformat(),
+        })
+
+        response = json.loads(await communicator.receive_from())
+
+        self.assertEqual([m['id'] for m in response['messages']], [msg_4.id])
+        self.assertEqual([m['id'] for m in response['updated']], [msg_1.id])
+        self.assertEqual(response['updated'][0]['content'], 'Mensaje editado')
+        self.assertEqual(response['deleted'], [msg_2_id])
+        self.assertFalse(response['resync'])
+        self.assertFalse(response['has_more'])
+        self.assertGreater(datetime.fromisoformat(response['watermark']), watermark)
+
+        # The deleted messages are kept during the synchronization window
+        await database_sync_to_async(MessageDeletion.objects.update)(deleted_at=watermark - timedelta(days=31))
+        self.assertEqual(await database_sync_to_async(delete_message_deletions)(), 1)
+        await communicator.send_json_to({
+            'command': 'sync',
+            'last_message_id': msg_3.id,
+            'watermark': (watermark - timedelta(days=31)).isoformat(),
+        })
+        response = json.loads(await communicator.receive_from())
+        self.assertTrue(response['resync'])
+        self.assertEqual(response['deleted'], [])
+
+        await communicator.disconnect()
+
+    @override_settings(
+        CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_DURABILITY='memory', CHAT_WRITE_BEHIND_FLUSH_INTERVAL=60000
+    )
+    async def test_sync_after_message_not_saved_yet(self) -> None:
+        """The last message of the client can be queued by the write-behind persistence"""
+        url = f'/ws/{API_VERSION_V1}/chat/{self.room_name}/?token={get_user_token(self.user_owner)}'
+        communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_owner)
+        await communicator.connect()
+        await communicator.send_json_to({
+            'command': 'create_message',
+            'data': {'room_name': self.room_name, 'user_receiver': self.user_receiver.username, 'content': self.message}
+        })
+        message = json.loads(await communicator.receive_from())['message']
+        self.assertFalse(await database_sync_to_async(Message.objects.filter(pk=message['id']).exists)())
+
+        await communicator.send_json_to({'command': 'sync', 'last_message_id': message['id']})
+        response = json.loads(await communicator.receive_from())
+        self.assertEqual(response['command'], 'sync')
+        self.assertNotIn('error', response)
+        self.assertEqual(response['messages'], [])
+
+        await write_behind_queue.stop()
+        await communicator.disconnect()
+
+    async def test_multiplexed_connection_subscribed_to_many_rooms(self) -> None:
+        """Receive the messages of many chat rooms over a single connection"""
+        room_1, msg_1 = await create_room_and_message(self.user_owner, self.user_receiver)
+        room_2, msg_2 = await create_room_and_message(self.user_owner, self.user_receiver)
+
+        token = get_user_token(self.user_receiver)
+        url = f'/ws/{API_VERSION_V1}/chat/?token={token}'
+
+        communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_receiver)
+        connected, subprotocol = await communicator.connect()
+
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'command': 'fetch_messages', 'room_name': room_1.name})
+        response = json.loads(await communicator.receive_from())
+        self.assertEqual(response['messages'], 'No está suscrito al chat.')
+
+        for room in (room_1, room_2):
+            await communicator.send_json_to({'command': 'subscribe', 'room_name': room.name})
+            response = json.loads(await communicator.receive_from())
+            self.assertEqual(response, {'command': 'subscribe', 'room_name': room.name})
+
+        await communicator.send_json_to({'command': 'fetch_messages', 'room_name': room_2.name})
+        response = json.loads(await communicator.receive_from())
+        self.assertEqual(response['room_name'], room_2.name)
+        self.assertEqual([m['id'] for m in response['messages']], [msg_2.id])
+
+        await communicator.send_json_to({
+            'command': 'create_message',
+            'room_name': room_1.name,
+            'data': {'content': self.message}
+        })
+        response = json.loads(await communicator.receive_from())
+        self.assertEqual(response['room_name'], room_1.name)
+        self.assertEqual(response['message']['room'], room_1.id)
+        self.assertEqual(response['message']['content'], self.message)
+
+        await communicator.send_json_to({'command': 'unsubscribe', 'room_name': room_1.name})
+        response = json.loads(await communicator.receive_from())
+        self.assertEqual(response, {'command': 'unsubscribe', 'room_name': room_1.name})
+
+        await communicator.send_json_to({'command': 'subscribe', 'room_name': 'room-1'})
+        response = json.loads(await communicator.receive_from())
+        self.assertEqual(response['messages'], 'El nombre del chat es inválido.')
+
+        await communicator.disconnect()
+
+    async def test_subscribe_refused_to_users_not_in_room(self) -> None:
+        """Users that do not participate in a chat room cannot subscribe to it nor send messages to it"""
+        room, msg = await create_room_and_message(self.user_owner, self.user_receiver)
+        user = await database_sync_to_async(UserFactory)()
+
+        url = f'/ws/{API_VERSION_V1}/chat/'
+        communicator = AuthWebsocketCommunicator(self.application, url, user=user)
+        await communicator.connect()
+
+        await communicator.send_json_to({'command': 'subscribe', 'room_name': room.name})
+        response = json.loads(await communicator.receive_from())
+        self.assertEqual((response['messages'], response['code']), ('No tiene acceso al chat.', 'forbidden'))
+
+        await communicator.send_json_to({'command': 'fetch_messages', 'room_name': room.name})
+        response = json.loads(await communicator.receive_from())
+        self.assertEqual(response['messages'], 'No está suscrito al chat.')
+        await communicator.disconnect()
+
+        communicator = AuthWebsocketCommunicator(self.application, f'{url}{room.name}/', user=user)
+        connected, subprotocol = await communicator.connect()
+        self.assertFalse(connected)
+
+        # The room did not exist when the user subscribed to it
+        room_name = 'roomnotcreated'
+        communicator = AuthWebsocketCommunicator(self.application, f'{url}{room_name}/', user=user)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        await database_sync_to_async(RoomFactory)(
+            name=room_name, user_owner=self.user_owner, user_receiver=self.user_receiver
+        )
+        await communicator.send_json_to({'command': 'fetch_messages'})
+        response = json.loads(await communicator.receive_from())
+        self.assertEqual(response['code'], 'forbidden')
+        await communicator.disconnect()
+
+    async def test_inactive_user_disconnected(self) -> None:
+        """The connections of a user are closed when it is deactivated, and it cannot connect again"""
+        application = JwtAuthMiddleware(self.application)
+        token = get_user_token(self.user_receiver)
+        url = f'/ws/{API_VERSION_V1}/chat/{self.room_name}/?token={token}'
+
+        communicator = WebsocketCommunicator(application, url)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        self.user_receiver.is_active = False
+        await database_sync_to_async(self.user_receiver.save)(update_fields=['is_active'])
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+        await communicator.wait()
+
+        communicator = WebsocketCommunicator(application, url)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_invalid_frames_rejected(self) -> None:
+        """The frames that are not an object with a command get an error frame and the connection stays open"""
+        url = f'/ws/{API_VERSION_V1}/chat/'
+        communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_owner)
+        await communicator.connect()
+
+        for frame in ('not json', '[1,2]', '{"room_name": "room"}', '{"command": 1}'):
+            await communicator.send_to(text_data=frame)
+            response = json.loads(await communicator.receive_from())
+            self.assertEqual((response['messages'], response['code']), ('La trama es inválida.', 'invalid_frame'))
+
+        await communicator.send_json_to({'command': 'subscribe', 'room_name': ['room']})
+        response = json.loads(await communicator.receive_from())
+        self.assertEqual(response['messages'], 'El nombre del chat es inválido.')
+        await communicator.disconnect()
+
+    @override_settings(CHAT_CONNECTION_RATE_LIMIT=(0.01, 2))
+    async def test_commands_rate_limited(self) -> None:
+        """The commands that exceed the rate limit of the connection are rejected"""
+        url = f'/ws/{API_VERSION_V1}/chat/{self.room_name}/?token={get_user_token(self.user_owner)}'
+        communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_owner)
+        await communicator.connect()
+
+        for _ in range(3):
+            await communicator.send_json_to({'command': 'fetch_messages'})
+        responses = [json.loads(await communicator.receive_from()) for _ in range(3)]
+
+        errors = [r for r in responses if r.get('code') == 'rate_limited']
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]['command'], 'fetch_messages')
+        self.assertGreater(errors[0]['retry_after'], 0)
+        await communicator.disconnect()
+
+    @override_settings(CHAT_USER_RATE_LIMIT=(0, 1))
+    async def test_commands_rate_limited_without_refill(self) -> None:
+        """A bucket that is not refilled rejects the commands without a retry time"""
+        communicator = AuthWebsocketCommunicator(self.application, f'/ws/{API_VERSION_V1}/chat/', user=self.user_owner)
+        await communicator.connect()
+
+        for _ in range(2):
+            await communicator.send_json_to({'command': 'unsubscribe', 'room_name': self.room_name})
+        responses = [json.loads(await communicator.receive_from()) for _ in range(2)]
+        self.assertEqual(responses[1]['code'], 'rate_limited')
+        self.assertIsNone(responses[1]['retry_after'])
+        await communicator.disconnect()
+
+    @override_settings(CHAT_COMMAND_QUEUE_SIZE=1)
+    async def test_commands_shed_when_queue_is_full(self) -> None:
+        """The commands are rejected while the queue of the connection is full"""
+        url = f'/ws/{API_VERSION_V1}/chat/{self.room_name}/?token={get_user_token(self.user_owner)}'
+        communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_owner)
+        await communicator.connect()
+
+        for _ in range(5):
+            await communicator.send_json_to({'command': 'fetch_messages'})
+        responses = [json.loads(await communicator.receive_from()) for _ in range(5)]
+
+        overloaded = [r for r in responses if r.get('code') == 'overloaded']
+        self.assertTrue(overloaded)
+        self.assertLess(len(overloaded), 5)
+        self.assertEqual(overloaded[0]['messages'], 'El servidor está ocupado, intente de nuevo.')
+        await communicator.disconnect()
+
+    async def test_presence_and_coalesced_typing_events(self) -> None:
+        """The repeated presence and typing events are broadcast to the chat room at most once per interval"""
+        room = await database_sync_to_async(RoomFactory)(user_owner=self.user_owner, user_receiver=self.user_receiver)
+        for user in (self.user_owner, self.user_receiver):
+            presence_registry.redis.delete(PRESENCE_KEY.format(user_id=user.id))
+
+        url = f'/ws/{API_VERSION_V1}/chat/{room.name}/'
+        receiver = AuthWebsocketCommunicator(self.application, url, user=self.user_receiver)
+        owner = AuthWebsocketCommunicator(self.application, url, user=self.user_owner)
+        await receiver.connect()
+        await owner.connect()
+
+        await receiver.send_json_to({'command': 'presence'})
+        frames = [json.loads(await receiver.receive_from()) for _ in range(2)]
+        self.assertIn({'user': self.user_owner.username, 'status': 'offline'}, [
+            {'user': f['user'], 'status': f['status']} for f in frames
+        ])
+        frame = json.loads(await owner.receive_from())
+        self.assertEqual((frame['user'], frame['status']), (self.user_receiver.username, 'online'))
+
+        await owner.send_json_to({'command': 'presence'})
+        frame = json.loads(await receiver.receive_from())
+        self.assertEqual(frame['command'], 'presence')
+        self.assertEqual((frame['user'], frame['status']), (self.user_owner.username, 'online'))
+
+        for _ in range(3):
+            await owner.send_json_to({'command': 'typing'})
+        frame = json.loads(await receiver.receive_from())
+        self.assertEqual((frame['command'], frame['user'], frame['typing']), ('typing', self.user_owner.username, True))
+        self.assertTrue(await receiver.receive_nothing(timeout=0.3))
+
+        # Stopping typing is not coalesced
+        await owner.send_json_to({'command': 'typing', 'typing': False})
+        frame = json.loads(await receiver.receive_from())
+        self.assertEqual((frame['command'], frame['typing']), ('typing', False))
+
+        await owner.disconnect()
+        frame = json.loads(await receiver.receive_from())
+        self.assertEqual((frame['user'], frame['status']), (self.user_owner.username, 'offline'))
+        self.assertFalse(presence_registry.is_online(self.user_owner.id))
+        await receiver.disconnect()
+
+    async def test_resumable_chunked_upload(self) -> None:
+        """A file is uploaded in chunks, resumed after reconnecting and committed as a message"""
+        room = await database_sync_to_async(RoomFactory)(user_owner=self.user_owner, user_receiver=self.user_receiver)
+        content = b'%PDF-1.4 archivo de prueba'
+        chunks = [content[i:i + 8] for i in range(0, len(content), 8)]
+        url = f'/ws/{API_VERSION_V1}/chat/{room.name}/'
+
+        def chunk_frame(upload_id, offset, chunk):
+            return {
+                'command': 'upload_chunk',
+                'upload_id': upload_id,
+                'offset': offset,
+                'data': base64.b64encode(chunk).decode(),
+                'checksum': hashlib.sha256(chunk).hexdigest(),
+            }
+
+        with tempfile.TemporaryDirectory() as files_root, \
+                override_settings(CHAT_FILES_ROOT=files_root, CHAT_UPLOAD_CHUNK_SIZE=8):
+            communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_owner)
+            await communicator.connect()
+            await communicator.send_json_to({
+                'command': 'upload_start',
+                'type': Message.Type.FILE,
+                'name': '../informe.pdf',
+                'size': len(content),
+                'checksum': hashlib.sha256(content).hexdigest(),
+            })
+            response = json.loads(await communicator.receive_from())
+            upload_id = response['upload_id']
+            self.assertEqual((response['offset'], response['chunk_size']), (0, 8))
+
+            # The checksum of the file is required
+            await communicator.send_json_to({
+                'command': 'upload_start', 'type': Message.Type.FILE, 'name': 'informe.pdf', 'size': len(content)
+            })
+            response = json.loads(await communicator.receive_from())
+            self.assertEqual(response['messages'], 'El checksum es inválido.')
+
+            await communicator.send_json_to(chunk_frame(upload_id, 0, chunks[0]))
+            response = json.loads(await communicator.receive_from())
+            self.assertEqual(response['offset'], len(chunks[0]))
+            await communicator.disconnect()
+
+            communicator = AuthWebsocketCommunicator(self.application, url, user=self.user_owner)
+            await communicator.connect()
+            await communicator.send_json_to({'command': 'upload_start', 'upload_id': upload_id})
+            offset = json.loads(await communicator.receive_from())['offset']
+            self.assertEqual(offset, len(chunks[0]))
+
+            # A chunk sent again is rejected with the offset to resume from
+            await communicator.send_json_to(chunk_frame(upload_id, 0, chunks[0]))
+            response = json.loads(await communicator.receive_from())
+            self.assertEqual(response['messages'], 'El offset del fragmento es inválido.')
+            self.assertEqual(response['offset'], offset)
+
+            # The offset claimed for a chunk that cannot be written is released
+            partial_path = os.path.join(files_root, 'uploads', f'{upload_id}.part')
+            os.rename(partial_path, f'{partial_path}.moved')
+            await communicator.send_json_to(chunk_frame(upload_id, offset, chunks[1]))
+            response = json.loads(await communicator.receive_from())
+            self.assertEqual(response['messages'], 'La carga no existe.')
+            os.rename(f'{partial_path}.moved', partial_path)
+            await communicator.send_json_to({'command': 'upload_start', 'upload_id': upload_id})
+            self.assertEqual(json.loads(await communicator.receive_from())['offset'], offset)
+
+            for chunk in chunks[1:]:
+                await communicator.send_json_to(chunk_frame(upload_id, offset, chunk))
+                offset = json.loads(await communicator.receive_from())['offset']
+            self.assertEqual(offset, len(content))
+
+            await communicator.send_json_to({'command': 'upload_commit', 'upload_id': upload_id})
+            response = json.loads(await communicator.receive_from())
+            message = response['message']
+            self.assertEqual((response['command'], response['upload_id']), ('create_message', upload_id))
+            self.assertEqual((message['type'], message['content']), (Message.Type.FILE, 'informe.pdf'))
+            self.assertEqual(message['file'], f"/api/{API_VERSION_V1}/messages/{message['id']}/file/")
+
+            # The file is stored outside MEDIA_ROOT with a random name
+            saved = await database_sync_to_async(Message.objects.get)(id=message['id'])
+            self.assertNotIn('informe', saved.file.name)
+            with open(saved.file.path, 'rb') as f:
+                self.assertEqual(f.read(), content)
+            self.assertTrue(saved.file.path.startswith(files_root))
+            self.assertFalse(os.listdir(os.path.join(files_root, 'uploads')))
+
+            # Only the users of the chat room can download it
+            def download(user):
+                return self.client.get(message['file'], HTTP_AUTHORIZATION=f'Bearer {get_user_token(user)}')
+
+            response = await database_sync_to_async(download)(self.user_receiver)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('informe.pdf', response['Content-Disposition'])
+            self.assertEqual(b''.join(response.streaming_content), content)
+            response.close()
+            response = await database_sync_to_async(download)(await database_sync_to_async(UserFactory)())
+            self.assertEqual(response.status_code, 404)
+
+            await communicator.send_json_to({'command': 'upload_commit', 'upload_id': upload_id})
+            response = json.loads(await communicator.receive_from())
+            self.assertEqual(response['messages'], 'La carga no existe.')
+            await communicator.disconnect()
+
+
+class BenchmarkTestCase(SimpleTestCase):
+    """Statistics of the load test (tests.chats.benchmark). The load test itself is run with the command."""
+
+    def test_percentile(self) -> None:
+        """The percentiles use the nearest-rank method"""
+        values = [5, 1, 4, 2, 3]
+        self.assertEqual(percentile(values, 50), 3)
+        self.assertEqual(percentile(values, 99), 5)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertIsNone(percentile([], 50))
+
+    def test_latency_summary(self) -> None:
+        """The summary of the latencies has their percentiles and maximum"""
+        summary = latency_summary(list(range(1, 101)))
+        self.assertEqual(summary, {'p50': 50, 'p95': 95, 'p99': 99, 'max': 100})
+        self.assertEqual(latency_summary([]), {'p50': None, 'p95': None, 'p99': None, 'max': None})
+
+
+class ThrottlingTestCase(SimpleTestCase):
+    """Token buckets of the chat commands"""
+
+    def test_rejected_command_does_not_consume_tokens(self) -> None:
+        """The tokens are only consumed if all the buckets have a token"""
+        connection_bucket, user_bucket = TokenBucket(0, 2), TokenBucket(0, 1)
+        self.assertTrue(consume_all((connection_bucket, user_bucket)))
+        self.assertFalse(consume_all((connection_bucket, user_bucket)))
+        self.assertEqual(connection_bucket.tokens, 1)
+        self.assertEqual(user_bucket.retry_after(), math.inf)
+        self.assertEqual(connection_bucket.retry_after(), 0)
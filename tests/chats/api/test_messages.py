@@ -0,0 +1,64 @@
+"""Message tests"""
+
+from io import StringIO
+
+from django.core.management import call_command
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from apps.chats.models import MessageToken
+from tests.accounts.factories import UserAdminFactory, UserFactory
+from tests.chats.factories import RoomFactory, MessageFactory
+from tests.utils import API_ENDPOINT_V1, AccessTokenTest
+
+
+class MessageSearchAPITestCase(APITestCase):
+    """Message search API test case"""
+
+    def setUp(self) -> None:
+        self.user_owner = UserAdminFactory()
+        self.user_receiver = UserFactory()
+        self.token = AccessTokenTest().for_user(self.user_owner)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {str(self.token)}')
+
+        self.room_1 = RoomFactory(user_owner=self.user_owner, user_receiver=self.user_receiver)
+        self.room_2 = RoomFactory(user_owner=self.user_owner)
+        self.message_1 = MessageFactory(room=self.room_1, user=self.user_owner, content='Cita médica el Lunes')
+        self.message_2 = MessageFactory(room=self.room_2, user=self.user_owner, content='La cita es mañana')
+        MessageFactory(room=self.room_1, user=self.user_receiver, content='Gracias doctor')
+        MessageFactory(room=RoomFactory(), content='Otra cita')
+        self.url = f'/{API_ENDPOINT_V1}/users/{self.user_owner.username}/messages/search/'
+
+    def test_search_messages_of_user(self) -> None:
+        """Search the messages of the chat rooms of the user by keyword"""
+        response = self.client.get(self.url, {'q': 'CITA'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([m['id'] for m in response.data['results']], [self.message_2.id, self.message_1.id])
+        self.assertEqual(response.data['results'][1]['room'], self.room_1.name)
+        self.assertEqual(response.data['results'][1]['content'], self.message_1.content)
+
+        # Todas las palabras, sin tildes
+        response = self.client.get(self.url, {'q': 'medica lunes'})
+        self.assertEqual([m['id'] for m in response.data['results']], [self.message_1.id])
+
+        response = self.client.get(self.url, {'q': 'cita', 'room': self.room_2.name})
+        self.assertEqual([m['id'] for m in response.data['results']], [self.message_2.id])
+
+        response = self.client.get(self.url, {'q': ' '})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_messages_after_editing_and_reindexing(self) -> None:
+        """The tokens are replaced when the message is edited or the messages are indexed again"""
+        self.message_1.content = 'Consulta cancelada'
+        self.message_1.save()
+
+        response = self.client.get(self.url, {'q': 'lunes'})
+        self.assertEqual(response.data['count'], 0)
+
+        MessageToken.objects.all().delete()
+        call_command('index_messages', batch_size=2, stdout=StringIO())
+
+        response = self.client.get(self.url, {'q': 'cancelada'})
+        self.assertEqual([m['id'] for m in response.data['results']], [self.message_1.id])
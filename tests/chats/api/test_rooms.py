@@ -1,11 +1,34 @@
 """Room tests"""
 
+import csv
+import json
+import os
+import tempfile
+import zipfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.contrib import admin
+from django.core import mail
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from apps.chats.models import Room, Message
+from apps.chats.admin import RoomAdmin
+from apps.chats.encryption import decrypted_content_cache
+from apps.chats.models import Message, MessageDeletion, MessagePurge, Room, RoomExport, RoomReadState
+from apps.chats.partitions import create_partitions
+from apps.chats.purge import purge_old_messages, purge_room, run_purge
+from apps.chats.tasks import archive_inactive_rooms, delete_expired_exports, export_room, send_chat_digests
+from apps.chats.utils import increment_unread_count, save_chat_message, update_room_last_message
 from tests.accounts.factories import UserAdminFactory, UserFactory, UserDoctorFactory
 from tests.chats.factories import RoomFactory, MessageFactory
+from gestion_consultas.utils import SendEmailsError
 from tests.utils import API_ENDPOINT_V1, AccessTokenTest
 
 
@@ -24,11 +47,11 @@ class RoomAPITestCase(APITestCase):
 
         MessageFactory(room=self.room_1, user=self.user_owner)
         MessageFactory(room=self.room_1, user=self.user_receiver_1)
-        MessageFactory(room=self.room_1, user=self.user_owner)
+        self.last_message_1 = MessageFactory(room=self.room_1, user=self.user_owner)
 
         MessageFactory(room=self.room_2, user=self.user_owner)
         MessageFactory.create_batch(2, room=self.room_2, user=self.user_receiver_2)
-        MessageFactory(room=self.room_2, user=self.user_owner)
+        self.last_message_2 = MessageFactory(room=self.room_2, user=self.user_owner)
 
     def test_list_chat_rooms_by_owner(self) -> None:
         """List of chat rooms where the user is an owner"""
@@ -53,6 +76,64 @@ class RoomAPITestCase(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_list_chat_rooms_with_last_message(self) -> None:
+        """List of chat rooms with the last message stored in each room"""
+        self.last_message_1.content = 'a' * 150
+        self.last_message_1.save()
+        call_command('backfill_rooms_last_message', stdout=StringIO())
+
+        url = f'/{API_ENDPOINT_V1}/users/{self.user_owner.username}/rooms/'
+        response = self.client.get(url)
+        rooms = {room['id']: room for room in response.data['results']['rooms']}
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for room, msg in [(self.room_1, self.last_message_1), (self.room_2, self.last_message_2)]:
+            self.assertEqual(rooms[room.id]['last_message']['id'], msg.id)
+            self.assertEqual(rooms[room.id]['last_message']['type'], msg.type)
+            self.assertEqual(rooms[room.id]['last_message']['content'], msg.content)
+            self.assertEqual(rooms[room.id]['last_message']['preview'], msg.content[:100])
+            self.assertIsNotNone(rooms[room.id]['last_message']['updated_at'])
+
+    def test_list_chat_rooms_with_unread_count(self) -> None:
+        """List of chat rooms with the unread messages counter of the user"""
+        increment_unread_count(self.room_1.id, self.user_owner.id, count=2)
+        increment_unread_count(self.room_1.id, self.user_owner.id)
+        increment_unread_count(self.room_2.id, self.user_receiver_2.id)
+
+        url = f'/{API_ENDPOINT_V1}/users/{self.user_owner.username}/rooms/'
+        response = self.client.get(url)
+        rooms = {room['id']: room for room in response.data['results']['rooms']}
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(rooms[self.room_1.id]['unread_count'], 3)
+        self.assertEqual(rooms[self.room_2.id]['unread_count'], 0)
+        self.assertIsNone(rooms[self.room_2.id]['last_read_message_id'])
+
+    def test_inbox_ordered_by_last_activity(self) -> None:
+        """Inbox of the user ordered by the last activity of the rooms, paginated with a cursor"""
+        call_command('backfill_rooms_last_message', stdout=StringIO())
+        room_3 = RoomFactory(user_owner=self.user_receiver_1, user_receiver=self.user_owner)
+        increment_unread_count(self.room_2.id, self.user_owner.id)
+
+        url = f'/{API_ENDPOINT_V1}/users/{self.user_owner.username}/inbox/'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'page_size': 2})
+        rooms = response.data['results']
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len([q for q in queries.captured_queries if 'FROM "room"' in q['sql']]), 1)
+        self.assertEqual([room['id'] for room in rooms], [room_3.id, self.room_2.id])
+        self.assertEqual(rooms[0]['user']['username'], self.user_receiver_1.username)
+        self.assertIsNone(rooms[0]['last_message'])
+        self.assertEqual(rooms[1]['user']['username'], self.user_receiver_2.username)
+        self.assertEqual(rooms[1]['last_message']['id'], self.last_message_2.id)
+        self.assertEqual(rooms[1]['last_message']['preview'], self.last_message_2.content[:100])
+        self.assertEqual(rooms[1]['unread_count'], 1)
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([room['id'] for room in response.data['results']], [self.room_1.id])
+        self.assertIsNone(response.data['next'])
+
     def test_list_chat_rooms_by_receiver(self):
         """List of chat rooms in which the user is a receiver"""
         token = AccessTokenTest().for_user(self.user_receiver_1)
@@ -158,3 +239,240 @@ class RoomAPITestCase(APITestCase):
         response = self.client.get(url)
 
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_retrieve_chat_rooms_with_messages_resolves_user_once(self):
+        """The user of the URL is loaded once per request, and the requesting user is not loaded again"""
+
+        def get_user_queries(url):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [query for query in queries if 'WHERE "user"."username" =' in query['sql']], response
+
+        url = f'/{API_ENDPOINT_V1}/users/{self.user_owner.username}/rooms/{self.room_1.name}/messages/'
+        self.client.get(url)
+        user_queries, response = get_user_queries(url)
+        self.assertEqual(user_queries, [])
+        self.assertEqual(response.data['user']['username'], self.user_owner.username)
+
+        url = f'/{API_ENDPOINT_V1}/users/{self.user_receiver_1.username}/rooms/{self.room_1.name}/messages/'
+        user_queries, response = get_user_queries(url)
+        self.assertEqual(len(user_queries), 1)
+        self.assertEqual(response.data['user']['username'], self.user_receiver_1.username)
+        self.assertIn('is_active', response.data['user'])
+
+    @override_settings(CHAT_DECRYPTED_CONTENT_CACHE_SIZE=1024 * 1024)
+    def test_retrieve_chat_rooms_with_messages_decrypted_from_cache(self):
+        """The messages decrypted are obtained from the cache in the following requests"""
+        decrypted_content_cache.clear()
+        url = f'/{API_ENDPOINT_V1}/users/{self.user_owner.username}/rooms/{self.room_1.name}/messages/'
+        field = Message._meta.get_field('_content_data')
+
+        with mock.patch.object(field, 'decrypt', wraps=field.decrypt) as decrypt:
+            response = self.client.get(url)
+            self.assertEqual(decrypt.call_count, 3)
+
+            response_cached = self.client.get(url)
+            self.assertEqual(decrypt.call_count, 3)
+
+        queryset = Message.objects.order_by('created_at').filter(room=self.room_1)
+        for i, msg in enumerate(queryset):
+            self.assertEqual(response.data['room']['messages'][i]['content'], msg.content)
+            self.assertEqual(response_cached.data['room']['messages'][i]['content'], msg.content)
+        decrypted_content_cache.clear()
+
+    def test_retrieve_chat_rooms_with_messages_archived_and_partitioned(self):
+        """The messages moved to the archive partition or to a new partition are still obtained"""
+        future_message = MessageFactory(
+            room=self.room_2, user=self.user_owner, created_at=datetime(2040, 1, 15, tzinfo=dt_timezone.utc)
+        )
+        self.assertEqual(create_partitions(future_message.created_at, future_message.created_at), ['message_y2040m01'])
+
+        Room.objects.filter(pk=self.room_1.pk).update(last_message_at=timezone.now() - timedelta(days=365))
+        self.assertEqual(archive_inactive_rooms(), 3)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT tableoid::regclass::text, COUNT(*) FROM message WHERE room_id IN %s GROUP BY 1',
+                [(self.room_1.id, future_message.room_id)]
+            )
+            partitions = dict(cursor.fetchall())
+        self.assertEqual(partitions['message_archive'], 3)
+        self.assertEqual(partitions['message_y2040m01'], 1)
+
+        # The archive partition is only read for the messages sent before the archive period
+        recent = Message.objects.filter(room=self.room_2).sent_after((timezone.now() - timedelta(days=1), 0))
+        self.assertNotIn('message_archive', recent.explain())
+        old = Message.objects.filter(room=self.room_1).sent_after((timezone.now() - timedelta(days=365), 0))
+        self.assertEqual(old.count(), 3)
+
+        url = f'/{API_ENDPOINT_V1}/users/{self.user_owner.username}/rooms/{self.room_1.name}/messages/'
+        response = self.client.get(url)
+        self.assertEqual(len(response.data['room']['messages']), 3)
+
+    @override_settings(CHAT_PURGE_BATCH_SIZE=2, CHAT_PURGE_BATCH_DELAY=0, CHAT_MESSAGE_RETENTION_DAYS=30)
+    def test_purge_chat_room_and_old_messages_in_batches(self):
+        """The messages are deleted in batches with the progress saved in the job, and then the chat room"""
+        # The confirmation page of the admin does not collect the messages
+        request = RequestFactory().post('/')
+        request.user = self.user_owner
+        with self.assertNumQueries(1):
+            deleted, model_count, _, _ = RoomAdmin(Room, admin.site).get_deleted_objects(
+                Room.objects.filter(pk=self.room_2.pk), request
+            )
+        self.assertEqual((deleted, model_count), ([str(self.room_2)], {Room._meta.verbose_name_plural: 1}))
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            job = purge_room(self.room_2)
+        self.assertEqual(len(callbacks), 2)
+
+        # No new messages are saved in the chat room while its messages are deleted
+        self.room_2.refresh_from_db()
+        with self.assertRaisesMessage(ValueError, 'El chat está siendo eliminado.'):
+            save_chat_message(self.room_2, self.user_owner, 'Mensaje')
+
+        job = run_purge(job.id, max_batches=1)
+        self.assertEqual((job.status, job.deleted_messages), (MessagePurge.Status.RUNNING, 2))
+        self.assertTrue(Room.objects.filter(pk=self.room_2.pk).exists())
+
+        job = run_purge(job.id)
+        self.assertEqual((job.status, job.deleted_messages), (MessagePurge.Status.DONE, 4))
+        self.assertFalse(Room.objects.filter(pk=self.room_2.pk).exists())
+        self.assertIsNone(run_purge(job.id))
+
+        Message.objects.filter(room=self.room_1).exclude(pk=self.last_message_1.pk).update(
+            created_at=timezone.now() - timedelta(days=60)
+        )
+        Room.objects.filter(pk=self.room_1.pk).update(last_message=self.last_message_1)
+        with self.captureOnCommitCallbacks():
+            job = purge_old_messages()
+        job = run_purge(job.id)
+
+        self.assertEqual(job.deleted_messages, 2)
+        self.assertEqual(list(Message.objects.filter(room=self.room_1)), [self.last_message_1])
+        self.assertEqual(MessageDeletion.objects.filter(room_id=self.room_1.id).count(), 2)
+        self.assertEqual(Room.objects.get(pk=self.room_1.pk).last_message_id, self.last_message_1.id)
+
+    @override_settings(CHAT_PURGE_BATCH_SIZE=2, CHAT_PURGE_BATCH_DELAY=0, CHAT_MESSAGE_RETENTION_DAYS=30)
+    def test_purge_old_messages_removes_last_message_preview(self):
+        """The rooms do not keep the preview of the messages deleted by the retention policy"""
+        old_message = self.last_message_2
+        Message.objects.filter(room=self.room_2).update(created_at=timezone.now() - timedelta(days=60))
+        old_message.refresh_from_db()
+        update_room_last_message(old_message, force=True)
+        update_room_last_message(Message.objects.get(pk=self.last_message_1.pk), force=True)
+        Message.objects.filter(room=self.room_1).exclude(pk=self.last_message_1.pk).update(
+            created_at=timezone.now() - timedelta(days=60)
+        )
+        # The last message of the room is older than a message left
+        Room.objects.filter(pk=self.room_1.pk).update(
+            last_message=Message.objects.filter(room=self.room_1).exclude(pk=self.last_message_1.pk).first()
+        )
+
+        with self.captureOnCommitCallbacks():
+            job = purge_old_messages()
+        run_purge(job.id)
+
+        room_2 = Room.objects.get(pk=self.room_2.pk)
+        self.assertEqual(
+            (room_2.last_message_id, room_2.last_message_type, room_2.last_message_at, room_2.last_message_preview),
+            (None, None, None, '')
+        )
+        room_1 = Room.objects.get(pk=self.room_1.pk)
+        self.assertEqual(room_1.last_message_id, self.last_message_1.id)
+        self.assertEqual(room_1.last_message_preview, self.last_message_1.content[:len(room_1.last_message_preview)])
+        self.assertTrue(room_1.last_message_preview)
+
+    def test_chat_digest_emails_aggregated_per_recipient(self):
+        """Each user receives a single e-mail with the rooms not read within the window"""
+        room_3 = RoomFactory(user_owner=self.user_receiver_2, user_receiver=self.user_receiver_1)
+        for room, user in [(self.room_1, self.user_receiver_1), (room_3, self.user_receiver_1),
+                           (room_3, self.user_receiver_1), (self.room_2, self.user_receiver_2)]:
+            increment_unread_count(room.id, user.id)
+
+        self.assertEqual(send_chat_digests(), 0)
+
+        RoomReadState.objects.update(unread_since=timezone.now() - timedelta(hours=1))
+        RoomReadState.objects.filter(room=self.room_2).update(unread_count=0, unread_since=None)
+        self.assertEqual(send_chat_digests(), 1)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.user_receiver_1.email])
+        self.assertIn(self.user_receiver_2.get_full_name(), mail.outbox[0].body)
+        self.assertIn(f'/chat/{room_3.name}', mail.outbox[0].body)
+        self.assertIn(f'/chat/{self.room_1.name}', mail.outbox[0].body)
+
+        # The rooms are notified once per unread period
+        increment_unread_count(self.room_1.id, self.user_receiver_1.id)
+        self.assertEqual(send_chat_digests(), 0)
+
+    def test_chat_digest_rooms_pending_if_email_not_sent(self):
+        """The rooms of the users whose e-mail could not be sent are included in the next digest"""
+        increment_unread_count(self.room_1.id, self.user_receiver_1.id)
+        RoomReadState.objects.update(unread_since=timezone.now() - timedelta(hours=1))
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError):
+            with self.assertRaises(SendEmailsError):
+                send_chat_digests()
+        self.assertIsNone(RoomReadState.objects.get(room=self.room_1, user=self.user_receiver_1).notified_at)
+
+        self.assertEqual(send_chat_digests(), 1)
+        self.assertEqual(mail.outbox[0].to, [self.user_receiver_1.email])
+
+    def test_export_chat_room_in_background(self):
+        """The transcript of the chat room is written by a task as JSON lines or as a CSV file in a ZIP file"""
+        url = f'/{API_ENDPOINT_V1}/rooms/{self.room_1.name}/export/'
+        with tempfile.TemporaryDirectory() as files_root, override_settings(CHAT_FILES_ROOT=files_root):
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.client.post(url)
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual(len(callbacks), 1)
+            self.assertEqual((response.data['status'], response.data['file']), (RoomExport.Status.PENDING, None))
+
+            self.assertEqual(export_room(response.data['id']), RoomExport.Status.DONE)
+            self.assertIsNone(export_room(response.data['id']))
+            response = self.client.get(f'{url}{response.data["id"]}/')
+            self.assertEqual(response.data['status'], RoomExport.Status.DONE)
+            response = self.client.get(response.data['file'])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['Content-Disposition'], f'attachment; filename="chat_{self.room_1.name}.jsonl"')
+
+            messages = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+            queryset = Message.objects.filter(room=self.room_1).order_by('created_at', 'id')
+            self.assertEqual([m['id'] for m in messages], [m.id for m in queryset])
+            self.assertEqual(messages[-1]['content'], self.last_message_1.content)
+
+            with self.captureOnCommitCallbacks():
+                response = self.client.post(url, {'type': 'csv', 'zip': True})
+            export_room(response.data['id'])
+            response = self.client.get(f'{url}{response.data["id"]}/file/')
+            self.assertEqual(response['Content-Type'], 'application/zip')
+            with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as archive:
+                rows = list(csv.reader(StringIO(archive.read(f'chat_{self.room_1.name}.csv').decode())))
+            self.assertEqual(rows[0][:4], ['id', 'user', 'type', 'content'])
+            self.assertEqual([int(row[0]) for row in rows[1:]], [m.id for m in queryset])
+
+            # The exports are only downloaded by the user who requested them, until they expire
+            export = RoomExport.objects.get(format=RoomExport.Format.CSV)
+            token = AccessTokenTest().for_user(UserAdminFactory())
+            self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {str(token)}')
+            self.assertEqual(self.client.get(f'{url}{export.id}/file/').status_code, status.HTTP_404_NOT_FOUND)
+            RoomExport.objects.update(created_at=timezone.now() - timedelta(days=2))
+            self.assertEqual(delete_expired_exports(), 2)
+            self.assertFalse(os.path.exists(export.file.path))
+
+        response = self.client.post(url, {'type': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        token = AccessTokenTest().for_user(self.user_receiver_1)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {str(token)}')
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # A DOCTOR user only exports the rooms in which it participates
+        token = AccessTokenTest().for_user(self.user_receiver_2)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {str(token)}')
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.post(f'/{API_ENDPOINT_V1}/rooms/{self.room_2.name}/export/')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
@@ -0,0 +1,353 @@
+"""
+Load test of the chat websocket (MessageConsumer).
+
+Opens `connections` authenticated consumers distributed across `rooms` chat rooms, using the WebsocketCommunicator
+and the InMemoryChannelLayer of the test settings, and measures two phases:
+    create_message: each consumer sends `create-rate` messages per second during `duration` seconds. The delivery
+        latency is the time from sending a message until each consumer of the room receives it.
+    fetch_messages: each consumer gets the history `fetch-rate` times per second during `duration` seconds.
+
+The results (messages/sec, p50/p95/p99 latencies and DB queries per message) are written as JSON.
+
+Usage:
+    python -m tests.chats.benchmark --connections 50 --rooms 10 --duration 10 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from unittest import mock
+
+import django
+
+
+def percentile(values, percent):
+    """Get the percentile of the values using the nearest-rank method"""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, math.ceil(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def latency_summary(latencies):
+    """Get the percentiles of the latencies in milliseconds"""
+    return {
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else None,
+    }
+
+
+class QueryCounter:
+    """Counts the queries executed by all the database connections, including the ones of the thread pool"""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def patch(self):
+        from django.db.backends.utils import CursorWrapper
+
+        execute, executemany = CursorWrapper.execute, CursorWrapper.executemany
+        counter = self
+
+        def counted_execute(self, *args, **kwargs):
+            with counter.lock:
+                counter.count += 1
+            return execute(self, *args, **kwargs)
+
+        def counted_executemany(self, *args, **kwargs):
+            with counter.lock:
+                counter.count += 1
+            return executemany(self, *args, **kwargs)
+
+        with mock.patch.object(CursorWrapper, 'execute', counted_execute), \
+                mock.patch.object(CursorWrapper, 'executemany', counted_executemany):
+            yield self
+
+
+def create_rooms(connections, rooms):
+    """
+    Create the users and chat rooms of the load test
+    :return: List of (user, token, room) of each connection
+    """
+    from tests.accounts.factories import UserFactory
+    from tests.chats.factories import RoomFactory
+    from tests.utils import AccessTokenTest
+
+    suffix = uuid.uuid4().hex[:8]
+    users = [UserFactory(username=f'bench{suffix}{i}') for i in range(max(connections, 2))]
+    room_list = [
+        RoomFactory(
+            name=f'bench{suffix}{i}', user_owner=users[i % len(users)], user_receiver=users[(i + 1) % len(users)]
+        )
+        for i in range(rooms)
+    ]
+    return [
+        (users[i], str(AccessTokenTest().for_user(users[i])), room_list[i % rooms])
+        for i in range(connections)
+    ]
+
+
+class Client:
+    """Consumer of the load test"""
+
+    def __init__(self, application, user, token, room):
+        from channels.testing import WebsocketCommunicator
+
+        self.user = user
+        self.room = room
+        self.user_receiver = room.user_receiver if room.user_owner_id == user.id else room.user_owner
+        self.communicator = WebsocketCommunicator(application, f'/ws/v1/chat/{room.name}/?token={token}')
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError(f'The user {self.user.username} could not connect.')
+
+    async def send(self, content):
+        await self.communicator.send_to(text_data=json.dumps(content))
+
+    async def receive(self, timeout=10):
+        return json.loads(await self.communicator.receive_from(timeout))
+
+
+async def run_create_phase(clients, room_members, rate, duration):
+    """
+    Send messages from all the consumers at `rate` messages per second each and measure their delivery
+    :return: Phase results
+    """
+    sent_at = {}
+    latencies = []
+    expected = 0
+    delivered = asyncio.Event()
+    deliveries = 0
+    rejected = 0
+
+    async def receive(client):
+        nonlocal deliveries, expected, rejected
+        while True:
+            frame = await client.receive(timeout=None)
+            if frame.get('code') is not None:
+                # Rejected by the rate limits or the command queue of the connection
+                rejected += 1
+                expected -= room_members[client.room.name]
+            elif frame.get('command') == 'create_message':
+                received_at = time.perf_counter()
+                latencies.append((received_at - sent_at[frame['message']['content']]) * 1000)
+                deliveries += 1
+            if sending_done and deliveries >= expected:
+                delivered.set()
+
+    async def send(client):
+        nonlocal expected
+        interval = 1 / rate
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            content = f'benchmark {uuid.uuid4().hex}'
+            sent_at[content] = time.perf_counter()
+            expected += room_members[client.room.name]
+            await client.send({
+                'command': 'create_message',
+                'data': {
+                    'room_name': client.room.name,
+                    'user_receiver': client.user_receiver.username,
+                    'content': content,
+                }
+            })
+            await asyncio.sleep(interval)
+
+    sending_done = False
+    receivers = [asyncio.ensure_future(receive(client)) for client in clients]
+    start = time.perf_counter()
+    await asyncio.gather(*[send(client) for client in clients])
+    sending_done = True
+    if deliveries < expected:
+        try:
+            await asyncio.wait_for(delivered.wait(), timeout=max(10, duration))
+        except asyncio.TimeoutError:
+            pass
+    elapsed = time.perf_counter() - start
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    return {
+        'messages': len(sent_at) - rejected,
+        'rejected': rejected,
+        'deliveries': deliveries,
+        'deliveries_expected': expected,
+        'seconds': elapsed,
+        'messages_per_second': (len(sent_at) - rejected) / elapsed,
+        'deliveries_per_second': deliveries / elapsed,
+        'delivery_latency_ms': latency_summary(latencies),
+    }
+
+
+async def run_fetch_phase(clients, rate, duration, page_size):
+    """
+    Get the history from all the consumers at `rate` requests per second each
+    :return: Phase results
+    """
+    latencies = []
+    frames = 0
+    rejected = 0
+
+    async def fetch(client):
+        nonlocal frames, rejected
+        interval = 1 / rate
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            sent_at = time.perf_counter()
+            await client.send({'command': 'fetch_messages', 'page_size': page_size})
+            while True:
+                frame = await client.receive()
+                frames += 1
+                if not frame.get('has_more'):
+                    break
+            if frame.get('code') is not None:
+                rejected += 1
+            else:
+                latencies.append((time.perf_counter() - sent_at) * 1000)
+            await asyncio.sleep(max(0, interval - (time.perf_counter() - sent_at)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[fetch(client) for client in clients])
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': len(latencies),
+        'rejected': rejected,
+        'frames': frames,
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed,
+        'latency_ms': latency_summary(latencies),
+    }
+
+
+async def run_benchmark(connections=10, rooms=2, duration=5, create_rate=5, fetch_rate=1, page_size=None):
+    """
+    Run the load test against the current database
+    :param connections: Number of concurrent consumers
+    :param rooms: Number of chat rooms. The consumers are distributed across the rooms
+    :param duration: Seconds of each phase
+    :param create_rate: Messages per second sent by each consumer
+    :param fetch_rate: History requests per second sent by each consumer
+    :param page_size: Number of messages per frame of the history
+    :return: Results
+    """
+    from channels.db import database_sync_to_async
+    from channels.routing import URLRouter
+    from django.conf import settings
+    from django.urls import re_path
+
+    from apps.chats.api.consumers.messages import MessageConsumer
+    from apps.chats.write_behind import write_behind_queue
+    from gestion_consultas.middleware import JwtAuthMiddleware
+
+    application = JwtAuthMiddleware(URLRouter([
+        re_path(r'ws/v1/chat/(?P<room_name>\w+)/$', MessageConsumer.as_asgi())
+    ]))
+    page_size = page_size or settings.CHAT_MESSAGES_PAGE_SIZE
+
+    clients_data = await database_sync_to_async(create_rooms)(connections, rooms)
+    clients = [Client(application, *data) for data in clients_data]
+    room_members = {}
+    for client in clients:
+        room_members[client.room.name] = room_members.get(client.room.name, 0) + 1
+
+    results = {
+        'config': {
+            'connections': connections,
+            'rooms': rooms,
+            'duration': duration,
+            'create_rate': create_rate,
+            'fetch_rate': fetch_rate,
+            'page_size': page_size,
+            'write_behind': settings.CHAT_WRITE_BEHIND,
+            'channel_layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+            'python': platform.python_version(),
+        }
+    }
+
+    await asyncio.gather(*[client.connect() for client in clients])
+    try:
+        with QueryCounter().patch() as counter:
+            results['create_message'] = await run_create_phase(clients, room_members, create_rate, duration)
+            if settings.CHAT_WRITE_BEHIND:
+                await write_behind_queue.stop()
+        results['create_message']['db_queries'] = counter.count
+        results['create_message']['db_queries_per_message'] = (
+            counter.count / results['create_message']['messages'] if results['create_message']['messages'] else None
+        )
+
+        with QueryCounter().patch() as counter:
+            results['fetch_messages'] = await run_fetch_phase(clients, fetch_rate, duration, page_size)
+        results['fetch_messages']['db_queries'] = counter.count
+        results['fetch_messages']['db_queries_per_request'] = (
+            counter.count / results['fetch_messages']['requests'] if results['fetch_messages']['requests'] else None
+        )
+    finally:
+        await asyncio.gather(*[client.communicator.disconnect() for client in clients])
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of the chat websocket.')
+    parser.add_argument('--connections', type=int, default=10, help='Number of concurrent consumers. Default 10.')
+    parser.add_argument('--rooms', type=int, default=2, help='Number of chat rooms. Default 2.')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds of each phase. Default 5.')
+    parser.add_argument(
+        '--create-rate', type=float, default=5, help='Messages per second sent by each consumer. Default 5.'
+    )
+    parser.add_argument(
+        '--fetch-rate', type=float, default=1, help='History requests per second sent by each consumer. Default 1.'
+    )
+    parser.add_argument('--page-size', type=int, default=None, help='Number of messages per frame of the history.')
+    parser.add_argument('--write-behind', action='store_true', help='Save the messages in write-behind mode.')
+    parser.add_argument('--output', help='File where the JSON results are written. By default they are printed.')
+    options = parser.parse_args(argv)
+
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.test_settings'
+    django.setup()
+
+    from django.test.utils import get_runner, override_settings
+    from django.conf import settings
+
+    runner = get_runner(settings)(verbosity=0)
+    runner.setup_test_environment()
+    old_config = runner.setup_databases()
+    try:
+        with override_settings(CHAT_WRITE_BEHIND=options.write_behind, CHAT_WRITE_BEHIND_DURABILITY='memory'):
+            results = asyncio.run(run_benchmark(
+                connections=options.connections,
+                rooms=options.rooms,
+                duration=options.duration,
+                create_rate=options.create_rate,
+                fetch_rate=options.fetch_rate,
+                page_size=options.page_size,
+            ))
+    finally:
+        runner.teardown_databases(old_config)
+        runner.teardown_test_environment()
+
+    output = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()